@@ -1,7 +1,12 @@
+import os
+
 from ControlUnit import create_control
 from CarModel import CarEnvironment, CarEnvironment1
 import hierarchical_control as hc
 import auto_tune as at
+import result_cache as rc
+import scenario as sc
+import tuning_db as tdb
 
 import yaml_functions as yf
 import WinDeklar.WindowForm as WinForm
@@ -39,7 +44,13 @@ class CarSpeedControl(hc.BaseHierarchicalControl):
 
 class AutoTuneCar(at.AutoTuneFunction):
     def __init__(self, car_name, control, output_lag, reference_changes, slope=0.0, slope_changes=(), dt=0.1,
-                 max_iter=500, change=2.0, debug=False):
+                 max_iter=500, change=2.0, bank=None, cache=None, debug=False):
+        """
+        :param bank:  optional scenario.ScenarioBank, if given each candidate cost is the mean of the episodes in all of
+                      its scenarios (the same ones for every candidate, the reference changes are kept)
+        :param cache: optional result_cache.ResultCache, so episodes already run (even in other sessions) are not run
+                      again
+        """
         self.dt                = dt
         self.output_lag        = output_lag
         self.slope             = slope
@@ -47,6 +58,10 @@ class AutoTuneCar(at.AutoTuneFunction):
         self.car_name          = car_name
         self.reference_changes = reference_changes
         self.slope_changes     = slope_changes
+        self.bank              = bank
+        self.cache             = cache
+        self.control_digest    = rc.object_digest(control) if cache is not None else None  # before any episode
+        self.last_costs        = []  # cost in each scenario of the bank in the last episode run
         self.debug             = debug
 
         super(AutoTuneCar, self).__init__(max_iter=max_iter, change=change)
@@ -57,7 +72,20 @@ class AutoTuneCar(at.AutoTuneFunction):
     def set_parameters(self, parameters):
         return self.control.set_parameters(parameters)
 
+    def get_context(self):
+        features = tdb.scenario_features(self.reference_changes, self.slope_changes, steps=self.max_iter)
+        if self.bank is not None:
+            features['bank'] = len(self.bank)
+        return {tdb.TuningDatabase.k_hierarchy:  tdb.hierarchy_name(self.control.get_type(),
+                                                                    self.control.get_parameters()),
+                tdb.TuningDatabase.k_plant:      self.car_name,
+                tdb.TuningDatabase.k_output_lag: self.output_lag,
+                tdb.TuningDatabase.k_slope:      self.slope,
+                tdb.TuningDatabase.k_features:   features}
+
     def run_one_episode(self, parameters):
+        if self.bank is not None:
+            return self.run_bank_episodes(parameters)
         self.control.set_parameters(parameters)
         self.control.reset()
         env = CarEnvironment(self.control, car_name=self.car_name, output_lag=self.output_lag, slope=self.slope,
@@ -66,11 +94,53 @@ class AutoTuneCar(at.AutoTuneFunction):
                                                    slope_changes=self.slope_changes, debug=True)
         return cost
 
+    def run_bank_episodes(self, parameters):
+        base            = sc.Scenario.from_changes(reference_changes=self.reference_changes)
+        self.last_costs = []
+        for i in range(len(self.bank)):
+            self.control.set_parameters(parameters)
+            self.control.reset()
+            env = CarEnvironment(self.control, car_name=self.car_name, output_lag=self.output_lag, slope=self.slope,
+                                 dt=self.dt, max_steps=self.max_iter)
+            steps, observation, cost = env.run_episode(scenario=self.bank.get_scenario(i, base=base),
+                                                       noise=self.bank.get_noise(i), debug=self.debug)
+            self.last_costs.append(cost)
+        return sum(self.last_costs)/len(self.last_costs)
+
+    def compare_parameters(self, parameters_a, parameters_b):
+        """
+        Returns the paired comparison (see scenario.paired_comparison) of two candidates in the bank scenarios
+        """
+        self.run_bank_episodes(parameters_a)
+        costs_a = self.last_costs
+        self.run_bank_episodes(parameters_b)
+        return sc.paired_comparison(costs_a, self.last_costs)
+
     def run_function_with_parameters(self, parameters):
-        cost = self.run_one_episode(parameters)
+        key_parts = self.get_cache_key(parameters) if self.cache is not None else None
+        if key_parts is None:
+            cost = self.run_one_episode(parameters)
+        else:
+            cost, self.last_costs = self.cache.get_or_run(key_parts, self.run_episode_and_costs, parameters)
         # print('  run, parameters: %s cost: %.2f' % (parameters, cost))
         return cost
 
+    def run_episode_and_costs(self, parameters):
+        cost = self.run_one_episode(parameters)
+        return cost, self.last_costs
+
+    def get_cache_key(self, parameters):
+        """
+        Returns what defines an episode: the control (as it was created), the parameters, the car definition, the
+        changes and the scenarios, None if the control can not be hashed
+        """
+        if self.control_digest is None:
+            return None
+        car_digest = rc.file_digest('cars/cars_definition.yaml', os.path.dirname(os.path.abspath(__file__)))
+        return [type(self).__name__, self.control_digest, parameters, self.car_name, car_digest, self.output_lag,
+                self.slope, self.dt, self.max_iter, self.reference_changes, self.slope_changes,
+                rc.object_digest(self.bank) if self.bank is not None else None]
+
 
 class CarPositionalControl(hc.BaseHierarchicalControl):
     """
@@ -1,6 +1,8 @@
 import numpy as np
 
+import scenario as sc
 import signals as sg
+import telemetry
 import yaml_functions as yf
 import unit_test as ut
 
@@ -10,56 +12,107 @@ class CarEnvironment1:
     Defines an Environment where a give car_name is controlled with a given control
     """
 
-    def __init__(self, control, car_name='simple', output_lag=0, slope=0.0, dt=0.1, max_steps=500):
-        self.slope      = slope
-        self.car_name   = car_name
-        self.output_lag = output_lag
-        self.dt         = dt
-        self.control    = control
-        self.max_iter   = max_steps
-        self.last_episode_observations = []
+    def __init__(self, control, car_name='simple', output_lag=0, slope=0.0, dt=0.1, max_steps=500, channels=None,
+                 decimation=1, sensor_noise=0.0, seed=None):
+        """
+        :param channels:     names of the values (sensors, actuators or any other control value) recorded in each step,
+                             None means all
+        :param decimation:   record just one of every decimation steps
+        :param sensor_noise: standard deviation of the gaussian noise added to the sensors seen by the control (the
+                             recorded ones are the actual values)
+        :param seed:         seed of the noise, so episodes can be repeated
+        """
+        self.slope        = slope
+        self.car_name     = car_name
+        self.output_lag   = output_lag
+        self.dt           = dt
+        self.control      = control
+        self.max_iter     = max_steps
+        self.sensors      = {}
+        self.sensor_noise = sensor_noise
+        self.seed         = seed
+        self.recorder     = telemetry.TelemetryRecorder(channels=channels, capacity=max_steps//max(decimation, 1) + 1,
+                                                        decimation=decimation)
 
     def run_episode(self, reference_changes=(), slope_changes=(), acc_pedal_key='accelerator', brake_pedal_key='brake',
-                    debug=False):
+                    debug=False, sink=None, scenario=None, noise=None):
         """
         Run a feedback control loop for a number of steps
         :param brake_pedal_key:
         :param acc_pedal_key:
         :param slope_changes:
-        :param reference_changes: list (iter, reference) where the reference will be changed (ex: [[0, 5], [40, 0]]
-                                  means at step 0 reference will be set at 5 and in step 40 will be set at 0)
+        :param reference_changes: list (iter, reference_name, reference) where the reference will be changed (ex:
+                                  [[0, 'ref_speed', 5], [40, 'ref_speed', 0]] means at step 0 reference will be set at 5
+                                  and in step 40 will be set at 0)
         :param debug:
+        :param sink:              optional object with record(t, values), i.e. telemetry.ChunkWriter, that receives the
+                                  values of every step besides self.recorder
+        :param scenario:          scenario.Scenario (or its file name) used instead of reference and slope changes
+        :param noise:             optional array (steps x sensors, in CarModel.get_sensor_names order) added to the
+                                  sensors seen by the control, i.e. from a scenario.ScenarioBank so every candidate of a
+                                  tuning sees the same noise (the last row is used after its last step)
         :return:
         """
-        self.last_episode_observations = []
-        car_model = self.get_car_model(acc_pedal_key=acc_pedal_key, brake_pedal_key=brake_pedal_key)
-        sensors   = car_model.get_sensors()
-        # print('sensors: %s' % sensors)
-        steps     = 0
-        t         = 0.0
-        while steps < self.max_iter:
-            self.run_one_cycle(sensors, t, reference_changes, steps, slope_changes, car_model)
+        self.recorder.reset()
+        steps = 0
+        for t, values in self.iter_episode(reference_changes=reference_changes, slope_changes=slope_changes,
+                                           acc_pedal_key=acc_pedal_key, brake_pedal_key=brake_pedal_key,
+                                           scenario=scenario, noise=noise):
+            self.recorder.record(t, values)
+            if sink is not None:
+                sink.record(t, values)
             steps += 1
 
         if debug:
             print('   episode cost: %.3f for control: %s' % (self.control.get_total_cost(), self.control.parm_string()))
-        return steps, sensors, self.control.get_total_cost()
+        return steps, self.sensors, self.control.get_total_cost()
 
-    def run_one_cycle(self, sensors, t, reference_changes, steps, slope_changes, car_model):
-        for [i, reference_name, reference_value] in reference_changes:
-            if i == steps:
-                self.control.set_value(reference_name, reference_value)
+    def iter_episode(self, reference_changes=(), slope_changes=(), acc_pedal_key='accelerator',
+                     brake_pedal_key='brake', scenario=None, noise=None):
+        """
+        Same as run_episode but step by step, yielding the values of each step as soon as they are produced, so long
+        episodes can be processed or saved (see telemetry.chunks and telemetry.ChunkWriter) without keeping them in
+        memory (nothing is recorded in self.recorder)
+        :return: yields (t, values) where values is a dict with the control state, actuators and sensors
+        """
+        scenario     = sc.get_scenario(scenario, reference_changes=reference_changes, slope_changes=slope_changes)
+        car_model    = self.get_car_model(acc_pedal_key=acc_pedal_key, brake_pedal_key=brake_pedal_key)
+        rng          = np.random.default_rng(self.seed) if self.sensor_noise > 0.0 else None
+        noise_names  = car_model.get_sensor_names()
+        self.sensors = car_model.get_sensors()
+        # print('sensors: %s' % sensors)
+        for steps in range(self.max_iter):
+            t, values    = self.run_one_cycle(self.sensors, steps*self.dt, scenario, steps, car_model)
+            self.sensors = car_model.get_sensors()  # fed back to the control in the next step
+            if rng is not None:
+                self.sensors = {name: value + rng.normal(0.0, self.sensor_noise)
+                                for name, value in self.sensors.items()}
+            if noise is not None:
+                self.sensors = dict(self.sensors)
+                for name, step_noise in zip(noise_names, noise[min(steps, len(noise) - 1)].tolist()):
+                    self.sensors[name] += step_noise
+            yield t, values
+
+    def run_one_cycle(self, sensors, t, scenario, steps, car_model):
+        for [event_type, name, value] in scenario.get_events(steps):
+            if event_type == sc.Scenario.k_reference:
+                if name not in self.control.reference_names:
+                    raise Exception('Reference "%s" of a scenario event not known, must be one of %s' %
+                                    (name, self.control.reference_names))
+                self.control.set_value(name, value)
                 # print('set reference to: %s' % reference)
-        for [i, slope] in slope_changes:
-            if i == steps:
-                car_model.set_slope(slope)
+            else:
+                apply_event(car_model, event_type, value)
 
         actions = self.control.get_actuators(sensors)
         car_model.apply_actions(actions, self.dt)
         sensors = car_model.get_sensors()
         # print('sensors: %s actuators %s' % (sensors, actions))
         t += self.dt
-        self.last_episode_observations.append([t, sensors])
+        values = dict(self.control.get_state())
+        values.update(actions)
+        values.update(sensors)
+        return t, values
 
     def get_car_model(self, acc_pedal_key='accelerator', brake_pedal_key='brake'):
         car_type  = get_car_type(self.car_name)
@@ -68,30 +121,56 @@ class CarEnvironment1:
         return car_model
 
     def get_sensor_evolution(self, sensor_name):
-        for [t, sensors] in self.last_episode_observations:
-            yield [t, sensors[sensor_name]]
+        return self.recorder.get_evolution(sensor_name)
 
 
 class CarEnvironment:
-    def __init__(self, control, car_name='simple', output_lag=0, slope=0.0, dt=0.1, max_steps=500):
-        self.slope      = slope
-        self.car_name   = car_name
-        self.output_lag = output_lag
-        self.dt         = dt
-        self.control    = control
-        self.max_iter   = max_steps
-        self.last_episode_observations = []
-
-    def run_episode(self, reference_changes=(), slope_changes=(), debug=False):
+    k_state = ['position', 'speed', 'acceleration']  # names of the values in CarModel.get_state (used to record them)
+
+    def __init__(self, control, car_name='simple', output_lag=0, slope=0.0, dt=0.1, max_steps=500, decimation=1):
+        self.slope       = slope
+        self.car_name    = car_name
+        self.output_lag  = output_lag
+        self.dt          = dt
+        self.control     = control
+        self.max_iter    = max_steps
+        self.observation = ()
+        self.recorder    = telemetry.TelemetryRecorder(channels=self.k_state,
+                                                       capacity=max_steps//max(decimation, 1) + 2,
+                                                       decimation=decimation)
+
+    def run_episode(self, reference_changes=(), slope_changes=(), debug=False, sink=None, scenario=None, noise=None):
         """
         Run a feedback control loop for a number of steps
         :param slope_changes:
         :param reference_changes: list (iter, reference) where the reference will be changed (ex: [[0, 5], [40, 0]]
                                   means at step 0 reference will be set at 5 and in step 40 will be set at 0)
         :param debug:
+        :param sink:              optional object with record(t, values), i.e. telemetry.ChunkWriter, that receives the
+                                  values of every step besides self.recorder
+        :param scenario:          scenario.Scenario (or its file name) used instead of reference and slope changes
+        :param noise:             optional array (steps x 3) added to the observation seen by the control
         :return:
         """
-        self.last_episode_observations = []
+        self.recorder.reset()
+        steps = 0
+        for t, values in self.iter_episode(reference_changes=reference_changes, slope_changes=slope_changes,
+                                           scenario=scenario, noise=noise):
+            self.recorder.record(t, values)
+            if sink is not None:
+                sink.record(t, values)
+            steps += 1
+        if debug:
+            print('   episode cost: %.3f for control: %s' % (self.control.get_total_cost(), self.control.parm_string()))
+        return steps, self.observation, self.control.get_total_cost()
+
+    def iter_episode(self, reference_changes=(), slope_changes=(), scenario=None, noise=None):
+        """
+        Same as run_episode but step by step, yielding the values of each step (see k_state) as soon as they are
+        produced (nothing is recorded in self.recorder)
+        :return: yields (t, values)
+        """
+        scenario    = sc.get_scenario(scenario, reference_changes=reference_changes, slope_changes=slope_changes)
         car_type    = get_car_type(self.car_name)
         car_model   = CarModel(car_type, slope=self.slope, output_lag=self.output_lag)
         observation = car_model.get_state()
@@ -99,37 +178,55 @@ class CarEnvironment:
         steps       = 0
         t           = 0.0
         while not ended:
-            for [i, reference] in reference_changes:
-                if i == steps:
-                    self.control.set_reference(reference)
+            for [event_type, _, value] in scenario.get_events(steps):
+                if event_type == sc.Scenario.k_reference:
+                    self.control.set_reference(value)
                     # print('set reference to: %s' % reference)
-            for [i, slope] in slope_changes:
-                if i == steps:
-                    car_model.set_slope(slope)
+                else:
+                    apply_event(car_model, event_type, value)
 
-            actions = self.control.get_actions(observation, [])
+            seen    = observation if noise is None else tuple(np.add(observation, noise[min(steps, len(noise) - 1)]))
+            actions = self.control.get_actions(seen, [])
             car_model.apply_actions(actions, self.dt)
             observation = car_model.get_state()
             steps += 1
             t     += self.dt
-            self.last_episode_observations.append([t, observation])
+            self.observation = observation
+            yield t, dict(zip(self.k_state, observation))
             if steps > self.max_iter:
                 ended = True
-        if debug:
-            print('   episode cost: %.3f for control: %s' % (self.control.get_total_cost(), self.control.parm_string()))
-        return steps, observation, self.control.get_total_cost()
 
     def get_speed_evolution(self):
-        for [t, observation] in self.last_episode_observations:
-            yield [t, observation[1]]
+        return self.recorder.get_evolution('speed')
 
     def get_position_evolution(self):
-        return [[t, observation[0]] for [t, observation] in self.last_episode_observations]
+        return self.recorder.get_evolution('position')
+
+
+def apply_event(car_model, event_type, value):
+    """
+    Applies a scenario event (but references, that are handled by the control) to a car model
+    """
+    if event_type == sc.Scenario.k_slope:
+        car_model.set_slope(value)
+    elif event_type == sc.Scenario.k_disturbance:
+        car_model.set_disturbance(value)
+    elif event_type == sc.Scenario.k_lag:
+        car_model.set_output_lag(int(value))
+    else:
+        raise Exception('Scenario event "%s" not valid for a car' % event_type)
 
 
 class CarModel:
     gravity         = 9.8
 
+    # configuration
+    __slots__ = ('car_type', 'olag', 'max_pedal_value', 'friction', 'pos_sensor_key', 'speed_sensor_key',
+                 'acc_sensor_key', 'acc_pedal_key', 'brake_pedal_key',
+                 # dynamic values
+                 'acc_values', 'acc_pedal', 'brake_pedal', 'current_pos', 'current_v', 'current_acc', 'slope_acc',
+                 'disturbance_acc')
+
     def __init__(self, car_type, slope=0.0, friction=0.1, output_lag=0, max_pedal_value=100, pos_sensor_key='position',
                  speed_sensor_key='speed', acc_sensor_key='acceleration', acc_pedal_key='acc', brake_pedal_key='brake'):
         """
@@ -157,6 +254,8 @@ class CarModel:
         self.slope_acc   = 0.0
         self.friction    = friction
 
+        self.disturbance_acc = 0.0  # external acceleration (i.e. wind), positive pushes forward
+
         self.set_slope(slope)
 
         self.reset()
@@ -202,7 +301,7 @@ class CarModel:
 
         # calc all accelerations
         valid_acc    = self.car_type.valid_acc(actual_acc)
-        forward_acc  = valid_acc - self.slope_acc                           # forces that move the vehicle
+        forward_acc  = valid_acc - self.slope_acc + self.disturbance_acc    # forces that move the vehicle
         backward_acc = self.friction * self.current_v + actual_braking_acc  # forces that resist the movement
 
         # calc new speed
@@ -226,6 +325,10 @@ class CarModel:
         return {self.pos_sensor_key: self.current_pos, self.speed_sensor_key: self.current_v,
                 self.acc_sensor_key: self.current_acc}
 
+    def get_sensor_names(self):
+        # order of the sensors in noise arrays (see scenario.ScenarioBank)
+        return [self.pos_sensor_key, self.speed_sensor_key, self.acc_sensor_key]
+
     def get_value(self, name):
         """
         Returns current sensor or actuator value, useful for plotting evolution
@@ -257,6 +360,13 @@ class CarModel:
         """
         self.slope_acc = np.sin(np.radians(new_slope)) * self.gravity
 
+    def set_disturbance(self, new_disturbance):
+        """
+        Set an external acceleration (i.e. wind) the car is facing
+        :param new_disturbance: positive -> pushes forward, negative -> backward
+        """
+        self.disturbance_acc = new_disturbance
+
     def __str__(self):
         return 'pos:%.2f v:%.2f acc:%.2f' % (self.current_pos, self.current_v, self.current_acc)
 
@@ -288,7 +398,7 @@ class CarType:
 
 
 def get_car_type(car_name):
-    cars_file = yf.get_yaml_file('cars/cars_definition.yaml')
+    cars_file = yf.get_yaml_file('cars/cars_definition.yaml', copy=False)  # CarType does not change car_spec
     car_spec  = yf.get_record(cars_file, car_name, 'cars', 'car')
     return CarType(car_spec)
 
@@ -307,5 +417,64 @@ def test_lineal_move(acc, until_t, total_t, dt, output_lag, debug):
     return car.current_pos
 
 
+def test_stream_episode(file_name, steps, chunk_size):
+    """
+    Returns True if an episode streamed to disk (in chunks) and counted in chunks (with iter_episode) gives the same
+    values as the ones recorded in memory
+    """
+    import os
+    import tempfile
+    import hierarchical_control as hc
+
+    control   = hc.HierarchicalControl(file_name, 'cars')
+    env       = CarEnvironment1(control, output_lag=2, max_steps=steps)
+    changes   = [[0, 'ref_speed', 5.0], [steps//2, 'ref_speed', 2.0]]
+    directory = os.path.join(tempfile.gettempdir(), 'test_stream_episode')
+    with telemetry.ChunkWriter(directory, chunk_size=chunk_size) as writer:
+        env.run_episode(reference_changes=changes, sink=writer)
+    reader = telemetry.ChunkReader(directory)
+
+    control.reset()
+    chunks = [len(chunk) for chunk in telemetry.chunks(env.iter_episode(reference_changes=changes), chunk_size)]
+    print('   %s chunks written, %s chunks streamed' % (reader.get_chunks_count(), len(chunks)))
+    return np.array_equal(reader.get_channel('speed'), env.recorder.get_channel('speed')) and \
+        np.array_equal(reader.get_channel('t'), env.recorder.get_times()) and sum(chunks) == steps
+
+
+def test_noise(file_name, steps, noise_steps, sensor_name):
+    """
+    Returns [steps run, True if the speed is the same as without noise] of an episode with noise (shorter than the
+    episode) added just to one sensor
+    """
+    import hierarchical_control as hc
+
+    control = hc.HierarchicalControl(file_name, 'cars')
+    env     = CarEnvironment1(control, output_lag=2, max_steps=steps)
+    changes = [[0, 'ref_speed', 5.0]]
+    env.run_episode(reference_changes=changes)
+    speed   = env.recorder.get_channel('speed').copy()
+
+    noise = np.zeros((noise_steps, 3))
+    noise[:, CarModel(get_car_type('simple')).get_sensor_names().index(sensor_name)] = 1.0
+    control.reset()
+    steps_run, _, _ = env.run_episode(reference_changes=changes, noise=noise)
+    return [steps_run, bool(np.array_equal(env.recorder.get_channel('speed'), speed))]
+
+
+def test_reference_event_name(file_name, reference_changes):
+    """
+    Returns True if a scenario with these reference changes ([step, name, value], name can be None) can be run
+    """
+    import hierarchical_control as hc
+
+    env = CarEnvironment1(hc.HierarchicalControl(file_name, 'cars'), max_steps=20)
+    try:
+        env.run_episode(scenario=sc.Scenario([[step, sc.Scenario.k_reference, name, value]
+                                              for [step, name, value] in reference_changes]))
+    except Exception:
+        return False
+    return True
+
+
 if __name__ == "__main__":
     ut.UnitTest(__name__, 'tests/CarModel.test', '')
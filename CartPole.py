@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 import GymEnvironment as GymEnv
 import hierarchical_control
 from ControlUnit import signum
@@ -35,6 +37,18 @@ class BaseGymControl(object):
         self.max_overshoot    = 0.0
         self.current_e        = 0.0
 
+    def reset(self):
+        """
+        Creates the controls again (keeping the current values, i.e. parameters and references) and sets the costs to 0,
+        to start a new episode
+        """
+        self.control.reset(initial_parameters=dict(self.control.get_state()))
+        self.total_error   = 0.0
+        self.avg_error     = 0.0
+        self.steps         = 0
+        self.max_overshoot = 0.0
+        self.current_e     = 0.0
+
     def get_parameters(self):
         return self.control.get_parameters()
 
@@ -125,7 +139,12 @@ class AutoTunePoleAngleControl(at.AutoTuneFunction):
 
 class AutoTuneCartPositionControl(at.AutoTuneFunction):
     def __init__(self, control_def_file_name, max_iter=500, cart_pos_reference=0.0, not_stable_gain=100.0, render=False,
-                 debug=False):
+                 bank=None, debug=False):
+        """
+        :param bank: optional scenario.ScenarioBank, if given each candidate cost is the mean of the episodes started
+                     from all of its initial states and seeds, with its observation noise (the same ones for every
+                     candidate)
+        """
         self.p_name1  = 'kg'
         self.p_name2  = 'ks'
         self.debug    = debug
@@ -136,6 +155,8 @@ class AutoTuneCartPositionControl(at.AutoTuneFunction):
         self.ref      = cart_pos_reference
         self.bad_g    = not_stable_gain
         self.control_def = control_def_file_name
+        self.bank        = bank
+        self.last_costs  = []  # cost in each scenario of the bank in the last call
         self.control     = CartPoleGymControl(self.control_def, initial_parameters=None,
                                               reference_name='ref_final_pos', reference_value=self.ref)
         super(AutoTuneCartPositionControl, self).__init__(changes_threshold=0.01, change=10.0, bad_inc=2.0, mid_inc=1.05)
@@ -146,6 +167,8 @@ class AutoTuneCartPositionControl(at.AutoTuneFunction):
                                                      debug=False)
         self.set_parameters(parameters)
         env      = GymEnv.BaseEnvironment('CartPole-v1', control=self.control, render_mode=None)
+        if self.bank is not None:
+            return self.run_bank_episodes(env)
         steps, _ = env.run_episode(initial_values=[[0, 0.0], [1, 0.0], [2, 0.0], [3, 0.0]], debug=False)
         cost     = self.bad_g*(env.get_max_episode_steps() - steps) + self.control.total_error
         if self.debug:
@@ -153,6 +176,15 @@ class AutoTuneCartPositionControl(at.AutoTuneFunction):
                                                                          cost))
         return cost
 
+    def run_bank_episodes(self, env):
+        self.last_costs = []
+        for i in range(len(self.bank)):
+            self.control.reset()
+            steps, _ = env.run_episode(initial_values=self.bank.get_initial_values(i), seed=self.bank.get_seed(i),
+                                       noise=self.bank.get_noise(i))
+            self.last_costs.append(self.bad_g*(env.get_max_episode_steps() - steps) + self.control.total_error)
+        return sum(self.last_costs)/len(self.last_costs)
+
 
 def run_one_move_cart(car_pos_reference, control_def_name, state, render, max_iter, max_angle=5, debug=False):
     render_mode        = 'human' if render else None
@@ -244,5 +276,36 @@ def test_move_cart(car_pos_reference, max_iter, control_def_name, state, render,
     return steps
 
 
+def test_bank_repeatable(control_def_file_name, scenarios, parameters, sensor_noise):
+    """
+    Returns [True if a candidate evaluated twice with the same scenario bank gets the same costs (gymnasium resets are
+    seeded by the bank), True if the bank noise changes the costs, True if the bank initial states change the costs]
+    """
+    import scenario as sc
+
+    bank      = sc.ScenarioBank.generate(scenarios, 500, seed=7, initial_ranges=[[-0.05, 0.05] for _ in range(4)],
+                                         sensor_noise=sensor_noise, sensors=4)
+    noiseless = sc.ScenarioBank(bank.seeds, bank.initial_states, bank.slopes, np.zeros_like(bank.noise))
+    moved     = sc.ScenarioBank(bank.seeds, bank.initial_states + 0.02, bank.slopes, bank.noise)
+    costs     = []
+    for episodes_bank in [bank, bank, noiseless, moved]:
+        tuner = AutoTuneCartPositionControl(control_def_file_name, cart_pos_reference=1.0, bank=episodes_bank)
+        tuner.run_function_with_parameters(parameters)
+        costs.append(tuner.last_costs)
+    return [costs[0] == costs[1], costs[0] != costs[2], costs[0] != costs[3]]
+
+
+def test_initial_state(initial_values, seed):
+    """
+    Returns the cart position and pole angle of the environment state after the first step of an episode started
+    with initial values (they must be set in the plant, not just in the first observation)
+    """
+    env = GymEnv.BaseEnvironment('CartPole-v1')
+    for _ in env.iter_episode(initial_values=initial_values, seed=seed):
+        break
+    state = env.env.unwrapped.state
+    return [round(float(state[0]), 2), round(float(state[2]), 2)]
+
+
 if __name__ == "__main__":
     ut.UnitTest(__name__, 'tests/CartPole.test', '')
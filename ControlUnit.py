@@ -1,17 +1,44 @@
-import FuzzyControl
+import copy
+import math
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
 import signals as sg
+import yaml_functions as yf
 import auto_tune as at
+import result_cache as rc
+import stability as stb
+import tuning_db as tdb
 import unit_test as ut
 
 
+control_types = {}  # control unit type ('PID', 'PCU', etc.) -> class, see register_control_type
+_prototypes   = {}  # id of a control definition -> [definition copy, state names, state values, prototype]
+_slot_copiers = {}  # class -> function that copies all its slots values from one instance to another
+max_prototypes = 1000
+k_learned_hierarchy = 'hierarchy'  # keys of the files saved by save_learned_states
+k_learned_controls  = 'controls'
+
+
 class GenericControlUnit(object):
     """
     Abstract class to Control Units like PID or PCU
+    Note: control units use __slots__ (many of them are kept in sweeps), subclasses without __slots__ just get a
+          __dict__ as usual
     """
-    type     = None
-    k_type   = 'type'
-    k_dt     = 'dt'
-    k_min_dt = 'min_dt'
+    type         = None
+    k_type       = 'type'
+    k_dt         = 'dt'
+    k_min_dt     = 'min_dt'
+    k_warm_start = 'warm_start'
+
+    # configuration
+    __slots__ = ('control_params', 'key', 'max_change', 'bounds', 'lag', 'dt', 'min_dt', 'min_error', 'debug',
+                 # dynamic values
+                 'o', 'r', 'e', 'p', 'reference_changed')
 
     @staticmethod
     def get_class(control_unit_type):
@@ -20,32 +47,12 @@ class GenericControlUnit(object):
         :param control_unit_type: :type String
         :return:
         """
-        for cls in GenericControlUnit.__subclasses__():
-            if cls.type == control_unit_type:
-                return cls
-            # ToDo: find a way to avoid using get_subclass
-            cls = GenericControlUnit.get_subclass(control_unit_type, cls)
-            if cls is not None:
-                return cls
-
-        return None
-
-    @staticmethod
-    def get_subclass(control_unit_type, super_class):
-        """
-        Given a control_unit_type and a super_class, returns the corresponding class searching down in the hierarchy
-        :param control_unit_type:
-        :param super_class:
-        :return:
-        """
-        for cls in super_class.__subclasses__():
-            if cls.type == control_unit_type:
-                return cls
-            cls = GenericControlUnit.get_subclass(control_unit_type, cls)
-            if cls is not None:
-                return cls
-
-        return None
+        cls = control_types.get(control_unit_type)
+        if cls is None:
+            # maybe it was defined after the last search (ex: in another module)
+            register_subclasses(GenericControlUnit)
+            cls = control_types.get(control_unit_type)
+        return cls
 
     def __init__(self, control_params, dt=0.1, min_dt=0.0001, state=None):
         """
@@ -196,6 +203,32 @@ class GenericControlUnit(object):
         """
         pass
 
+    def clone(self, control_params):
+        """
+        Returns a new controller with the same definition, as if it were just created with control_params
+        Note: it must be called on a controller that was never used (see create_control)
+        :param control_params: definition used by the new controller (it must be equal to the one of this controller)
+        :return:
+        """
+        new_control = object.__new__(self.__class__)  # much faster than copy.copy
+        get_slots_copier(self.__class__)(self, new_control)
+        if hasattr(self, '__dict__'):
+            new_control.__dict__.update(self.__dict__)
+        new_control.control_params = control_params
+        new_control.clone_specific()
+        if new_control.debug:
+            print('%s params: %s' % (new_control.type, new_control.parm_string()))
+        return new_control
+
+    def clone_specific(self):
+        """
+        Abstract method
+        Creates new copies of the values that change while running (lists, histories, etc.) so they are not shared
+        between clones
+        :return: None
+        """
+        pass
+
     def get_parameters(self):
         """
         Abstract method, returns the ControlUnit parameters that can be tuned
@@ -211,6 +244,22 @@ class GenericControlUnit(object):
         """
         return {}
 
+    def get_learned_state(self):
+        """
+        Abstract method, returns what the controller learned while running (i.e. adaptive weights) as a dict of simple
+        values (so it can be saved in a yaml file, see save_learned_states)
+        :return:
+        """
+        return {}
+
+    def set_learned_state(self, learned_state):
+        """
+        Abstract method, continues from what was learned before (see get_learned_state)
+        :param learned_state:
+        :return:
+        """
+        pass
+
     def get_params_as_widgets(self):
         """
         Returns params as a dict used to be display in a WinDeklar form, useful to interactively change param values to
@@ -251,6 +300,11 @@ class PID(GenericControlUnit):
     k_i_length     = 'integrator_length'
     k_i_reset      = 'integrator_reset'
 
+    # configuration
+    __slots__ = ('k_p', 'k_i', 'k_d', 'i_windup', 'integrator_length', 'integrator_reset',
+                 # dynamic values
+                 'first_time', 'integrator', 'integrator_values', 'p_value', 'i_value', 'd_value')
+
     def __init__(self, control_params, state=None, integrator_length=0, integrator_windup=300.0,
                  integrator_reset=False):
         """
@@ -276,7 +330,7 @@ class PID(GenericControlUnit):
         # there are two kind of integrators, the first one is a traditional one (just summing all values)
         # and the second one just take in count the lasts (integrator_length) values
         self.integrator        = 0.0
-        self.integrator_values = sg.SignalHistory(length=self.integrator_length)
+        self.integrator_values = self.new_integrator_values()
 
         self.p_value = 0.0
         self.i_value = 0.0
@@ -311,7 +365,7 @@ class PID(GenericControlUnit):
 
         if self.integrator_reset and self.reference_changed:
             self.integrator = 0.0
-        elif self.integrator_values.get_len() > 1:
+        elif self.integrator_values is not None:
             self.integrator_values.append(value)
             self.integrator = self.integrator_values.sum()
         else:
@@ -323,7 +377,14 @@ class PID(GenericControlUnit):
 
     def reset_specific(self):
         self.integrator        = 0.0
-        self.integrator_values = sg.SignalHistory(length=self.integrator_length)
+        self.integrator_values = self.new_integrator_values()
+
+    def clone_specific(self):
+        self.integrator_values = self.new_integrator_values()
+
+    def new_integrator_values(self):
+        # only needed when integrating the last values (saves memory in the traditional integrator)
+        return sg.SignalHistory(length=self.integrator_length) if self.integrator_length > 0 else None
 
     def get_parameters(self):
         return {self.kp_key: self.k_p, self.ki_key: self.k_i, self.kd_key: self.k_d}
@@ -347,6 +408,11 @@ class IncrementalPID(GenericControlUnit):
     kd_key = 'd'
     k_gains = 'gains'
 
+    # configuration
+    __slots__ = ('k_p', 'k_i', 'k_d',
+                 # dynamic values
+                 'last_e', 'last_last_e', 'first_time', 'p_value', 'i_value', 'd_value')
+
     def __init__(self, control_params, state=None):
         check_mandatory_param(self.k_gains, control_params, self.type)
 
@@ -400,13 +466,15 @@ class P(PID):
     Just a Proportional controller (it is implemented over a PID with just the proportional gain available)
     The only difference with a PID with I and D in 0.0 is the only gain that can be used in twiddle is P
     """
-    type = 'P'
-    k_p  = 'gain'
+    type   = 'P'
+    k_gain = 'gain'
+
+    __slots__ = ()
 
     def __init__(self, control_params, state=None):
-        check_mandatory_param(self.k_p, control_params, self.type)
+        check_mandatory_param(self.k_gain, control_params, self.type)
 
-        kp = get_param(control_params, self.k_p, 1.0, state=state)
+        kp = get_param(control_params, self.k_gain, 1.0, state=state)
         control_params[self.k_gains] = [kp]
         super(P, self).__init__(control_params, state=state)
 
@@ -427,6 +495,8 @@ class PCU(GenericControlUnit):
     k_g  = 'g'
     k_s  = 's'
 
+    __slots__ = ('kg', 'ks')
+
     def __init__(self, control_params, state=None):
         check_mandatory_param(self.k_g, control_params, self.type)
 
@@ -480,6 +550,8 @@ class BangBang(GenericControlUnit):
     above_value_key  = 'above_value'
     hysteresis_key   = 'hysteresis'
 
+    __slots__ = ('bellow_value', 'above_value', 'hysteresis')
+
     def __init__(self, control_params, state=None, bellow_value=1, above_value=0, hysteresis=0.0):
         """
         :param bellow_value:  output when p is bellow reference
@@ -529,6 +601,8 @@ class LinealControlUnit(GenericControlUnit):
     k_gain     = 'gain'
     k_i_bounds = 'input_bounds'
 
+    __slots__ = ('gain', 'input_bounds')
+
     def __init__(self, control_params, state=None):
         self.gain         = control_params.get(self.k_gain, 1.0)
         self.input_bounds = control_params.get(self.k_i_bounds, [])
@@ -560,6 +634,8 @@ class FuzzyController(GenericControlUnit):
     def __init__(self, control_params, def_dir_name='fuzzy_rules', state=None):
         check_mandatory_param(self.k_file_name, control_params, self.type)
 
+        import FuzzyControl  # loads skfuzzy (slow), so only imported when a fuzzy control unit is used
+
         file_name             = control_params[self.k_file_name]
         dir_name              = control_params.get(self.k_dir_name, def_dir_name)
         self.fuzzy_controller = FuzzyControl.FuzzyControl.create_from_file(file_name, directory=dir_name)
@@ -606,10 +682,9 @@ class AdaptiveControlUnit(GenericControlUnit):
 
         super(AdaptiveControlUnit, self).__init__(control_params, state=state)
         self.set_constants()
-        self.past_errors = sg.SignalHistory(length=self.past_length)
-        self.weights     = [0.0 for _ in range(self.past_length+1)]
-        for i, v in enumerate(initial_weights):
-            self.weights[i] = v
+        self.past_errors = sg.create_signal_history(length=self.past_length, array=True)
+        self.weights     = np.zeros(self.past_length+1)
+        self.weights[:len(initial_weights)] = initial_weights
         self.reference_changed = True
 
     def calc_output(self, new_error):
@@ -624,16 +699,27 @@ class AdaptiveControlUnit(GenericControlUnit):
             print('   o:%.3f w_sum:%.3f e:%.3f r:%.3f p:%.3f' % (self.o, weighted_sum, self.e, self.r, self.p))
         return self.o
 
+    def clone_specific(self):
+        self.past_errors = sg.create_signal_history(length=self.past_length, array=True)
+        self.weights     = self.weights.copy()
+
     def adjust_weights(self, new_error):
-        for i, e in enumerate(self.past_errors.get_items_in_lifo_order()):
-            change = self.learning_rate*new_error*e
-            self.weights[i] += change
-            self.weights[i] -= self.weights[i] * self.decay_rate
-            # if self.weights[i] < 0.0:
-            #    self.weights[i] = 0.0
-            if self.debug:
-                print('      i:%s e:%.3f w:%.3f v:%.3f change:%.3f' % (i, e, self.weights[i], self.weights[i]*e,
-                                                                       change))
+        # LMS update of the weights of all the past errors at once (lifo order, so weights[0] is for the last error)
+        errors   = self.past_errors.get_lifo_view()
+        weights  = self.weights[:len(errors)]  # a view, so self.weights is changed
+        weights += self.learning_rate*new_error*errors
+        weights -= weights*self.decay_rate
+        if self.debug:
+            for i, e in enumerate(errors):
+                print('      i:%s e:%.3f w:%.3f v:%.3f change:%.3f' % (i, e, weights[i], weights[i]*e,
+                                                                       self.learning_rate*new_error*e))
+
+    def get_learned_state(self):
+        return {'weights': self.weights.tolist(), 'past_errors': self.past_errors.get_fifo_view().tolist()}
+
+    def set_learned_state(self, learned_state):
+        set_weights(self.weights, learned_state.get('weights', []))
+        self.past_errors.load(learned_state.get('past_errors', []))
 
     def get_parameters(self):
         return {self.k_gain: self.gain, self.k_past_length: self.past_length, self.k_learning_rate: self.learning_rate,
@@ -656,6 +742,165 @@ class AdaptiveControlUnit(GenericControlUnit):
         self.past_length   = self.control_params.get(self.k_past_length, self.past_length)
 
 
+class AdaptiveRLSControlUnit(GenericControlUnit):
+    """
+    Adaptive control (a self-tuning regulator) that learns, by Recursive Least Squares, how the perception changes
+    each cycle given the last outputs:
+        p(t) - p(t-1) = b1*o(t-1) + ... + bn*o(t-n) + c      (n is past_length, c includes the disturbances)
+    and then uses that model to calculate the output that removes a gain fraction of the error in the next cycle
+    Old data is forgotten (forgetting_factor < 1, so it follows changes in the controlled system) and the covariance
+    is reset when it grows too much (i.e. when the output did not change for a long time)
+    """
+
+    type                 = 'AdaptiveRLS'
+    k_gain               = 'gain'
+    k_past_length        = 'past_length'
+    k_forgetting_factor  = 'forgetting_factor'
+    k_initial_covariance = 'initial_covariance'
+    k_max_covariance     = 'max_covariance'
+    k_initial_weights    = 'initial_weights'
+
+    # configuration
+    __slots__ = ('gain', 'past_length', 'forgetting_factor', 'initial_covariance', 'max_covariance',
+                 'initial_weights', 'min_model_gain',
+                 # dynamic values
+                 'weights', 'covariance', 'past_outputs', 'last_p')
+
+    def __init__(self, control_params, state=None, min_model_gain=0.001):
+        """
+        :param min_model_gain: min absolute value of b1 used to calculate the output (to avoid dividing by zero)
+        """
+        self.gain               = get_param(control_params, self.k_gain, 0.5, state=state)
+        self.past_length        = int(get_param(control_params, self.k_past_length, 1, state=state))
+        self.forgetting_factor  = get_param(control_params, self.k_forgetting_factor, 0.98, state=state)
+        self.initial_covariance = get_param(control_params, self.k_initial_covariance, 1000.0, state=state)
+        self.max_covariance     = get_param(control_params, self.k_max_covariance, 1000000.0, state=state)
+        self.initial_weights    = get_param(control_params, self.k_initial_weights, [1.0], state=state)
+        self.min_model_gain     = min_model_gain
+
+        super(AdaptiveRLSControlUnit, self).__init__(control_params, state=state)
+
+    def reset_specific(self):
+        self.weights      = np.zeros(self.past_length+1)  # b1 ... bn, c
+        self.weights[:len(self.initial_weights)] = self.initial_weights
+        self.covariance   = None
+        self.reset_covariance()
+        self.past_outputs = np.zeros(self.past_length)    # o(t-1) ... o(t-n)
+        self.last_p       = None
+
+    def clone_specific(self):
+        self.reset_specific()
+
+    def reset_covariance(self):
+        self.covariance = np.eye(self.past_length+1)*self.initial_covariance
+
+    def calc_output(self, new_error):
+        if self.last_p is not None:
+            self.past_outputs[1:] = self.past_outputs[:-1]
+            self.past_outputs[0]  = self.o  # the output (already bounded) used since the last cycle
+            self.adjust_weights(np.append(self.past_outputs, 1.0), self.p - self.last_p)
+        self.last_p = self.p
+        self.e      = new_error
+
+        # output that makes the model change the perception in gain*error (the last outputs and c are known)
+        b1 = self.weights[0]
+        if 0.0 <= b1 < self.min_model_gain:
+            b1 = self.min_model_gain
+        elif -self.min_model_gain < b1 < 0.0:
+            b1 = -self.min_model_gain
+        known_change = np.dot(self.weights[1:-1], self.past_outputs[:-1]) + self.weights[-1]
+        return float((self.gain*new_error - known_change)/b1)
+
+    def adjust_weights(self, x, y):
+        """
+        Recursive Least Squares update of the weights (and its covariance) given a new observation
+        :param x: inputs (past outputs and 1 for c)
+        :param y: observed change of the perception
+        :return:
+        """
+        px               = self.covariance @ x
+        k                = px/(self.forgetting_factor + x @ px)
+        self.weights    += k*(y - x @ self.weights)
+        self.covariance  = (self.covariance - np.outer(k, px))/self.forgetting_factor
+        if np.trace(self.covariance) > self.max_covariance:
+            self.reset_covariance()
+
+    def get_learned_state(self):
+        # past outputs are not kept, in a new episode they start from 0 again
+        return {'weights': self.weights.tolist(), 'covariance': self.covariance.tolist()}
+
+    def set_learned_state(self, learned_state):
+        set_weights(self.weights, learned_state.get('weights', []))
+        covariance = np.array(learned_state.get('covariance', []), dtype=float)
+        if covariance.shape == self.covariance.shape:
+            self.covariance = covariance
+
+    def get_parameters(self):
+        return {self.k_gain: self.gain, self.k_forgetting_factor: self.forgetting_factor,
+                self.k_past_length: self.past_length}
+
+    def set_parameters(self, parameters):
+        self.gain              = parameters.get(self.k_gain, self.gain)
+        self.forgetting_factor = parameters.get(self.k_forgetting_factor, self.forgetting_factor)
+        past_length            = int(parameters.get(self.k_past_length, self.past_length))
+        if past_length != self.past_length:
+            self.past_length = past_length
+            self.reset_specific()
+
+    def more_info_for_debug(self):
+        return 'b:%s c:%.3f' % (np.round(self.weights[:-1], 3).tolist(), self.weights[-1])
+
+
+class AdaptiveBatch(object):
+    """
+    Many AdaptiveP control units (with the same past_length) run at once: each step the weights of all of them are
+    updated with array operations (i.e. to try many learning rates in parallel)
+    Note: it is just the adaptive part (calc_output of AdaptiveControlUnit), lag, bounds, etc. are not applied
+    """
+
+    def __init__(self, units, gain=1.0, learning_rate=0.01, decay_rate=0.0, past_length=10,
+                 initial_weights=(1.0, 0.0)):
+        """
+        :param units:         number of control units
+        :param gain:          one value for all the units or a list with one value per unit
+        :param learning_rate: one value for all the units or a list with one value per unit
+        :param decay_rate:    one value for all the units or a list with one value per unit
+        :param past_length:
+        :param initial_weights:
+        """
+        self.gain          = values_per_unit(gain, units)
+        self.learning_rate = values_per_unit(learning_rate, units)
+        self.decay_rate    = values_per_unit(decay_rate, units)
+        self.past_errors   = np.zeros((units, past_length+1))  # lifo order, past_errors[:, 0] are the last errors
+        self.size          = 0                                 # number of past errors stored (per unit)
+        self.weights       = np.zeros((units, past_length+1))
+        self.weights[:, :len(initial_weights)] = initial_weights
+        self.o             = np.zeros(units)
+
+    def calc_outputs(self, new_errors):
+        """
+        Same as calling calc_output of each unit with its new error
+        :param new_errors: one per unit
+        :return: the outputs (one per unit)
+        """
+        new_errors = np.asarray(new_errors, dtype=float)
+        self.past_errors[:, 1:] = self.past_errors[:, :-1]
+        self.past_errors[:, 0]  = new_errors
+        self.size               = min(self.size + 1, self.past_errors.shape[1])
+
+        errors   = self.past_errors[:, :self.size]
+        weights  = self.weights[:, :self.size]  # a view, so self.weights is changed
+        weights += (self.learning_rate*new_errors)[:, np.newaxis]*errors
+        weights -= weights*self.decay_rate[:, np.newaxis]
+        self.o   = self.gain*np.einsum('ij,ij->i', weights, errors)
+        return self.o
+
+
+def values_per_unit(value, units):
+    # returns an array with one value per unit given just one value (for all) or a list of them
+    return np.zeros(units) + np.asarray(value, dtype=float)
+
+
 def check_mandatory_param(parameter_key, params, controller_type):
     if parameter_key not in params:
         raise Exception(missing_parameter_msg(parameter_key, controller_type))
@@ -665,15 +910,123 @@ def missing_parameter_msg(parameter_key, controller_type):
     return 'Parameter "%s" must be present for type %s' % (parameter_key, controller_type)
 
 
-def create_control(control_params, state=None):
+def register_control_type(cls, control_unit_type=None):
+    """
+    Makes a control unit class available to create_control (and so to hierarchies definitions), it can be used as a
+    class decorator in plugins
+    :param cls:               subclass of GenericControlUnit
+    :param control_unit_type: name used in definitions, if None cls.type is used
+    :return: cls
+    """
+    control_types[control_unit_type if control_unit_type is not None else cls.type] = cls
+    return cls
+
+
+def register_subclasses(super_class):
+    """
+    Registers all the subclasses of super_class (searching down in the hierarchy) not registered yet
+    :param super_class:
+    :return:
+    """
+    for cls in super_class.__subclasses__():
+        if cls.type is not None and cls.type not in control_types:
+            register_control_type(cls)
+        register_subclasses(cls)
+
+
+def create_control(control_params, state=None, use_prototype=True):
+    """
+    Returns a new control unit as defined in control_params
+    The first time a definition is used a prototype is created, after that the prototype is just cloned (which is
+    much faster than creating the control again, useful because hierarchies create all their controls in every reset)
+    :param control_params: dict with control definition (type, gains, etc.)
+    :param state:          dict with values used in the definition (see get_param)
+    :param use_prototype:  if False the control is always created from scratch
+    :return:
+    Note: if the definition has warm_start (a file saved by save_learned_states) the control continues from what was
+          learned by the control with the same key (name), if the file does not exist it just starts from scratch
+    """
+    control_unit    = create_control_unit(control_params, state=state, use_prototype=use_prototype)
+    warm_start_file = control_params.get(GenericControlUnit.k_warm_start)
+    if warm_start_file:
+        learned_state = load_learned_states(warm_start_file, must_exist=False).get(control_unit.key)
+        if learned_state:
+            control_unit.set_learned_state(learned_state)
+    return control_unit
+
+
+def create_control_unit(control_params, state=None, use_prototype=True):
+    # see create_control
     if GenericControlUnit.k_type not in control_params:
         raise Exception('No type defined for controller %s' % control_params)
+    if use_prototype:
+        prototype = get_prototype(control_params, state)
+        if prototype is not None:
+            return prototype.clone(control_params)
     control_type       = control_params[GenericControlUnit.k_type]
     control_unit_class = GenericControlUnit.get_class(control_type)
     if control_unit_class is None:
         raise Exception('Control type %s is not implemented' % control_type)
     # print('Create %s ' % control_unit_class)
-    return control_unit_class(control_params, state=state)
+    control_unit = control_unit_class(copy.deepcopy(control_params) if use_prototype else control_params, state=state)
+    if use_prototype:
+        if len(_prototypes) >= max_prototypes:
+            _prototypes.clear()
+        state_names = state_names_in_params(control_params, state)
+        _prototypes[id(control_params)] = [copy.deepcopy(control_params), state_names,
+                                           [state[name] for name in state_names], control_unit]
+        return control_unit.clone(control_params)
+    return control_unit
+
+
+def get_slots_copier(cls):
+    """
+    Returns a function copier(source, target) that copies the values of all the slots of a class (including the ones
+    defined in its super classes), it's generated once per class because it is much faster than a loop with setattr
+    """
+    copier = _slot_copiers.get(cls)
+    if copier is None:
+        names = [name for klass in cls.__mro__ for name in klass.__dict__.get('__slots__', ())
+                 if name not in ('__dict__', '__weakref__')]
+        lines = ['def copier(source, target):'] + ['    target.%s = source.%s' % (name, name) for name in names]
+        lines.append('    pass')
+        namespace = {}
+        exec('\n'.join(lines), namespace)
+        copier = _slot_copiers[cls] = namespace['copier']
+    return copier
+
+
+def get_prototype(control_params, state):
+    """
+    Returns the prototype created with control_params and state, or None if there is no one (or it is not valid
+    because the definition or state values were changed)
+    """
+    entry = _prototypes.get(id(control_params))
+    if entry is None:
+        return None
+    params, state_names, state_values, prototype = entry
+    if params != control_params:
+        return None
+    if state is None:
+        return prototype if not state_names else None
+    for i, name in enumerate(state_names):
+        if name not in state or state[name] != state_values[i]:
+            return None
+    return prototype
+
+
+def state_names_in_params(control_params, state):
+    """
+    Returns the state names used in control_params (see get_param)
+    """
+    if state is None:
+        return []
+    names = []
+    for value in control_params.values():
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, str) and item in state and item not in names:
+                names.append(item)
+    return names
 
 
 def widget_from_param(par_name, par_value, default_type='EditNumberSpin'):
@@ -687,7 +1040,13 @@ class AutoTuneControl(at.AutoTuneFunction):
     """
 
     def __init__(self, control, reference=0.0, disturbance=0.0, dt=0.1, max_iter=500, change=1.0, output_lag=0,
-                 overshoot_cost=2.0, overshoot_max_cost=10.0, debug=False):
+                 overshoot_cost=2.0, overshoot_max_cost=10.0, cache=None, prescreen=False, debug=False):
+        """
+        :param cache:     optional result_cache.ResultCache, so episodes already run (even in other sessions) are not
+                          run again
+        :param prescreen: if True the parameters that make the loop unstable (see stability.StabilityScreen) get an
+                          infinite cost without running the episode
+        """
         self.dt            = dt
         self.output_lag    = output_lag
         self.control       = control
@@ -695,7 +1054,11 @@ class AutoTuneControl(at.AutoTuneFunction):
         self.disturbance   = disturbance
         self.over_cost     = overshoot_cost
         self.over_max_cost = overshoot_max_cost
+        self.cache         = cache
+        self.screen        = stb.StabilityScreen(stb.integrator_plant(dt)) if prescreen else None
         self.debug         = debug
+        # taken before any episode is run, since the control state after an episode is not the initial one
+        self.control_digest = rc.object_digest(control) if cache is not None else None
 
         super(AutoTuneControl, self).__init__(max_iter=max_iter, change=change)
 
@@ -705,6 +1068,13 @@ class AutoTuneControl(at.AutoTuneFunction):
     def set_parameters(self, parameters):
         return self.control.set_parameters(parameters)
 
+    def get_context(self):
+        return {tdb.TuningDatabase.k_hierarchy:  tdb.hierarchy_name(self.control.type, self.control.get_parameters()),
+                tdb.TuningDatabase.k_plant:      'step_response',
+                tdb.TuningDatabase.k_output_lag: self.output_lag,
+                tdb.TuningDatabase.k_features:   {'reference': self.reference, 'disturbance': self.disturbance,
+                                                  'steps': self.max_iter*self.dt}}
+
     def run_one_episode(self, parameters):
         self.control.set_parameters(parameters)
         self.control.reset()
@@ -725,12 +1095,31 @@ class AutoTuneControl(at.AutoTuneFunction):
         return error_cost + self.over_cost*overshoot_error + self.over_max_cost*max_overshoot_value
 
     def run_function_with_parameters(self, parameters):
-        cost = self.run_one_episode(parameters)
+        if self.screen is not None:
+            self.control.set_parameters(parameters)
+            if self.screen.is_unstable(self.control):
+                return math.inf
+        key_parts = self.get_cache_key(parameters) if self.cache is not None else None
+        if key_parts is None:
+            cost = self.run_one_episode(parameters)
+        else:
+            cost = self.cache.get_or_run(key_parts, self.run_one_episode, parameters)
         # print('  run, parameters: %s cost: %.2f' % (parameters, cost))
         return cost
 
+    def get_cache_key(self, parameters):
+        """
+        Returns what defines an episode: the control (as it was created, so its definition), the parameters and the
+        step response, None if the control can not be hashed
+        """
+        if self.control_digest is None or self.debug:
+            return None
+        return [type(self).__name__, self.control_digest, parameters, self.reference, self.disturbance, self.dt,
+                self.max_iter, self.over_cost, self.over_max_cost]
+
 
-def step_response_values(r, d, times, dt, debug, control_unit, max_output_change=5.0, control_delta=False):
+def step_response_values(r, d, times, dt, debug, control_unit, max_output_change=5.0, control_delta=False,
+                         scenario=None):
     """
     Very basic model to simulate a system that react to an output force (with disturbance)
     :param control_delta: whether control output directly or it's change
@@ -741,12 +1130,23 @@ def step_response_values(r, d, times, dt, debug, control_unit, max_output_change
     :param debug:
     :param control_unit: controller to use
     :param max_output_change: max change per second the actuator (output) is able to execute
+    :param scenario: optional scenario.Scenario with reference and disturbance changes (r and d are the initial values),
+                     other events (slope, lag) can not be applied to this model so they raise an exception
     :return:
     """
     max_output_change_in_cycle = max_output_change*dt
     current_o = 0.0
     p         = 0.0
+    if scenario is not None:
+        not_applied = sorted(set(scenario.event_types) - {scenario.k_reference, scenario.k_disturbance})
+        if not_applied:
+            raise Exception('Events %s can not be applied to the step response model, just %s and %s' %
+                            (not_applied, scenario.k_reference, scenario.k_disturbance))
+        references   = scenario.get_profile(scenario.k_reference, steps=times, initial=r).tolist()
+        disturbances = scenario.get_profile(scenario.k_disturbance, steps=times, initial=d).tolist()
     for i in range(0, times):
+        if scenario is not None:
+            r, d = references[i], disturbances[i]
         controller_o = control_unit.get_output(r, p)
         if control_delta:
             delta_o    = max(-max_output_change_in_cycle, min(controller_o, max_output_change_in_cycle))
@@ -781,8 +1181,8 @@ class DeConvolution:
         self.learning_rate = learning_rate
         self.max_change    = max_change
         self.decay_rate    = decay_rate
-        self.past_inputs   = sg.SignalHistory(length=self.past_length)
-        self.weights       = [0.0 for _ in range(self.past_length+1)]
+        self.past_inputs   = sg.create_signal_history(length=self.past_length, array=True)
+        self.weights       = np.zeros(self.past_length+1)
 
     def get_output(self, input_value, output_value):
         if self.debug:
@@ -799,17 +1199,87 @@ class DeConvolution:
     def adjust_weights(self, input_value, actual_output_value, estimated_output_value):
         self.past_inputs.append(input_value)
         delta_output_value = actual_output_value - estimated_output_value
-        for i, old_input in enumerate(self.past_inputs.get_items_in_lifo_order()):
-            change = self.learning_rate*delta_output_value*signum(old_input)
-            if abs(change) > self.max_change:
-                change = self.max_change if change >= 0.0 else - self.max_change
+        old_inputs = self.past_inputs.get_lifo_view()
+        changes    = self.learning_rate*delta_output_value*signum_array(old_inputs)
+        changes    = np.clip(changes, -self.max_change, self.max_change)
+        weights    = self.weights[:len(old_inputs)]  # a view, so self.weights is changed
+        weights   += changes
+        weights   *= 1 - self.decay_rate
+        if self.debug:
+            for i, old_input in enumerate(old_inputs):
+                print('      i:%s in:%.3f w:%.3f change:%.3f' % (i, old_input, weights[i], changes[i]))
+
+    def get_learned_state(self):
+        return {'weights': self.weights.tolist(), 'past_inputs': self.past_inputs.get_fifo_view().tolist()}
+
+    def set_learned_state(self, learned_state):
+        set_weights(self.weights, learned_state.get('weights', []))
+        self.past_inputs.load(learned_state.get('past_inputs', []))
+
+    def fit(self, inputs, outputs, regularization=0.0, chunk_size=100000):
+        """
+        Finds the weights in one shot (by least squares) given a recorded history of inputs and outputs, instead of
+        learning them one value at a time with get_output. After it get_output continues from the end of the history
+        :param inputs:         all the inputs (any sequence, i.e. a numpy memmap of a long log)
+        :param outputs:        outputs, one per input
+        :param regularization: ridge factor, > 0 when inputs do not change enough (i.e. constant for a long time)
+        :param chunk_size:     values used at once (long histories are never loaded all in memory)
+        :return: root mean squared error of the fitted weights
+        """
+        fit = LeastSquaresFit(self.past_length+1, regularization=regularization)
+        for start in range(0, len(inputs), chunk_size):
+            fit.add(inputs[start:start+chunk_size], outputs[start:start+chunk_size])
+        self.weights = fit.solve()
+        self.past_inputs.load(inputs[-(self.past_length+1):])
+        return fit.rms_error(self.weights)
 
-            self.weights[i] += change
-            self.weights[i] = self.weights[i]*(1 - self.decay_rate)
-            # if self.weights[i] < 0.0:
-            #    self.weights[i] = 0.0
-            if self.debug:
-                print('      i:%s in:%.3f w:%.3f change:%.3f' % (i, old_input, self.weights[i], change))
+
+class LeastSquaresFit:
+    """
+    Least squares fit of the weights w of a FIR model (as the one of DeConvolution):
+        output(t) = w0*input(t-1) + w1*input(t-2) + ... + wn*input(t-n-1)
+    Data can be added in chunks (so very long histories can be used), just the normal equations are accumulated
+    """
+
+    def __init__(self, length, regularization=0.0):
+        """
+        :param length:         number of weights
+        :param regularization: ridge factor (added to the diagonal of the normal equations)
+        """
+        self.length         = length
+        self.regularization = regularization
+        self.xtx            = np.zeros((length, length))
+        self.xty            = np.zeros(length)
+        self.yty            = 0.0
+        self.last_inputs    = np.zeros(length)  # inputs before the current chunk (0 before the first one)
+        self.count          = 0
+
+    def add(self, inputs, outputs):
+        """
+        Adds a chunk of consecutive inputs and outputs
+        """
+        inputs  = np.asarray(inputs, dtype=float)
+        outputs = np.asarray(outputs, dtype=float)
+        x       = self.design_matrix(inputs)
+        self.xtx   += x.T @ x
+        self.xty   += x.T @ outputs
+        self.yty   += outputs @ outputs
+        self.count += len(outputs)
+        self.last_inputs = np.concatenate([self.last_inputs, inputs])[-self.length:]
+
+    def design_matrix(self, inputs):
+        # Toeplitz matrix, row t has the past inputs of t in lifo order (a view of the inputs, not a copy)
+        previous = np.concatenate([self.last_inputs, inputs[:-1]])
+        return np.lib.stride_tricks.sliding_window_view(previous, self.length)[:, ::-1]
+
+    def solve(self):
+        a = self.xtx + self.regularization*np.eye(self.length)
+        return np.linalg.lstsq(a, self.xty, rcond=None)[0]
+
+    def rms_error(self, weights):
+        # from the normal equations: sum of (y - x.w)^2 = y.y - 2 w.x'y + w.x'x.w
+        squared_error = self.yty - 2.0*weights @ self.xty + weights @ self.xtx @ weights
+        return math.sqrt(max(squared_error, 0.0)/self.count) if self.count > 0 else 0.0
 
 
 def signum(number, min_v=0.000001):
@@ -821,6 +1291,41 @@ def signum(number, min_v=0.000001):
         return 0
 
 
+def set_weights(weights, values):
+    # changes the weights (an array) in place with the given values (a list), the remaining ones are set to 0
+    values = values[:len(weights)]
+    weights[:]            = 0.0
+    weights[:len(values)] = values
+
+
+def save_learned_states(learned_states, file_name, directory='', hierarchy_name=None):
+    """
+    Saves what many control units learned (see get_learned_state) so later they can continue from it (see warm_start
+    in create_control)
+    :param learned_states: dict control name -> learned state
+    :param file_name:
+    :param directory:      '' means this script directory
+    :param hierarchy_name: hierarchy definition file where the controls are defined (just for information)
+    :return: full file name
+    """
+    return yf.save_yaml_file({k_learned_hierarchy: hierarchy_name, k_learned_controls: learned_states}, file_name,
+                             directory=directory)
+
+
+def load_learned_states(file_name, directory='', must_exist=True):
+    """
+    Returns the learned states (control name -> learned state) saved by save_learned_states
+    Note: the dict is shared with other callers (see yaml_functions.get_yaml_file), must not be changed
+    """
+    content = yf.get_yaml_file(file_name, directory=directory, must_exist=must_exist, copy=False)
+    return content.get(k_learned_controls, {}) if content else {}
+
+
+def signum_array(numbers, min_v=0.000001):
+    # signum of all the numbers (an array) at once
+    return (numbers > min_v).astype(float) - (numbers < -min_v)
+
+
 def dict_to_label(values, exclude_keys=(), max_length=80):
     message = ''
     for k, v in values.items():
@@ -882,6 +1387,62 @@ def test_step_response(r, d, times, dt, debug, control_params):
     return p_last
 
 
+def test_prototype(r, d, times, dt, control_params):
+    """
+    A control created from a prototype must behave as one created from scratch, even after the prototype was used
+    """
+    responses = []
+    for use_prototype in [False, True, True]:
+        control_unit = create_control(control_params, use_prototype=use_prototype)
+        responses.append([p for [p, o] in step_response_values(r, d, times, dt, False, control_unit)])
+    return responses[0] == responses[1] == responses[2]
+
+
+def test_create_control_speedup(control_params, times):
+    """
+    Returns how many times faster is to create a control from its prototype than from scratch
+    """
+    elapsed = []
+    for use_prototype in [False, True]:
+        start = time.perf_counter()
+        for _ in range(times):
+            create_control(control_params, use_prototype=use_prototype)
+        elapsed.append(time.perf_counter() - start)
+    return round(elapsed[0]/elapsed[1], 1)
+
+
+def test_slots_memory(control_params, count):
+    """
+    Returns how many times more memory (in bytes per instance) a control unit would use without __slots__
+    """
+    control_unit = create_control(control_params)
+    with_dict    = type('WithDict' + control_unit.__class__.__name__, (control_unit.__class__,), {})
+    sizes        = []
+    for cls in [with_dict, control_unit.__class__]:
+        tracemalloc.start()
+        controls = [cls(control_params) for _ in range(count)]
+        size, _  = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sizes.append(size/len(controls))
+    print('      bytes per instance: %.0f with __dict__, %.0f with __slots__' % (sizes[0], sizes[1]))
+    return round(sizes[0]/sizes[1], 1)
+
+
+def test_slots_update_speed(control_params, times):
+    """
+    Returns how many times faster is update() using __slots__ than using a __dict__
+    """
+    control_unit = create_control(control_params)
+    with_dict    = type('WithDict' + control_unit.__class__.__name__, (control_unit.__class__,), {})
+    elapsed      = []
+    for control in [with_dict(control_params), control_unit]:
+        start = time.perf_counter()
+        for i in range(times):
+            control.get_output(1.0, i*0.0001)
+        elapsed.append(time.perf_counter() - start)
+    return round(elapsed[0]/elapsed[1], 2)
+
+
 def test_deconvolution(function_name, max_iter, learning_rate, decay_rate, max_change, past_length, debug):
     deconvolution = DeConvolution(learning_rate=learning_rate, decay_rate=decay_rate, past_length=past_length,
                                   max_change=max_change, debug=debug)
@@ -893,6 +1454,146 @@ def test_deconvolution(function_name, max_iter, learning_rate, decay_rate, max_c
     return error
 
 
+def test_adaptive_weights(past_length, steps, decay_rate):
+    """
+    Returns True if the (vectorized) AdaptiveP weights are exactly the same as updating them one by one
+    """
+    unit    = create_control({'type': 'AdaptiveP', 'gain': 1.0, 'learning_rate': 0.01, 'decay_rate': decay_rate,
+                              'past_length': past_length})
+    weights = [1.0, 0.0] + [0.0 for _ in range(past_length-1)]
+    errors  = []
+    for step in range(steps):
+        new_error = math.sin(step/7.0)
+        errors.insert(0, new_error)
+        del errors[past_length+1:]
+        for i, e in enumerate(errors):
+            weights[i] += unit.learning_rate*new_error*e
+            weights[i] -= weights[i]*decay_rate
+        unit.calc_output(new_error)
+    return unit.weights.tolist() == weights
+
+
+def test_adaptive_batch(learning_rates, past_length, steps):
+    """
+    Returns True if an AdaptiveBatch gives the same outputs as running each AdaptiveP unit on its own
+    """
+    units  = [create_control({'type': 'AdaptiveP', 'gain': 2.0, 'learning_rate': learning_rate, 'decay_rate': 0.001,
+                              'past_length': past_length}) for learning_rate in learning_rates]
+    batch  = AdaptiveBatch(len(units), gain=2.0, learning_rate=learning_rates, decay_rate=0.001,
+                           past_length=past_length)
+    for step in range(steps):
+        new_errors = [math.sin(step/(5.0 + i)) for i in range(len(units))]
+        outputs    = batch.calc_outputs(new_errors)
+        for unit, new_error, output in zip(units, new_errors, outputs):
+            if not math.isclose(unit.calc_output(new_error), output, rel_tol=1e-9, abs_tol=1e-9):
+                return False
+    return True
+
+
+def test_adaptive_speedup(past_length, units, steps):
+    """
+    Prints how many times faster is calc_output of AdaptiveP (vectorized) than updating the weights one by one, and
+    an AdaptiveBatch than the same number of separate units
+    """
+    unit  = create_control({'type': 'AdaptiveP', 'learning_rate': 0.01, 'past_length': past_length})
+    start = time.perf_counter()
+    for step in range(steps):
+        unit.calc_output(math.sin(step/7.0))
+    unit_time = (time.perf_counter() - start)/steps
+
+    weights, errors = [0.0 for _ in range(past_length+1)], []
+    start = time.perf_counter()
+    for step in range(steps):
+        new_error = math.sin(step/7.0)
+        errors.insert(0, new_error)
+        del errors[past_length+1:]
+        for i, e in enumerate(errors):
+            weights[i] += 0.01*new_error*e
+            weights[i] -= weights[i]*0.0
+        sum(w*e for w, e in zip(weights, errors))
+    loop_time = (time.perf_counter() - start)/steps
+
+    batch = AdaptiveBatch(units, learning_rate=0.01, past_length=past_length)
+    start = time.perf_counter()
+    for step in range(steps):
+        batch.calc_outputs([math.sin(step/7.0)]*units)
+    batch_time = (time.perf_counter() - start)/steps
+    print('   past_length %s: %.1f times faster than a loop, batch of %s units %.1f times faster than each unit' %
+          (past_length, loop_time/unit_time, units, units*unit_time/batch_time))
+
+
+def test_adaptive_convergence(r, d, times, dt, tolerance, control_params):
+    """
+    Returns the number of steps a control unit needs to reach (and keep) an error below tolerance in the step
+    response model (times if never), used to compare AdaptiveRLS with AdaptiveP
+    """
+    control_unit = create_control(control_params)
+    steps        = times
+    for i, (p, o) in enumerate(step_response_values(r, d, times, dt, False, control_unit)):
+        if abs(r - p) >= tolerance:
+            steps = i + 1
+    print('   %s reached error %s in %s steps' % (control_params['type'], tolerance, steps))
+    return steps
+
+
+def test_deconvolution_fit(function_name, times, past_length, regularization, chunk_size):
+    """
+    Returns the error of the DeConvolution output after fitting its weights with a recorded history
+    """
+    inputs, outputs = np.array([call_function(function_name, i) for i in range(times)], dtype=float).T
+    deconvolution   = DeConvolution(past_length=past_length)
+    deconvolution.fit(inputs, outputs, regularization=regularization, chunk_size=chunk_size)
+    actual_input, actual_output = call_function(function_name, times)
+    return actual_output - deconvolution.get_output(actual_input, actual_output)
+
+
+def test_deconvolution_fit_speed(times, past_length, learning_rate):
+    """
+    Prints the time needed to fit the weights of a DeConvolution with a long history (i.e. 10 minutes at 100 Hz) and
+    the rms error, compared with learning them with get_output
+    """
+    random.seed(1)
+    inputs  = np.array([random.uniform(-1.0, 1.0) for _ in range(times)])
+    weights = np.array([0.5**i for i in range(past_length+1)])
+    outputs = np.convolve(np.concatenate([[0.0], inputs[:-1]]), weights)[:times]
+
+    deconvolution = DeConvolution(past_length=past_length)
+    start         = time.perf_counter()
+    rms_error     = deconvolution.fit(inputs, outputs, chunk_size=10000)
+    fit_time      = time.perf_counter() - start
+
+    deconvolution = DeConvolution(learning_rate=learning_rate, past_length=past_length)
+    start         = time.perf_counter()
+    errors        = [output - deconvolution.get_output(i, output) for i, output in zip(inputs, outputs)]
+    learn_time    = time.perf_counter() - start
+    learn_error   = math.sqrt(sum(e*e for e in errors[-1000:])/1000)
+    print('   %s values: fit in %.1f ms (rms error %.2g), learning in %.1f ms (rms error of last 1000 %.2g)' %
+          (times, fit_time*1000, rms_error, learn_time*1000, learn_error))
+
+
+def test_warm_start(r, d, episodes, times, dt, control_params):
+    """
+    Returns the mean absolute error of a short episode (of the step response) starting from scratch and with
+    warm_start after learning in some previous episodes
+    """
+    learned_states = {}
+    for _ in range(episodes):
+        control_unit = create_control(control_params)
+        control_unit.set_learned_state(learned_states.get(control_unit.key, {}))
+        for _ in step_response_values(r, d, times, dt, False, control_unit):
+            pass
+        learned_states[control_unit.key] = control_unit.get_learned_state()
+    file_name = save_learned_states(learned_states, 'test_warm_start.yaml', directory='/tmp')
+
+    errors = []
+    for warm_start in [None, file_name]:
+        params       = dict(control_params, warm_start=warm_start)
+        control_unit = create_control(params)
+        errors.append(sum(abs(r - p) for p, _ in step_response_values(r, d, times, dt, False, control_unit))/times)
+    print('   mean error: %.3f from scratch, %.3f with warm start' % (errors[0], errors[1]))
+    return errors[1] < errors[0]
+
+
 def lineal2(i):
     return i, i*2
 
@@ -905,5 +1606,14 @@ def call_function(func_name, i):
         raise Exception("%s is not implemented" % func_name)
 
 
+def test_import(module_name, watched_modules):
+    """
+    Returns which of the (slow) watched modules are loaded just by importing the given module
+    """
+    elapsed, loaded = ut.get_import_time(module_name, watched_modules)
+    print('   import %s: %.3f secs' % (module_name, elapsed))
+    return loaded
+
+
 if __name__ == "__main__":
     ut.UnitTest(__name__, 'tests/ControlUnit.test', '')
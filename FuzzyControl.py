@@ -2,7 +2,6 @@
 
 import re
 import numpy as np
-import matplotlib.pyplot as plt
 import skfuzzy as fuzz
 from skfuzzy import control as ctrl
 import yaml_functions as yaml
@@ -108,6 +107,8 @@ class FuzzyControl:
         Show the memberships functions of all antecedent and consequent fuzzy variables
         :return:
         """
+        import matplotlib.pyplot as plt
+
         fuzzy_variables = [a for a in self.control.antecedents]
         fuzzy_variables.extend([c for c in self.control.consequents])
         fig, axis = plt.subplots(nrows=len(fuzzy_variables), figsize=(8, 9))
@@ -306,6 +307,8 @@ def view_fuzzy_variable(ax, fuzzy_variable, colors, value=None, set_legend=True)
 
 
 def show_window(axis, name):
+    import matplotlib.pyplot as plt
+
     # Turn off top/right axes
     for ax in axis:
         ax.spines['top'].set_visible(False)
@@ -1,34 +1,85 @@
 import math
 
-import gymnasium as gym
+import numpy as np
+
+import scenario as sc
 
 
 class BaseEnvironment(object):
+    k_observation = 'observation'
+    k_action      = 'action'
+    k_error       = 'error'
+
     def __init__(self, name, control=None, max_episode_steps=500, render_mode=None):
+        import gymnasium as gym  # slow to load, so only imported when an environment is created
+
         self.control = control
         self.env     = gym.make(name, max_episode_steps=max_episode_steps, render_mode=render_mode)
         self.error_history = []
+        self.observation   = None
 
     def get_max_episode_steps(self):
         return self.env.spec.max_episode_steps
 
-    def run_episode(self, initial_values=(), debug=False):
+    def run_episode(self, initial_values=(), debug=False, sink=None, scenario=None, seed=None, noise=None):
+        """
+        :param initial_values: list of [observation index, value] to set at the start
+        :param debug:
+        :param sink:           optional object with record(t, values), i.e. telemetry.ChunkWriter, that receives the
+                               values of every step (see iter_episode)
+        :param scenario:       optional scenario.Scenario (or its file name) with reference changes and disturbances
+                               (the value is added to the state at index name, i.e. a push to the cart)
+        :param seed:           seed used to reset the environment, so its random initial state can be repeated
+        :param noise:          optional array (steps x observation values) added to the observation seen by the
+                               control, i.e. from a scenario.ScenarioBank so every candidate of a tuning sees the same
+                               noise (the recorded values are the actual ones)
+        :return: steps, last observation
+        """
+        self.error_history = []
+        steps = 0
+        for step, values in self.iter_episode(initial_values=initial_values, debug=debug, scenario=scenario,
+                                              seed=seed, noise=noise):
+            if self.control is not None:
+                self.error_history.append([step, values[self.k_error]])
+            if sink is not None:
+                sink.record(step, values)
+            steps += 1
+        return steps, self.observation
+
+    def iter_episode(self, initial_values=(), debug=False, scenario=None, seed=None, noise=None):
+        """
+        Same as run_episode but step by step, yielding the values of each step as soon as they are produced
+        :return: yields (step, values) where values is a dict with the observation (as observation_<index>), the action
+                 and the control error
+        """
         if debug:
             print('   start episode')
 
-        observation, info = self.env.reset()
-        for [i, v] in initial_values:
-            observation[i] = v
+        observation, info = self.env.reset(seed=seed)
+        if initial_values:
+            # set in the environment state (the observation returned by reset is a copy of it)
+            state = np.array(self.env.unwrapped.state, dtype=float)
+            for [i, v] in initial_values:
+                state[i] = v
+            self.env.unwrapped.state = state
+            observation = np.array(state, dtype=observation.dtype)
 
-        self.error_history = []
-        steps = 0
-        ended = False
+        scenario = sc.get_scenario(scenario)
+        steps    = 0
+        ended    = False
         while not ended:
-            action = self.control.get_action(observation, info) if self.control is not None \
+            for [event_type, name, value] in scenario.get_events(steps):
+                self.apply_event(event_type, name, value)
+            seen   = observation if noise is None else observation + noise[min(steps, len(noise) - 1)]
+            action = self.control.get_action(seen, info) if self.control is not None \
                 else self.env.action_space.sample()
             observation, reward, terminated, truncated, info = self.env.step(action)
+            self.observation = observation
+            values = {'%s_%s' % (self.k_observation, i): float(v) for i, v in enumerate(observation)}
+            values[self.k_action] = float(action)
             if self.control is not None:
-                self.error_history.append([steps, self.control.get_last_error()])
+                values[self.k_error] = self.control.get_last_error()
+            yield steps, values
             steps += 1
             ended = terminated or truncated
             if debug:
@@ -38,7 +89,18 @@ class BaseEnvironment(object):
                        math.degrees(self.control.get_last_error())))
                 if terminated:
                     print('    terminated at step %s' % steps)
-        return steps, observation
+
+    def apply_event(self, event_type, name, value):
+        if event_type == sc.Scenario.k_reference and name is None:
+            self.control.set_reference(value)
+        elif event_type == sc.Scenario.k_reference:
+            self.control.set_reference(name, value)
+        elif event_type == sc.Scenario.k_disturbance:
+            state = np.array(self.env.unwrapped.state, dtype=float)
+            state[int(name)] += value
+            self.env.unwrapped.state = state
+        else:
+            raise Exception('Scenario event "%s" not valid for %s' % (event_type, self.env.spec.id))
 
     def run_episodes(self, max_number_of_episodes=500, debug=False):
         for _ in range(max_number_of_episodes):
@@ -96,6 +96,105 @@ def twiddle(function_object, threshold=0.1, change=10.0, max_iterations=1000, go
     return best_err, best_p, j
 
 
+class TwiddleTuner:
+    """
+    Ask/tell version of twiddle: instead of calling the function, it asks for the parameters to evaluate and is told
+    their costs, so they can be evaluated elsewhere (i.e. by workers in other nodes, see work_queue.QueueExecutor)
+        tuner = TwiddleTuner(function_object)
+        while not tuner.is_done():
+            candidates = tuner.ask()
+            tuner.tell([cost_of(parameters) for parameters in candidates])
+    Without speculation it tries the same parameters than twiddle (so it gives the same result), with speculation the
+    change in the opposite direction is asked together with the first one, so two candidates are evaluated in parallel
+    (at the cost of evaluating it also when not needed)
+    """
+
+    def __init__(self, function_object, threshold=0.1, change=10.0, max_iterations=1000, good_inc=1.1, bad_inc=2.0,
+                 mid_inc=1.05, dec_inc=0.95, speculative=False):
+        """
+        :param function_object: AutoTuneFunction, just its initial parameters, is_better and is_best are used
+        :param speculative:     if True the changes in both directions are asked at once
+        the rest of parameters are the same as in twiddle
+        """
+        self.function_object = function_object
+        self.threshold       = threshold
+        self.change          = change
+        self.max_iterations  = max_iterations
+        self.good_inc        = good_inc
+        self.bad_inc         = bad_inc
+        self.mid_inc         = mid_inc
+        self.dec_inc         = dec_inc
+        self.speculative     = speculative
+        self.best_cost       = None
+        self.best_parameters = None
+        self.iteration       = 0
+        self.evaluations     = 0
+        self.search          = self.search_steps()
+        self.candidates      = next(self.search)
+
+    def ask(self):
+        """
+        Returns the list of parameters to evaluate (the same ones until their costs are told), empty when it is done
+        """
+        return [dict(parameters) for parameters in self.candidates]
+
+    def tell(self, costs):
+        """
+        :param costs: cost of each one of the parameters given by ask
+        """
+        if len(costs) != len(self.candidates):
+            raise Exception('%s costs told but %s parameters asked' % (len(costs), len(self.candidates)))
+        self.evaluations += len(costs)
+        try:
+            self.candidates = self.search.send(list(costs))
+        except StopIteration:
+            self.candidates = []
+
+    def is_done(self):
+        return len(self.candidates) == 0
+
+    def result(self):
+        """
+        Returns best cost, best parameters and iterations, as twiddle
+        """
+        return self.best_cost, self.best_parameters, self.iteration
+
+    def search_steps(self):
+        # twiddle as a generator: yields the parameters to evaluate and receives their costs
+        f  = self.function_object
+        p  = f.get_parameters()
+        dp = {k: self.change for k in p}
+
+        [self.best_cost] = yield [dict(p)]
+        self.best_parameters = dict(p)
+
+        for self.iteration in range(0, self.max_iterations):
+            if dict_sum(dp) <= self.threshold or f.is_best(self.best_cost):
+                break
+
+            for k in p:
+                p[k] += dp[k]
+                other     = dict(p, **{k: p[k] - self.bad_inc*dp[k]})
+                candidate = dict(p)
+                if self.speculative:
+                    [cost, other_cost] = yield [candidate, other]
+                else:
+                    [cost] = yield [candidate]
+                if f.is_better(cost, self.best_cost):
+                    self.best_cost, self.best_parameters = cost, candidate
+                    dp[k] *= self.good_inc
+                    continue
+                p[k] -= self.bad_inc*dp[k]
+                if not self.speculative:
+                    [other_cost] = yield [other]
+                if f.is_better(other_cost, self.best_cost):
+                    self.best_cost, self.best_parameters = other_cost, other
+                    dp[k] *= self.mid_inc
+                else:
+                    p[k]  += dp[k]
+                    dp[k] *= self.dec_inc
+
+
 class AutoTuneFunction(object):
     """
     Wrapper class to tune the parameters of a given function according to a certain cost function
@@ -114,11 +213,33 @@ class AutoTuneFunction(object):
         self.bad_inc   = bad_inc
         self.change    = change
         self.threshold = changes_threshold
-        self.max_iter  = max_iter
-        self.total_i   = 0  # number of calls to run_function_with_parameters
+        self.max_iter   = max_iter
+        self.total_i    = 0     # number of calls to run_function_with_parameters
+        self.last_cost  = None  # best cost and tries of the last auto_tune
+        self.last_tries = None
 
-    def auto_tune(self, debug=False):
-        best_error, best_p, steps = self.auto_tune_with_twiddle()
+    def auto_tune(self, debug=False, database=None):
+        """
+        :param debug:
+        :param database: optional tuning_db.TuningDatabase, if given (and get_context is implemented) the tuning starts
+                         from the best parameters of the most similar past tunings, with smaller changes, and its
+                         result is saved there
+        :return: best parameters
+        """
+        context = self.get_context() if database is not None else None
+        change  = self.change
+        if context is not None:
+            parameters, self.change = database.get_start(context, self.get_parameters(), change)
+            self.set_parameters(parameters)
+            if debug:
+                print('   start parameters:%s change:%.3f' % (parameters, self.change))
+        try:
+            best_error, best_p, steps = self.auto_tune_with_twiddle()
+        finally:
+            self.change = change
+        self.last_cost, self.last_tries = best_error, steps
+        if context is not None:
+            database.add(context, best_p, best_error, steps)
         if debug:
             print('   best cost:%.3f parameters:%s tries:%s' % (best_error, best_p, steps))
         return best_p
@@ -126,9 +247,35 @@ class AutoTuneFunction(object):
     def auto_tune_with_twiddle(self):
         return twiddle(self, threshold=self.threshold, change=self.change, bad_inc=self.bad_inc, mid_inc=self.mid_inc)
 
+    def auto_tune_with_executor(self, executor, speculative=False, debug=False):
+        """
+        Same as auto_tune but the parameters are evaluated by an executor (i.e. work_queue.QueueExecutor), so they can
+        be run in other processes or nodes
+        :param executor:    object with map(function_object, parameters_list) that returns the list of costs
+        :param speculative: see TwiddleTuner
+        :param debug:
+        :return: best parameters
+        """
+        tuner = TwiddleTuner(self, threshold=self.threshold, change=self.change, bad_inc=self.bad_inc,
+                             mid_inc=self.mid_inc, speculative=speculative)
+        while not tuner.is_done():
+            tuner.tell(executor.map(self, tuner.ask()))
+        best_error, best_p, steps       = tuner.result()
+        self.last_cost, self.last_tries = best_error, steps
+        if debug:
+            print('   best cost:%.3f parameters:%s tries:%s evaluations:%s' % (best_error, best_p, steps,
+                                                                             tuner.evaluations))
+        return best_p
+
     def get_parameters(self):
         return {}
 
+    def get_context(self):
+        """
+        Returns what defines this tuning (see tuning_db.TuningDatabase), None means it is not saved nor warm started
+        """
+        return None
+
     def set_parameters(self, new_parameters):
         pass
 
@@ -0,0 +1,361 @@
+import time
+
+import numpy as np
+
+import ControlUnit as cu
+import CarModel as cm
+import hierarchical_control as hc
+import stability as stb
+import unit_test as ut
+
+# transfer functions are [numerator, denominator] as in stability.py, but for many parameter sets at once: arrays
+# (sets x coefficients of z^0, z^-1, z^-2, ...)
+
+k_gain_margin     = 'gain_margin'      # dB, inf if the phase never reaches -180 (nan if the open loop is unstable or
+                                       # there is no feedback, i.e. a Lineal unit closing the loop)
+k_phase_margin    = 'phase_margin'     # degrees, inf if the gain is always below 1, nan if always above
+k_gain_crossover  = 'gain_crossover'   # rad/s where the gain is 1
+k_phase_crossover = 'phase_crossover'  # rad/s where the phase is -180
+
+
+def frequencies(dt, points=200, decades=3.0):
+    """
+    Returns a logarithmic grid of frequencies (rad/s) up to the Nyquist one (pi/dt)
+    """
+    nyquist = np.pi/dt
+    return np.logspace(np.log10(nyquist) - decades, np.log10(nyquist), points)
+
+
+def parameter_grid(**values):
+    """
+    Returns all the combinations of the given values as dict name -> array (i.e. p=[1, 2], i=[0, 0.5] gives 4 sets)
+    """
+    names = list(values)
+    grids = np.meshgrid(*[np.asarray(values[name], dtype=float) for name in names], indexing='ij')
+    return {name: grid.ravel() for name, grid in zip(names, grids)}
+
+
+def unit_transfer_function(control, parameters=None):
+    """
+    Returns the transfer function of a control unit, from its error to its output, for the parameter sets given (see
+    stability.linear_transfer_function, bounds and max_change are ignored as for small signals)
+    :param control:    ControlUnit.GenericControlUnit (P, PID, IncrementalPID, PCU or Lineal)
+    :param parameters: dict name (as in control.get_parameters) -> array of values, the ones not given are the ones
+                       of the control
+    """
+    transfer_function = stb.linear_transfer_function(control, parameters)
+    if transfer_function is None:
+        raise Exception('Frequency response of "%s" control units not known' % control.type)
+    return transfer_function
+
+
+def reference_transfer_function(control, parameters=None):
+    """
+    Returns the transfer function of a control unit from its reference to its output (see unit_transfer_function):
+    the same as from its error but for Lineal units, whose output is just their reference times their gain
+    """
+    if control.type == 'Lineal':
+        parameters = parameters if parameters is not None else {}
+        gain       = np.asarray(parameters.get(control.k_gain, control.gain), dtype=float).reshape(-1, 1)
+        return [gain, np.ones((len(gain), 1))]
+    return unit_transfer_function(control, parameters)
+
+
+def multiply(transfer_function1, transfer_function2):
+    """
+    Returns the transfer function of two in series (sets are broadcast)
+    """
+    return [multiply_polynomials(transfer_function1[0], transfer_function2[0]),
+            multiply_polynomials(transfer_function1[1], transfer_function2[1])]
+
+
+def multiply_polynomials(polynomials1, polynomials2):
+    polynomials1 = np.atleast_2d(polynomials1)
+    polynomials2 = np.atleast_2d(polynomials2)
+    sets         = max(len(polynomials1), len(polynomials2))
+    result       = np.zeros((sets, polynomials1.shape[1] + polynomials2.shape[1] - 1))
+    for i in range(polynomials1.shape[1]):
+        result[:, i:i + polynomials2.shape[1]] += polynomials1[:, i:i + 1]*polynomials2
+    return result
+
+
+def delay(steps):
+    return [np.eye(1, steps + 1, steps), np.ones((1, 1))]
+
+
+def get_plant(plant_name, dt=0.1, output_lag=0, friction=0.1, max_pedal_value=100):
+    """
+    Returns the transfer function of a plant, from the control output to the perception (after output_lag steps):
+        'integrator': ControlUnit.simple_change_model
+        a car name:   speed of CarModel.CarModel moving forward, from the accelerator pedal
+    """
+    if plant_name == 'integrator':
+        plant = stb.integrator_plant(dt)
+    else:
+        car_type = cm.get_car_type(plant_name)
+        plant    = stb.first_order_plant(1.0 - friction*dt, dt*car_type.max_acc/max_pedal_value)
+    return multiply(plant, delay(output_lag))
+
+
+def response(transfer_function, w, dt):
+    """
+    Returns the frequency response (complex, sets x frequencies) of a transfer function at the frequencies w (rad/s)
+    """
+    z_inverse = np.exp(-1j*np.asarray(w, dtype=float)*dt)
+    return evaluate(transfer_function[0], z_inverse)/evaluate(transfer_function[1], z_inverse)
+
+
+def evaluate(polynomials, z_inverse):
+    polynomials = np.atleast_2d(polynomials)
+    return polynomials @ np.power.outer(z_inverse, np.arange(polynomials.shape[1])).T
+
+
+def evaluate_rows(transfer_function, w, dt):
+    # response of each set at its own frequency
+    z_inverse = np.exp(-1j*w*dt).reshape(-1, 1)
+    powers    = [z_inverse**np.arange(np.shape(polynomials)[1]) for polynomials in transfer_function]
+    return np.sum(np.atleast_2d(transfer_function[0])*powers[0], axis=1) / \
+        np.sum(np.atleast_2d(transfer_function[1])*powers[1], axis=1)
+
+
+def bode(transfer_function, w, dt):
+    """
+    Returns [magnitude (dB), phase (degrees, unwrapped)], both arrays sets x frequencies
+    """
+    values = response(transfer_function, w, dt)
+    return [20*np.log10(np.abs(values)), np.degrees(np.unwrap(np.angle(values), axis=-1))]
+
+
+def margins(open_loop, w, dt, iterations=20):
+    """
+    Returns the gain and phase margins of loops (see k_gain_margin...), given their open loop transfer function, as
+    dict name -> array (one value per set)
+    The first crossing in the frequency grid is refined by bisection
+    """
+    values    = response(open_loop, w, dt)
+    unstable  = unstable_poles(open_loop[1], len(values))
+    magnitude = np.abs(values)
+    phase     = np.degrees(np.unwrap(np.angle(values), axis=-1))
+    sets      = len(values)
+    rows      = np.arange(sets)
+    result    = {k_gain_margin: np.full(sets, np.inf), k_phase_margin: np.full(sets, np.inf),
+                 k_gain_crossover: np.full(sets, np.nan), k_phase_crossover: np.full(sets, np.nan)}
+    w         = np.asarray(w, dtype=float)
+
+    # gain crossover: |L| from >= 1 to < 1
+    crossing = (magnitude[:, :-1] >= 1.0) & (magnitude[:, 1:] < 1.0)
+    found    = np.any(crossing, axis=1)
+    result[k_phase_margin][~found & (magnitude[:, -1] >= 1.0)] = np.nan
+    if np.any(found):
+        i         = np.argmax(crossing, axis=1)[found]
+        loop      = [np.atleast_2d(polynomials)[found] if len(np.atleast_2d(polynomials)) == sets else polynomials
+                     for polynomials in open_loop]
+        crossover = bisect(lambda x: np.abs(evaluate_rows(loop, x, dt)) - 1.0, w[i], w[i + 1], iterations)
+        angle     = phase[rows[found], i] + np.degrees(np.angle(evaluate_rows(loop, crossover, dt) /
+                                                                 values[rows[found], i]))
+        result[k_gain_crossover][found] = crossover
+        result[k_phase_margin][found]   = (angle + 360.0) % 360.0 - 180.0
+
+    # phase crossover: phase from > -180 to <= -180
+    crossing = (phase[:, :-1] > -180.0) & (phase[:, 1:] <= -180.0 + 1e-6)
+    found    = np.any(crossing, axis=1)
+    if np.any(found):
+        i         = np.argmax(crossing, axis=1)[found]
+        loop      = [np.atleast_2d(polynomials)[found] if len(np.atleast_2d(polynomials)) == sets else polynomials
+                     for polynomials in open_loop]
+        start     = values[rows[found], i]
+        first     = phase[rows[found], i]
+        crossover = bisect(lambda x: first + np.degrees(np.angle(evaluate_rows(loop, x, dt)/start)) + 180.0,
+                           w[i], w[i + 1], iterations, tolerance=1e-6)
+        result[k_phase_crossover][found] = crossover
+        result[k_gain_margin][found]     = -20*np.log10(np.abs(evaluate_rows(loop, crossover, dt)))
+    no_feedback = np.broadcast_to(~np.any(np.atleast_2d(open_loop[0]) != 0.0, axis=1), (sets,))
+    for name in [k_gain_margin, k_phase_margin]:
+        result[name][unstable | no_feedback] = np.nan
+    return result
+
+
+def unstable_poles(denominators, sets, tolerance=1e-9):
+    """
+    Returns True for each set with poles outside the unit circle (its margins do not tell if the loop is stable)
+    """
+    denominators = np.atleast_2d(denominators)
+    if denominators.shape[1] < 2:
+        return np.zeros(sets, dtype=bool)
+    # poles are the eigenvalues of the companion matrices (all the sets at once)
+    order          = denominators.shape[1] - 1
+    companion      = np.zeros((len(denominators), order, order))
+    companion[:, 0, :]             = -denominators[:, 1:]/denominators[:, :1]
+    companion[:, 1:, :-1]          = np.eye(order - 1)
+    unstable       = np.any(np.abs(np.linalg.eigvals(companion)) > 1.0 + tolerance, axis=1)
+    return np.broadcast_to(unstable, (sets,)) if len(unstable) == 1 else unstable
+
+
+def bisect(function, low, high, iterations, tolerance=0.0):
+    """
+    Returns, for each row, the x in [low, high] where function changes from positive to <= tolerance
+    """
+    for _ in range(iterations):
+        middle = (low + high)/2
+        above  = function(middle) > tolerance
+        low    = np.where(above, middle, low)
+        high   = np.where(above, high, middle)
+    return (low + high)/2
+
+
+def loop_transfer_function(control, plant, parameters=None):
+    """
+    Returns the open loop transfer function of a control unit with a plant (including the lag of the control, see
+    stability.perception_filter)
+    """
+    return multiply(multiply(unit_transfer_function(control, parameters), stb.perception_filter(control)), plant)
+
+
+def screen(control, plant, parameters, dt=None, points=200, min_gain_margin=6.0, min_phase_margin=30.0):
+    """
+    Returns [margins, True for each parameter set with enough margins] of a control unit with a plant, many
+    parameter sets at once (see parameter_grid), so the ones not robust (or unstable) can be discarded before
+    simulating them
+    """
+    dt     = dt if dt is not None else control.dt
+    result = margins(loop_transfer_function(control, plant, parameters), frequencies(dt, points), dt)
+    return [result, (result[k_gain_margin] >= min_gain_margin) & (result[k_phase_margin] >= min_phase_margin)]
+
+
+def hierarchy_chain(control, first=None):
+    """
+    Returns the control units (hierarchical_control.ControlUnit) in series from first (its name, None means the
+    first one of the hierarchy): each one is followed by the next one with its output as reference
+    Note: inner loops (i.e. the sensor of an inner control) are not taken in count, just the units in series
+    :param control: hierarchical_control.HierarchicalControl
+    """
+    units = control._controls
+    unit  = units[0] if first is None else next((unit for unit in units if unit.control.key == first), None)
+    if unit is None:
+        raise Exception('Control "%s" not in hierarchy %s' % (first, control.file_name))
+    chain = [unit]
+    while True:
+        unit = next((unit for unit in units if unit.reference_name == chain[-1].output_name and unit not in chain),
+                    None)
+        if unit is None:
+            return chain
+        chain.append(unit)
+
+
+def unit_parameters(unit, parameters):
+    """
+    Returns the parameters of a control unit (as in get_parameters) given the ones of its hierarchy (the names used
+    in its definition, i.e. gains: [k_p, 0.0, 0.0] with {k_p: [1, 2]} gives {p: [1, 2]})
+    """
+    definition = unit.control.control_params
+    if unit.control.type == 'P':
+        names = {definition.get(cu.P.k_gain): cu.PID.kp_key}
+    elif cu.PID.k_gains in definition:
+        names = dict(zip(definition[cu.PID.k_gains], [cu.PID.kp_key, cu.PID.ki_key, cu.PID.kd_key]))
+    else:
+        names = {definition[name]: name for name in unit.control.get_parameters() if
+                 isinstance(definition.get(name), str)}
+    return {names[name]: value for name, value in parameters.items() if isinstance(name, str) and name in names}
+
+
+def chain_transfer_function(chain, parameters=None):
+    """
+    Returns the transfer function of control units in series (see hierarchy_chain), from the error of the first one
+    (that closes the loop) to the output of the last one (the others get the output of the previous one as reference)
+    :param parameters: dict hierarchy parameter name -> array of values
+    """
+    parameters        = parameters if parameters is not None else {}
+    transfer_function = unit_transfer_function(chain[0].control, unit_parameters(chain[0], parameters))
+    for unit in chain[1:]:
+        transfer_function = multiply(transfer_function,
+                                     reference_transfer_function(unit.control, unit_parameters(unit, parameters)))
+    return transfer_function
+
+
+def hierarchy_screen(file_name, dir_name, plant, parameters, first=None, dt=0.1, points=200, min_gain_margin=6.0,
+                     min_phase_margin=30.0):
+    """
+    Same as screen for the series chain of a hierarchy (see hierarchy_chain), with the lag of its first unit
+    """
+    chain  = hierarchy_chain(hc.HierarchicalControl(file_name, dir_name), first)
+    loop   = multiply(multiply(chain_transfer_function(chain, parameters), stb.perception_filter(chain[0].control)),
+                      plant)
+    result = margins(loop, frequencies(dt, points), dt)
+    return [result, (result[k_gain_margin] >= min_gain_margin) & (result[k_phase_margin] >= min_phase_margin)]
+
+
+# tests
+def test_margins(control_params, plant_name, dt, output_lag):
+    """
+    Returns [gain margin, phase margin] of a control unit with a plant
+    """
+    control = cu.create_control(control_params)
+    plant   = get_plant(plant_name, dt, output_lag)
+    result  = margins(loop_transfer_function(control, plant), frequencies(dt, 500), dt)
+    return [round(float(result[k_gain_margin][0]), 2), round(float(result[k_phase_margin][0]), 2)]
+
+
+def test_bode(control_params, plant_name, dt, output_lag):
+    """
+    Returns [magnitude (dB), phase] of the open loop at the lowest and the Nyquist frequencies
+    """
+    control = cu.create_control(control_params)
+    w       = frequencies(dt, 3)
+    [magnitude, phase] = bode(loop_transfer_function(control, get_plant(plant_name, dt, output_lag)), w, dt)
+    return [round(float(magnitude[0, 0]), 2), round(float(phase[0, 0]), 2), round(float(magnitude[0, -1]), 2),
+            round(float(phase[0, -1]), 2)]
+
+
+def test_no_feedback(control_params, plant_name, dt):
+    """
+    Returns [True if the margins are nan, True if screened as valid] of a control unit whose output does not depend
+    on the perception (i.e. Lineal)
+    """
+    control         = cu.create_control(control_params)
+    [result, valid] = screen(control, get_plant(plant_name, dt), {}, dt=dt)
+    return [bool(np.isnan(result[k_gain_margin][0]) and np.isnan(result[k_phase_margin][0])), bool(valid[0])]
+
+
+def test_agrees_with_stability(control_params, plant_name, dt, grid):
+    """
+    Returns the ratio of parameter sets where positive margins (not nan) means a stable loop (see stability.py)
+    """
+    control    = cu.create_control(control_params)
+    plant      = get_plant(plant_name, dt)
+    parameters = parameter_grid(**grid)
+    [result, _] = screen(control, plant, parameters, dt=dt, points=500)
+    positive   = (result[k_gain_margin] > 0.0) & (result[k_phase_margin] > 0.0)
+    screen_one = stb.StabilityScreen([polynomials[0] for polynomials in plant])
+    agree      = 0
+    for i in range(len(positive)):
+        control.set_parameters({name: float(values[i]) for name, values in parameters.items()})
+        agree += positive[i] == (screen_one.classify(control) == stb.StabilityScreen.k_stable)
+    return round(agree/len(positive), 3)
+
+
+def test_screen_speed(control_params, plant_name, dt, grid, min_sets_per_second):
+    """
+    Returns True if the parameter sets are screened faster than min_sets_per_second
+    """
+    control    = cu.create_control(control_params)
+    parameters = parameter_grid(**grid)
+    start      = time.perf_counter()
+    [_, valid] = screen(control, get_plant(plant_name, dt), parameters, dt=dt)
+    elapsed    = time.perf_counter() - start
+    sets       = len(valid)
+    print('      %s sets in %.1f ms (%s valid)' % (sets, elapsed*1000, int(np.sum(valid))))
+    return sets/elapsed >= min_sets_per_second
+
+
+def test_hierarchy(file_name, dir_name, plant_name, output_lag, grid):
+    """
+    Returns the number of parameter sets of the hierarchy chain with enough margins
+    """
+    dt          = 0.1
+    [_, valid]  = hierarchy_screen(file_name, dir_name, get_plant(plant_name, dt, output_lag),
+                                   parameter_grid(**grid), dt=dt)
+    return int(np.sum(valid))
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/frequency_response.test', '')
@@ -1,6 +1,7 @@
 import auto_tune
 import yaml_functions as yaml
-from ControlUnit import signum, create_control
+import hierarchy_compiler
+from ControlUnit import signum, create_control, save_learned_states, load_learned_states
 import unit_test as ut
 
 
@@ -36,18 +37,29 @@ class HierarchicalControl:
     k_autotune   = 'autotune'
     k_type       = 'type'
 
-    def __init__(self, file_name, dir_name, initial_parameters=None):
+    def __init__(self, file_name, dir_name, initial_parameters=None, compiled=False):
+        """
+        :param file_name:          YAML file with the hierarchy definition
+        :param dir_name:
+        :param initial_parameters: dict with values that replace the ones in the definition
+        :param compiled:           if True all the controls are run by a generated step function (see
+                                   hierarchy_compiler), much faster but controls' debug info is not printed
+        """
 
         # to avoid warnings
         self.total_error      = 0.0
         self._state           = {}   # keeps all values
         self._controls        = []
+        self._step            = None  # compiled step, if any
         self.initial_err_sign = 0
         self.max_overshoot    = 0.0
         self.current_e        = 0.0
 
-        self.hc_def = yaml.get_yaml_file(file_name, directory=dir_name)
+        self.compiled  = compiled
+        self.file_name = file_name
+        self.hc_def    = yaml.get_yaml_file(file_name, directory=dir_name)
 
+        self.sensor_names    = get_item_names(self.k_name, self.k_sensors, self.k_sensor, self.hc_def)
         self.actuator_names  = get_item_names(self.k_name, self.k_actuators, self.k_actuator, self.hc_def)
         self.parm_names      = get_item_names(self.k_name, self.k_parameters, self.k_parameter, self.hc_def)
         self.reference_names = get_item_names(self.k_name, self.k_references, self.k_reference, self.hc_def)
@@ -57,7 +69,13 @@ class HierarchicalControl:
 
         self.reset(initial_parameters=initial_parameters)
 
-    def reset(self, initial_parameters=None):
+    def reset(self, initial_parameters=None, keep_learned=False):
+        """
+        :param initial_parameters: dict with values that replace the ones in the definition
+        :param keep_learned:       if True the new controls continue from what the current ones learned (i.e. adaptive
+                                   weights), useful to evaluate short episodes without learning again each time
+        """
+        learned_states = self.get_learned_states() if keep_learned else {}
         self._state = {}
         for [group, item] in [[self.k_references, self.k_reference], [self.k_sensors, self.k_sensor],
                               [self.k_actuators, self.k_actuator], [self.k_parameters, self.k_parameter]]:
@@ -65,10 +83,41 @@ class HierarchicalControl:
         if initial_parameters is not None:
             self._state.update(initial_parameters)
         self.create_controls()  # must go after init_state to property init controllers
+        self.set_learned_states(learned_states)
 
     def create_controls(self):
+        key = hierarchy_compiler.definition_hash(self.hc_def, self._state) if self.compiled else None
         self._controls = [ControlUnit(control_def, self._state) for control_def in
                           get_item_def(self.k_controls, self.k_control, self.hc_def)]
+        self._step = hierarchy_compiler.compile_step(self._controls, actuator_names=self.actuator_names, key=key) \
+            if self.compiled else None
+
+    def get_learned_states(self):
+        """
+        Returns what the controls learned while running (control name -> learned state), just the ones that learn
+        """
+        learned_states = {}
+        for control in self._controls:
+            learned_state = control.control.get_learned_state()
+            if learned_state:
+                learned_states[control.control.key] = learned_state
+        return learned_states
+
+    def set_learned_states(self, learned_states):
+        for control in self._controls:
+            if control.control.key in learned_states:
+                control.control.set_learned_state(learned_states[control.control.key])
+
+    def save_learned_states(self, file_name, directory=''):
+        """
+        Saves what the controls learned, it can be loaded with load_learned_states or used as warm_start in a control
+        definition
+        """
+        return save_learned_states(self.get_learned_states(), file_name, directory=directory,
+                                   hierarchy_name=self.file_name)
+
+    def load_learned_states(self, file_name, directory='', must_exist=True):
+        self.set_learned_states(load_learned_states(file_name, directory=directory, must_exist=must_exist))
 
     def update_state_with_definition(self, group_name, item_name, definition):
         for item in get_item_def(group_name, item_name, definition):
@@ -80,6 +129,13 @@ class HierarchicalControl:
     def get_value(self, name):
         return self._state[name]
 
+    def get_state(self):
+        """
+        Returns all the current values (references, sensors, actuators, parameters and controls' outputs)
+        Note: it is not a copy, must not be changed
+        """
+        return self._state
+
     def set_reference(self, reference_name, new_reference):
         if reference_name not in self.reference_names:
             raise Exception('Reference name "%s" not known, must be one of %s' % (reference_name, self.reference_names))
@@ -98,6 +154,9 @@ class HierarchicalControl:
         :return:
         """
         # print('   new sensor values: %s' % new_sensor_values)
+        if self._step is not None:
+            self._state.update(new_sensor_values)
+            return self._step(self._state)
         for k, v in new_sensor_values.items():
             self._state[k] = v
         [control.run(self._state) for control in self._controls]
@@ -148,6 +207,9 @@ class ControlUnit:
     """
     A control unit used in HierarchicalControl
     """
+
+    __slots__ = ('control', 'sensor_name', 'output_name', 'reference_name')
+
     def __init__(self, control_def_all, state):
         control_def         = control_def_all[HierarchicalControl.k_definition]
         control_def['key']  = control_def_all.get(HierarchicalControl.k_name, 'NoName')
@@ -307,5 +369,32 @@ def test_get_items(file_name, dir_name, group, item):
     return len(items)
 
 
+def test_learned_states(file_name, dir_name, steps, sensor_name):
+    """
+    Returns True if what the controls learned is the same after: saving/loading it, a reset keeping it and
+    creating the hierarchy again with the controls' definition using warm_start
+    """
+    hc = HierarchicalControl(file_name, dir_name)
+    for reference_name in hc.reference_names:
+        hc.set_reference(reference_name, 5.0)
+    for i in range(steps):
+        hc.get_actuators({sensor_name: 5.0*i/steps})
+    learned = hc.get_learned_states()
+    saved   = hc.save_learned_states('test_learned_states.yaml', directory='/tmp')
+
+    loaded = HierarchicalControl(file_name, dir_name)
+    loaded.load_learned_states(saved)
+    hc.reset(keep_learned=True)
+
+    warm_started = HierarchicalControl(file_name, dir_name)
+    for control_def in get_item_def(HierarchicalControl.k_controls, HierarchicalControl.k_control, warm_started.hc_def):
+        control_def[HierarchicalControl.k_definition]['warm_start'] = saved
+    warm_started.reset()
+
+    results = [learned == other.get_learned_states() for other in [loaded, hc, warm_started]]
+    print('   controls learning: %s, same after load, reset and warm start: %s' % (list(learned.keys()), results))
+    return len(learned) > 0 and all(results)
+
+
 if __name__ == "__main__":
     ut.UnitTest(__name__, 'tests/hierarchical_control.test', '')
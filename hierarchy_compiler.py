@@ -0,0 +1,338 @@
+import hashlib
+import json
+import math
+import time
+
+import ControlUnit as cu
+import unit_test as ut
+
+
+_code_cache = {}  # definition hash -> compiled code object of the generated step factory
+
+
+class StepWriter:
+    """
+    Generates the Python source of one step function for a list of hierarchical ControlUnits
+    Signals are kept in locals, constants are written as literals and the logic of each known control unit type is
+    inlined, so the result is numerically the same as running the interpreted controls (but without calls)
+    """
+
+    def __init__(self, controls, actuator_names=()):
+        """
+        :param controls:       list of hierarchical_control.ControlUnit, in the order they are run
+        :param actuator_names: names of the values returned by the step function
+        """
+        self.controls  = controls
+        self.actuators = actuator_names
+        self.lines     = []
+        self.constants = {}  # constants that cannot be written as literals
+        self.signals   = {}  # signal name -> local variable name
+        self.loaded    = []  # signal names read from state at the start of the step
+        self.written   = []  # signal names written to state at the end of the step
+
+    def source(self):
+        body = []
+        self.lines = body
+        for i, control_unit in enumerate(self.controls):
+            self.write_control(i, control_unit)
+
+        args  = ', '.join('c%s' % i for i in range(len(self.controls)))
+        lines = ['def make_step(%s):' % args,
+                 '    def step(state):']
+        for name in self.loaded:
+            lines.append('        %s = state.get(%r, 0.0)' % (self.signals[name], name))
+        lines.extend(body)
+        for name in self.written:
+            lines.append('        state[%r] = %s' % (name, self.signals[name]))
+        actuators = ', '.join('%r: %s' % (name, self.signals[name] if name in self.written else 'state[%r]' % name)
+                              for name in self.actuators)
+        lines.append('        return {%s}' % actuators)
+        lines.append('    return step')
+        return '\n'.join(lines) + '\n'
+
+    def emit(self, line, indent=0):
+        self.lines.append('        ' + '    '*indent + line)
+
+    def const(self, value):
+        """
+        Returns the literal for a constant value (or a global name when it has no exact literal)
+        :param value:
+        :return:
+        """
+        if type(value) in (int, bool) or (type(value) is float and math.isfinite(value)):
+            return repr(value)
+        name = 'K%s' % len(self.constants)
+        self.constants[name] = value
+        return name
+
+    def read_signal(self, name):
+        if name is None:
+            return '0.0'
+        if name not in self.signals:
+            self.signals[name] = 's%s' % len(self.signals)
+            self.loaded.append(name)
+        return self.signals[name]
+
+    def write_signal(self, name, value_expr):
+        if name not in self.signals:
+            self.signals[name] = 's%s' % len(self.signals)
+        if name not in self.written:
+            self.written.append(name)
+        self.emit('%s = %s' % (self.signals[name], value_expr))
+
+    def write_control(self, i, control_unit):
+        control = control_unit.control
+        self.emit('# %s (%s)' % (control.key, control.type))
+        self.emit('c = c%s' % i)
+        self.emit('r = %s' % self.read_signal(control_unit.reference_name))
+        self.emit('new_p = %s' % self.read_signal(control_unit.sensor_name))
+        writer = control_writers.get(type(control), write_delegated)
+        writer(self, control)
+        self.write_signal(control_unit.output_name, 'o')
+
+    # pieces shared by the controls that use GenericControlUnit.update
+    def write_set_reference(self, control, keep_changed=False):
+        if keep_changed:
+            self.emit('if abs(c.r - r) > 0.01:')
+            self.emit('c.reference_changed = True', 1)
+        self.emit('c.r = r')
+
+    def write_error(self, control):
+        dt  = self.const(control.dt)
+        lag = self.const(control.lag)
+        self.emit('p_expected = new_p + (new_p - c.p)/%s*%s' % (dt, lag))
+        self.emit('c.p = new_p')
+        self.emit('new_error = r - p_expected')
+        if control.min_error > 0.0:
+            self.emit('if abs(new_error) < %s:' % self.const(control.min_error))
+            self.emit('new_error = 0.0', 1)
+
+    def write_output_limits(self, control, keep_changed=False):
+        if control.max_change > 0.00001:
+            max_change = self.const(control.max_change)
+            self.emit('o_max = c.o + %s' % max_change)
+            self.emit('o_min = c.o - %s' % max_change)
+            self.emit('if new_o > o_max:')
+            self.emit('new_o = o_max', 1)
+            self.emit('elif new_o < o_min:')
+            self.emit('new_o = o_min', 1)
+        self.write_bound('new_o', control.bounds)
+        self.emit('c.o = o = new_o')
+        if keep_changed:
+            self.emit('c.reference_changed = False')
+
+    def write_bound(self, var, bounds):
+        if not bounds:
+            return
+        min_v, max_v = bounds
+        self.emit('if %s > %s:' % (var, self.const(max_v)))
+        self.emit('%s = %s' % (var, self.const(max_v)), 1)
+        self.emit('elif %s < %s:' % (var, self.const(min_v)))
+        self.emit('%s = %s' % (var, self.const(min_v)), 1)
+
+
+def write_delegated(writer, _):
+    """
+    Control types without an inlined version are just called
+    """
+    writer.emit('o = c.get_output(r, new_p)')
+
+
+def write_pid(writer, control):
+    integrate    = abs(control.k_i) >= 0.0001
+    keep_changed = integrate and bool(control.integrator_reset)
+    dt           = writer.const(control.dt)
+    writer.write_set_reference(control, keep_changed=keep_changed)
+    writer.write_error(control)
+    writer.emit('delta_error = new_error - c.e')
+    writer.emit('c.e = new_error')
+    writer.emit('p_value = %s*new_error' % writer.const(control.k_p))
+    writer.emit('if c.first_time:')
+    writer.emit('c.first_time = False', 1)
+    writer.emit('new_o = p_value', 1)
+    writer.emit('else:')
+    if integrate:
+        windup = control.i_windup
+        if keep_changed:
+            writer.emit('if c.reference_changed:', 1)
+            writer.emit('integrator = 0.0', 2)
+            writer.emit('else:', 1)
+            indent = 2
+        else:
+            indent = 1
+        if control.integrator_values is not None:
+            writer.emit('c.integrator_values.append(new_error*%s)' % dt, indent)
+            writer.emit('integrator = c.integrator_values.sum()', indent)
+        else:
+            writer.emit('integrator = c.integrator + new_error*%s' % dt, indent)
+        writer.emit('if integrator > %s:' % writer.const(windup), 1)
+        writer.emit('integrator = %s' % writer.const(windup), 2)
+        writer.emit('elif integrator < %s:' % writer.const(-windup), 1)
+        writer.emit('integrator = %s' % writer.const(-windup), 2)
+        writer.emit('c.integrator = integrator', 1)
+    if control.dt > control.min_dt:
+        d_value = '%s*delta_error/%s' % (writer.const(control.k_d), dt)
+    else:
+        d_value = '0.0'
+    writer.emit('new_o = p_value + %s*c.integrator + %s' % (writer.const(control.k_i), d_value), 1)
+    writer.write_output_limits(control, keep_changed=keep_changed)
+
+
+def write_incremental_pid(writer, control):
+    writer.write_set_reference(control)
+    writer.write_error(control)
+    writer.emit('last_e = c.last_e')
+    writer.emit('c.e = new_error')
+    writer.emit('new_o = c.o + (%s*(new_error - last_e) + %s*new_error + %s*(new_error - 2*last_e + c.last_last_e))' %
+                (writer.const(control.k_p), writer.const(control.k_i), writer.const(control.k_d)))
+    writer.emit('c.last_last_e = last_e')
+    writer.emit('c.last_e = new_error')
+    writer.write_output_limits(control)
+
+
+def write_pcu(writer, control, min_ks=0.01):
+    if 0.0 <= control.ks < min_ks:
+        ks = min_ks
+    elif -min_ks < control.ks <= 0.0:
+        ks = -min_ks
+    else:
+        ks = control.ks
+    writer.emit('c.e = e = r - new_p')
+    writer.emit('o = c.o')
+    writer.emit('o += (%s*e - o)/%s' % (writer.const(control.kg), writer.const(ks)))
+    if len(control.bounds) > 0:
+        writer.emit('if o < %s:' % writer.const(control.bounds[0]))
+        writer.emit('o = %s' % writer.const(control.bounds[0]), 1)
+        writer.emit('elif o > %s:' % writer.const(control.bounds[1]))
+        writer.emit('o = %s' % writer.const(control.bounds[1]), 1)
+    writer.emit('c.o = o')
+
+
+def write_bang_bang(writer, control):
+    writer.write_set_reference(control)
+    writer.write_error(control)
+    writer.emit('c.e = new_error')
+    if control.hysteresis < 0:
+        low, high = 'r + %s' % writer.const(control.hysteresis), 'r'
+    else:
+        low, high = 'r', 'r + %s' % writer.const(control.hysteresis)
+    writer.emit('p = r - new_error')
+    writer.emit('if p <= %s:' % low)
+    writer.emit('new_o = %s' % writer.const(control.bellow_value), 1)
+    writer.emit('elif p > %s:' % high)
+    writer.emit('new_o = %s' % writer.const(control.above_value), 1)
+    writer.emit('else:')
+    writer.emit('new_o = c.o', 1)
+    writer.write_output_limits(control)
+
+
+def write_lineal(writer, control):
+    writer.write_set_reference(control)
+    writer.emit('new_o = r')
+    writer.write_bound('new_o', control.input_bounds)
+    writer.emit('new_o = %s*new_o' % writer.const(control.gain))
+    writer.write_bound('new_o', control.bounds)
+    writer.emit('c.o = o = new_o')
+
+
+control_writers = {cu.PID: write_pid, cu.P: write_pid, cu.IncrementalPID: write_incremental_pid, cu.PCU: write_pcu,
+                   cu.BangBang: write_bang_bang, cu.LinealControlUnit: write_lineal}
+
+
+def definition_hash(hc_def, state):
+    """
+    Returns a hash that identifies a hierarchy definition with its values (parameters are compiled as constants)
+    :param hc_def: hierarchy definition (as read from the YAML file)
+    :param state:  values used to create the controls
+    :return: :type String
+    """
+    text = json.dumps([hc_def, state], sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def generate_source(controls, actuator_names=()):
+    writer = StepWriter(controls, actuator_names=actuator_names)
+    return writer.source(), writer.constants
+
+
+def compile_step(controls, actuator_names=(), key=None):
+    """
+    Returns a function step(state) that runs all the controls in just one call, as HierarchicalControl does, and
+    returns the actuators values
+    Notes:
+        * the controls objects keep their dynamic values (o, e, integrator, etc.) so they can still be used
+        * controls parameters are constants, so it must be compiled again if they change (as after a reset)
+        * debug info of the controls is not printed
+    :param controls:       list of hierarchical_control.ControlUnit
+    :param actuator_names:
+    :param key:            definition hash (see definition_hash) used to avoid compiling the same code again
+    :return:
+    """
+    cached = _code_cache.get(key) if key is not None else None
+    if cached is None:
+        source, constants = generate_source(controls, actuator_names=actuator_names)
+        cached = (compile(source, '<hierarchy %s>' % key, 'exec'), constants)
+        if key is not None:
+            _code_cache[key] = cached
+    code, constants = cached
+    namespace = dict(constants)
+    exec(code, namespace)
+    return namespace['make_step'](*[control_unit.control for control_unit in controls])
+
+
+# tests
+def get_hierarchy(file_name, dir_name, compiled):
+    import hierarchical_control as hc
+    return hc.HierarchicalControl(file_name, dir_name, compiled=compiled)
+
+
+def cart_pole_sensors(steps):
+    for i in range(steps):
+        yield {'cart_pos': 0.5*math.sin(i*0.01), 'cart_speed': 0.1*math.cos(i*0.03), 'pole_angle': 0.05*math.sin(i*0.1),
+               'pole_speed': 0.2*math.cos(i*0.07)}
+
+
+def run_cart_pole(control, reference_name, reference, steps):
+    control.set_reference(reference_name, reference)
+    return [control.get_actuators(sensors) for sensors in cart_pole_sensors(steps)]
+
+
+def run_car(control, reference_changes, steps):
+    import CarModel as cm
+    env = cm.CarEnvironment1(control, output_lag=2, max_steps=steps)
+    env.run_episode(reference_changes=reference_changes)
+    return env.recorder.get_records()
+
+
+def run_hierarchy(file_name, dir_name, compiled, steps):
+    control = get_hierarchy(file_name, dir_name, compiled)
+    if dir_name == 'cars':
+        return run_car(control, [[0, 'ref_speed', 5.0], [steps//2, 'ref_speed', 2.0]], steps)
+    reference_name = 'ref_final_pos' if 'ref_final_pos' in control.reference_names else 'ref_pole_angle'
+    return run_cart_pole(control, reference_name, 0.1, steps)
+
+
+def test_same_as_interpreted(file_name, dir_name, steps):
+    interpreted = run_hierarchy(file_name, dir_name, False, steps)
+    compiled    = run_hierarchy(file_name, dir_name, True, steps)
+    return interpreted == compiled
+
+
+def test_speedup(file_name, dir_name, steps):
+    """
+    Returns how many times the compiled step is faster than the interpreted one (steps per second)
+    """
+    sensors = list(cart_pole_sensors(steps))
+    times   = []
+    for compiled in [False, True]:
+        control = get_hierarchy(file_name, dir_name, compiled)
+        start   = time.perf_counter()
+        for values in sensors:
+            control.get_actuators(values)
+        times.append(time.perf_counter() - start)
+    print('      interpreted: %.0f steps/s compiled: %.0f steps/s' % (steps/times[0], steps/times[1]))
+    return round(times[0]/times[1], 1)
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/hierarchy_compiler.test', '')
@@ -0,0 +1,284 @@
+import math
+
+import numpy as np
+
+import ControlUnit as cu
+import hierarchical_control as hc
+import unit_test as ut
+
+
+class RelayResult:
+    """
+    Ultimate gain and period of a plant measured with a relay feedback experiment (Astrom-Hagglund): the control is
+    replaced by a relay (a BangBang control) that makes the loop oscillate, the oscillation gives the point where the
+    plant phase is -180 degrees, from which initial gains are calculated with tuning rules (see get_gains)
+    """
+
+    # rule name -> function(ku, tu) that returns [p gain, integral time, derivative time], integral time 0 means no I
+    pid_rules = {'zn_p':           lambda ku, tu: [0.5*ku,  0.0,    0.0],
+                 'zn_pi':          lambda ku, tu: [0.45*ku, tu/1.2, 0.0],
+                 'zn_pid':         lambda ku, tu: [0.6*ku,  tu/2.0, tu/8.0],
+                 'some_overshoot': lambda ku, tu: [ku/3.0,  tu/2.0, tu/3.0],
+                 'no_overshoot':   lambda ku, tu: [0.2*ku,  tu/2.0, tu/3.0],
+                 'tyreus_luyben':  lambda ku, tu: [ku/2.2,  2.2*tu, tu/6.3]}
+    pcu_phase_lag = 15.0  # degrees
+
+    def __init__(self, ku, tu, amplitude, cycles, dt):
+        """
+        :param ku:        ultimate gain
+        :param tu:        ultimate period (in seconds)
+        :param amplitude: amplitude of the oscillation of the perception
+        :param cycles:    number of cycles measured
+        :param dt:
+        """
+        self.ku        = ku
+        self.tu        = tu
+        self.amplitude = amplitude
+        self.cycles    = cycles
+        self.dt        = dt
+
+    @classmethod
+    def from_values(cls, values, relay_amplitude, dt, hysteresis=0.0, skip=0.5):
+        """
+        :param values:          perception in each step of the relay episode
+        :param relay_amplitude: half of the difference between the two relay outputs
+        :param dt:
+        :param hysteresis:      width of the relay hysteresis band
+        :param skip:            fraction of the episode ignored at the start (transient)
+        """
+        values = np.asarray(values, dtype=float)[int(len(values)*skip):]
+        mean   = (np.max(values) + np.min(values))/2.0 if len(values) > 0 else 0.0
+        ups    = np.nonzero((values[:-1] < mean) & (values[1:] >= mean))[0]
+        if len(ups) < 3:
+            raise Exception('No sustained oscillation in the relay episode (%s cycles), try a larger relay amplitude '
+                            'or a longer episode' % max(len(ups) - 1, 0))
+        cycle_values = values[ups[0]:ups[-1] + 1]
+        amplitude    = (np.max(cycle_values) - np.min(cycle_values))/2.0
+        if amplitude <= 0.5*hysteresis:
+            raise Exception('Relay oscillation amplitude (%.4f) is not greater than the hysteresis' % amplitude)
+        ku = 4.0*relay_amplitude/(math.pi*math.sqrt(amplitude**2 - (0.5*hysteresis)**2))
+        tu = float(np.mean(np.diff(ups)))*dt
+        return cls(ku, tu, amplitude, len(ups) - 1, dt)
+
+    def get_gains(self, control_type='PID', rule='zn_pid'):
+        """
+        Returns the initial parameters of a control (with the names used by its get_parameters):
+            PID:            p, i and d from the rule
+            IncrementalPID: same, but in its form (i and d per step)
+            P:              just p
+            PCU:            g is the p gain of the rule and s the slowing factor (the PCU output is a first order
+                            filter of g*e with time constant s*dt) that adds just pcu_phase_lag degrees at the ultimate
+                            frequency
+        """
+        if rule not in self.pid_rules:
+            raise Exception('Tuning rule "%s" not known, must be one of %s' % (rule, list(self.pid_rules)))
+        kp, ti, td = self.pid_rules[rule](self.ku, self.tu)
+        ki         = kp/ti if ti > 0 else 0.0
+        kd         = kp*td
+        if control_type == 'PID':
+            return {cu.PID.kp_key: kp, cu.PID.ki_key: ki, cu.PID.kd_key: kd}
+        if control_type == 'IncrementalPID':
+            return {cu.IncrementalPID.kp_key: kp, cu.IncrementalPID.ki_key: ki*self.dt,
+                    cu.IncrementalPID.kd_key: kd/self.dt}
+        if control_type == 'P':
+            return {cu.P.kp_key: kp}
+        if control_type == 'PCU':
+            time_constant = math.tan(math.radians(self.pcu_phase_lag))*self.tu/(2.0*math.pi)
+            return {cu.PCU.k_g: kp, cu.PCU.k_s: max(1.0, time_constant/self.dt)}
+        raise Exception('Relay tuning not implemented for control type "%s"' % control_type)
+
+    def summary_string(self):
+        return 'ku:%.3f tu:%.3f amplitude:%.3f cycles:%s' % (self.ku, self.tu, self.amplitude, self.cycles)
+
+
+def relay_definition(amplitude, bias=0.0, hysteresis=0.0, key='relay'):
+    """
+    Returns the definition of a relay: a BangBang control whose output is bias + amplitude when the perception is bellow
+    the reference and bias - amplitude when it is above
+    """
+    return {cu.GenericControlUnit.k_type: cu.BangBang.type, cu.BangBang.bellow_value_key: bias + amplitude,
+            cu.BangBang.above_value_key: bias - amplitude, cu.BangBang.hysteresis_key: hysteresis, 'key': key}
+
+
+def swap_control(control, control_name, new_control):
+    """
+    Replaces a control unit inside a control, returns the one replaced
+    :param control:      hierarchical_control.HierarchicalControl (not compiled), the unit named control_name is
+                         replaced, or hierarchical_control.BaseHierarchicalControl, its main control is replaced
+    :param control_name:
+    :param new_control:  a ControlUnit.GenericControlUnit
+    """
+    if isinstance(control, hc.HierarchicalControl):
+        if control.compiled:
+            raise Exception('Controls can not be replaced in a compiled hierarchy')
+        for unit in control._controls:
+            if unit.control.key == control_name:
+                old_control, unit.control = unit.control, new_control
+                new_control.set_reference(control.get_value(unit.reference_name) if unit.reference_name in
+                                          control.get_state() else 0.0)
+                return old_control
+        raise Exception('Control "%s" not in hierarchy %s' % (control_name, control.file_name))
+    old_control, control.main_control = control.main_control, new_control
+    return old_control
+
+
+def get_control_unit(control, control_name=None):
+    # the control unit tuned (see swap_control)
+    if isinstance(control, hc.HierarchicalControl):
+        for unit in control._controls:
+            if unit.control.key == control_name:
+                return unit
+        raise Exception('Control "%s" not in hierarchy %s' % (control_name, control.file_name))
+    return control.main_control
+
+
+def car_relay_experiment(control, reference, control_name=None, amplitude=1.0, bias=0.0, hysteresis=0.0,
+                         car_name='simple', output_lag=0, slope=0.0, dt=0.1, steps=600, reference_name='ref_speed',
+                         sensor_name='speed'):
+    """
+    Runs one car episode with the control replaced by a relay and returns the RelayResult
+    :param control:        hierarchical_control.HierarchicalControl (not compiled) or BaseHierarchicalControl (i.e.
+                           CarControl.CarSpeedControl), see swap_control
+    :param reference:      reference value (the relay oscillates around it)
+    :param control_name:   name of the control replaced in a HierarchicalControl
+    :param amplitude:      relay amplitude (in the control output units)
+    :param bias:           relay middle output (i.e. the output that keeps the reference)
+    :param hysteresis:
+    :param car_name:
+    :param output_lag:
+    :param slope:
+    :param dt:
+    :param steps:
+    :param reference_name: used in a HierarchicalControl
+    :param sensor_name:    perception of the replaced control
+    """
+    import CarModel as cm
+
+    relay       = cu.create_control(relay_definition(amplitude, bias, hysteresis, key=control_name or 'relay'))
+    old_control = swap_control(control, control_name, relay)
+    try:
+        if isinstance(control, hc.HierarchicalControl):
+            env = cm.CarEnvironment1(control, car_name=car_name, output_lag=output_lag, slope=slope, dt=dt,
+                                     max_steps=steps, channels=[sensor_name])
+            env.run_episode(reference_changes=[[0, reference_name, reference]])
+        else:
+            env = cm.CarEnvironment(control, car_name=car_name, output_lag=output_lag, slope=slope, dt=dt,
+                                    max_steps=steps)
+            env.run_episode(reference_changes=[[0, reference]])
+        values = env.recorder.get_channel(sensor_name)
+    finally:
+        swap_control(control, control_name, old_control)
+        control.reset()
+    return RelayResult.from_values(values, amplitude, dt, hysteresis=hysteresis)
+
+
+def hierarchy_parameters(control, control_name, gains):
+    """
+    Returns the parameters of a HierarchicalControl that set the gains of one of its controls, that is the parameters
+    used in its definition (i.e. gains: [k_p, 0.0, 0.0] with gains {p: 1.5} gives {k_p: 1.5}), gains given with a
+    number in the definition can not be changed so they are ignored (if none can be set it raises an exception)
+    """
+    unit       = get_control_unit(control, control_name)
+    definition = unit.control.control_params
+    if unit.control.type == 'P':
+        names = {cu.P.kp_key: definition.get(cu.P.k_gain)}
+    elif cu.PID.k_gains in definition:
+        names = dict(zip([cu.PID.kp_key, cu.PID.ki_key, cu.PID.kd_key], definition[cu.PID.k_gains]))
+    else:
+        names = {name: definition.get(name) for name in gains}
+    parameters = {names[name]: value for name, value in gains.items()
+                  if isinstance(names.get(name), str) and names[name] in control.parm_names}
+    if not parameters:
+        raise Exception('None of the gains %s of control "%s" is a parameter of the hierarchy' %
+                        (list(gains), control_name))
+    return parameters
+
+
+def seed_auto_tune(auto_tune, relay_result, control_type='PID', rule='zn_pid', change=None):
+    """
+    Sets the initial parameters of an auto_tune.AutoTuneFunction from a relay experiment, so twiddle starts close to a
+    stable (and usually good) region
+    :param change: new twiddle initial change, None means keep it
+    :return: initial parameters set
+    """
+    parameters = dict(auto_tune.get_parameters(), **relay_result.get_gains(control_type, rule))
+    auto_tune.set_parameters(parameters)
+    if change is not None:
+        auto_tune.change = change
+    return parameters
+
+
+# tests
+def test_relay(values, relay_amplitude, dt, hysteresis):
+    """
+    Returns [ku, tu] of a relay episode
+    """
+    result = RelayResult.from_values(values, relay_amplitude, dt, hysteresis=hysteresis)
+    return [round(result.ku, 3), round(result.tu, 3)]
+
+
+def test_gains(ku, tu, dt, control_type, rule):
+    result = RelayResult(ku, tu, 1.0, 3, dt)
+    return {name: round(value, 3) for name, value in result.get_gains(control_type, rule).items()}
+
+
+def test_car_speed_relay(car_name, output_lag, reference, amplitude, bias, rule, change, reference_changes, max_iter,
+                        debug):
+    """
+    Returns True if twiddle seeded with a relay experiment reaches a cost at least as good as from the default gains,
+    in less tries
+    """
+    import CarControl as cc
+
+    speed_def = {'type': 'PID', 'name': 'speed', 'gains': [1.0, 0.0, 0.0]}
+    control   = cc.CarSpeedControl(0.0, speed_def)
+    result    = car_relay_experiment(control, reference, amplitude=amplitude, bias=bias, car_name=car_name,
+                                     output_lag=output_lag)
+    seeded    = cc.AutoTuneCar(car_name, control, output_lag, reference_changes, max_iter=max_iter)
+    initial   = seed_auto_tune(seeded, result, rule=rule, change=change)
+    seeded.auto_tune()
+    cold      = cc.AutoTuneCar(car_name, cc.CarSpeedControl(0.0, speed_def), output_lag, reference_changes,
+                               max_iter=max_iter)
+    cold.auto_tune()
+    if debug:
+        print('   %s initial:%s' % (result.summary_string(), {k: round(v, 3) for k, v in initial.items()}))
+        print('   seeded: cost %.3f tries %s, default: cost %.3f tries %s' % (seeded.last_cost, seeded.last_tries,
+                                                                             cold.last_cost, cold.last_tries))
+    return seeded.last_tries < cold.last_tries and seeded.last_cost <= cold.last_cost*1.05
+
+
+def test_hierarchy_relay(file_name, dir_name, control_name, reference, amplitude, bias, output_lag, debug):
+    """
+    Returns the hierarchy parameters given by a relay experiment on one of its controls
+    """
+    control = hc.HierarchicalControl(file_name, dir_name)
+    result  = car_relay_experiment(control, reference, control_name=control_name, amplitude=amplitude, bias=bias,
+                                   output_lag=output_lag)
+    if debug:
+        print('   %s' % result.summary_string())
+    gains   = result.get_gains(get_control_unit(control, control_name).control.type, 'zn_p')
+    return {name: round(value, 1) for name, value in hierarchy_parameters(control, control_name, gains).items()}
+
+
+def test_hierarchy_parameters(file_name, dir_name, control_name, definition, gains):
+    """
+    Returns the hierarchy parameters that set the gains of a control, once its definition is replaced, or 'not mapped'
+    if none of them can be set
+    """
+    import tempfile
+    import yaml_functions as yf
+
+    hierarchy = yf.get_yaml_file(file_name, directory=dir_name)
+    for control_def in hierarchy['controls']:
+        if control_def['control']['name'] == control_name:
+            control_def['control']['definition'] = definition
+    yf.save_yaml_file(hierarchy, 'test_hierarchy_parameters.yaml', directory=tempfile.gettempdir())
+    control = hc.HierarchicalControl('test_hierarchy_parameters.yaml', tempfile.gettempdir())
+    try:
+        return hierarchy_parameters(control, control_name, gains)
+    except Exception:
+        return 'not mapped'
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/relay_tune.test', '')
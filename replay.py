@@ -0,0 +1,275 @@
+import csv
+import json
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import telemetry
+import unit_test as ut
+
+k_time = telemetry.TelemetryRecorder.k_time
+
+
+def read_log(file_name, chunk_size=10000, names=None):
+    """
+    Reads a recorded log in chunks, so logs of any size are read with bounded memory
+    :param file_name:  a .csv file (names in the first line), a .ndjson/.jsonl file (one JSON object per line) or a
+                       directory written by telemetry.ChunkWriter
+    :param chunk_size: records per chunk (a ChunkWriter directory is read in the chunks it was written)
+    :param names:      names of the values to read, None means all
+    :return: yields dict name -> numpy array
+    """
+    if os.path.isdir(file_name):
+        return read_chunks(file_name, names=names)
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.csv':
+        return read_csv(file_name, chunk_size=chunk_size, names=names)
+    if extension in ['.ndjson', '.jsonl']:
+        return read_ndjson(file_name, chunk_size=chunk_size, names=names)
+    raise Exception('Log "%s" format not known, must be a .csv, .ndjson or .jsonl file or a telemetry directory' %
+                    file_name)
+
+
+def read_csv(file_name, chunk_size=10000, names=None):
+    with open(file_name, newline='') as log_file:
+        reader = csv.reader(log_file)
+        header = [name.strip() for name in next(reader)]
+        names  = header if names is None else list(names)
+        for name in names:
+            if name not in header:
+                raise Exception('"%s" not in log %s, must be one of %s' % (name, file_name, header))
+        columns = [header.index(name) for name in names]
+        rows    = []
+        for row in reader:
+            rows.append([to_float(row[i]) for i in columns])
+            if len(rows) >= chunk_size:
+                yield rows_to_chunk(rows, names)
+                rows = []
+        if rows:
+            yield rows_to_chunk(rows, names)
+
+
+def read_ndjson(file_name, chunk_size=10000, names=None):
+    """
+    Values missing in a record are read as nan
+    """
+    with open(file_name) as log_file:
+        rows = []
+        for line in log_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if names is None:
+                names = list(record.keys())
+            rows.append([to_float(record.get(name)) for name in names])
+            if len(rows) >= chunk_size:
+                yield rows_to_chunk(rows, names)
+                rows = []
+        if rows:
+            yield rows_to_chunk(rows, names)
+
+
+def read_chunks(directory, names=None):
+    """
+    Reads a directory written by telemetry.ChunkWriter (memory mapped, so just the values used are read from disk)
+    """
+    reader = telemetry.ChunkReader(directory)
+    for chunk in reader.iter_chunks(names=names):
+        yield chunk
+
+
+def to_float(value):
+    return np.nan if value is None or value == '' else float(value)
+
+
+def rows_to_chunk(rows, names):
+    values = np.array(rows, dtype=float).reshape(len(rows), len(names))
+    return {name: values[:, i] for i, name in enumerate(names)}
+
+
+def replay(controls, log_chunks):
+    """
+    Runs the values of a log through several hierarchical controls in open loop (no plant), each chunk is read once for
+    all the controls, so many parameter sets can be evaluated in just one pass over the log
+    Values in the log named as a control's reference are set with set_reference (when they change) and the ones named
+    as its sensors are given to get_actuators, the rest are ignored
+    :param controls:   list of hierarchical_control.HierarchicalControl (compiled ones are much faster)
+    :param log_chunks: iterable of dict name -> array, see read_log
+    :return: yields (chunk, outputs) for each chunk of the log, where outputs has one dict actuator name -> array per
+             control
+    """
+    last_references = [None for _ in controls]
+    for chunk in log_chunks:
+        outputs = []
+        for i, control in enumerate(controls):
+            sensor_names    = [name for name in control.sensor_names if name in chunk]
+            reference_names = [name for name in control.reference_names if name in chunk]
+            sensor_rows     = list(zip(*[chunk[name].tolist() for name in sensor_names]))
+            reference_rows  = list(zip(*[chunk[name].tolist() for name in reference_names])) if reference_names \
+                else None
+            last_references[i], actuators = run_rows(control, sensor_names, sensor_rows, reference_names,
+                                                     reference_rows, last_references[i])
+            outputs.append({name: actuators[:, j] for j, name in enumerate(control.actuator_names)})
+        yield chunk, outputs
+
+
+def run_rows(control, sensor_names, sensor_rows, reference_names, reference_rows, last_reference):
+    actuator_names = control.actuator_names
+    actuators      = np.empty((len(sensor_rows), len(actuator_names)))
+    for row, sensor_values in enumerate(sensor_rows):
+        if reference_rows is not None and reference_rows[row] != last_reference:
+            for name, value in zip(reference_names, reference_rows[row]):
+                control.set_reference(name, value)
+            last_reference = reference_rows[row]
+        actions = control.get_actuators(dict(zip(sensor_names, sensor_values)))
+        actuators[row] = [actions[name] for name in actuator_names]
+    return last_reference, actuators
+
+
+def audit(file_name, dir_name, parameter_sets, log_file_name, chunk_size=10000, compiled=True):
+    """
+    Replays a log through a hierarchy with each one of the parameter sets (in just one pass over the log) and compares
+    the actuators with the ones recorded in the log
+    :param file_name:      hierarchy definition
+    :param dir_name:
+    :param parameter_sets: list of dicts with the parameters that replace the ones in the definition
+    :param log_file_name:  see read_log
+    :param chunk_size:
+    :param compiled:       if True the hierarchies are compiled (see hierarchy_compiler)
+    :return: list (one per parameter set) of dict actuator name -> rms difference with the log (nan if not in the log)
+    """
+    import hierarchical_control as hc
+
+    controls = [hc.HierarchicalControl(file_name, dir_name, initial_parameters=parameters, compiled=compiled)
+                for parameters in parameter_sets]
+    names    = controls[0].actuator_names
+    squares  = np.zeros((len(controls), len(names)))
+    count    = 0
+    for chunk, outputs in replay(controls, read_log(log_file_name, chunk_size=chunk_size)):
+        count += len(next(iter(chunk.values())))
+        for i, actuators in enumerate(outputs):
+            for j, name in enumerate(names):
+                squares[i, j] += np.sum((actuators[name] - chunk[name])**2) if name in chunk else np.nan
+    return [{name: math.sqrt(squares[i, j]/count) if count > 0 else np.nan for j, name in enumerate(names)}
+            for i in range(len(controls))]
+
+
+# tests
+def speed_sensors(steps, dt=0.1):
+    """
+    Returns a log like the ones recorded in a car: time, reference speed, speed and acceleration
+    """
+    t     = np.arange(1, steps + 1)*dt
+    speed = 4.0 + 1.5*np.sin(0.05*t) + 0.2*np.sin(1.3*t)
+    return {k_time: t, 'ref_speed': np.where(t < steps*dt/2, 5.0, 2.0), 'speed': speed,
+            'acceleration': np.gradient(speed, dt)}
+
+
+def write_log(log, file_name):
+    """
+    Writes a log (dict name -> array) in the format given by the file name: .csv, .ndjson or else a telemetry directory
+    """
+    names     = list(log.keys())
+    rows      = np.stack([log[name] for name in names], axis=1).tolist()
+    extension = os.path.splitext(file_name)[1]
+    if extension == '.csv':
+        with open(file_name, 'w', newline='') as log_file:
+            writer = csv.writer(log_file)
+            writer.writerow(names)
+            writer.writerows([repr(value) for value in row] for row in rows)
+    elif extension == '.ndjson':
+        with open(file_name, 'w') as log_file:
+            log_file.writelines(json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+    else:
+        with telemetry.ChunkWriter(file_name, chunk_size=1000) as writer:
+            for row in rows:
+                writer.record(row[0], dict(zip(names[1:], row[1:])))
+
+
+def run_log(file_name, dir_name, parameters, log):
+    """
+    Runs a log through a hierarchy step by step (what replay must give), returns the actuators as a list of lists
+    """
+    import hierarchical_control as hc
+
+    control   = hc.HierarchicalControl(file_name, dir_name, initial_parameters=parameters, compiled=True)
+    reference = None
+    actuators = []
+    for ref_speed, speed, acceleration in zip(log['ref_speed'], log['speed'], log['acceleration']):
+        if ref_speed != reference:
+            control.set_reference('ref_speed', ref_speed)
+            reference = ref_speed
+        actions = control.get_actuators({'speed': speed, 'acceleration': acceleration})
+        actuators.append([actions[name] for name in control.actuator_names])
+    return actuators
+
+
+def test_replay_formats(file_name, dir_name, steps, chunk_size):
+    """
+    Returns True if replaying the same log saved as csv, ndjson and telemetry gives the same actuators than running it
+    step by step
+    """
+    import hierarchical_control as hc
+
+    log      = speed_sensors(steps)
+    expected = run_log(file_name, dir_name, None, log)
+    all_same = True
+    for extension in ['.csv', '.ndjson', '']:
+        log_file_name = os.path.join(tempfile.gettempdir(), 'test_replay' + extension)
+        write_log(log, log_file_name)
+        control  = hc.HierarchicalControl(file_name, dir_name, compiled=True)
+        replayed = [np.stack([outputs[0][name] for name in control.actuator_names], axis=1)
+                    for _, outputs in replay([control], read_log(log_file_name, chunk_size=chunk_size))]
+        same     = np.concatenate(replayed).tolist() == expected
+        print('   %s: %s' % (extension or 'telemetry', same))
+        all_same = all_same and same
+    return all_same
+
+
+def test_parameter_sets(file_name, dir_name, parameter_name, values, steps):
+    """
+    Returns True if evaluating all the parameter values in one pass gives the same actuators as running each one alone,
+    also prints the steps per second (of all the sets together)
+    """
+    import hierarchical_control as hc
+
+    log           = speed_sensors(steps)
+    log_file_name = os.path.join(tempfile.gettempdir(), 'test_parameter_sets.csv')
+    write_log(log, log_file_name)
+    controls = [hc.HierarchicalControl(file_name, dir_name, initial_parameters={parameter_name: value}, compiled=True)
+                for value in values]
+    names    = controls[0].actuator_names
+    start    = time.perf_counter()
+    replayed = [[] for _ in controls]
+    for _, outputs in replay(controls, read_log(log_file_name, chunk_size=1000)):
+        for i, actuators in enumerate(outputs):
+            replayed[i].append(np.stack([actuators[name] for name in names], axis=1))
+    elapsed  = time.perf_counter() - start
+    print('   %s sets: %.0f steps per second' % (len(values), len(values)*steps/elapsed))
+    return all(np.concatenate(replayed[i]).tolist() == run_log(file_name, dir_name, {parameter_name: value}, log)
+               for i, value in enumerate(values))
+
+
+def test_audit(file_name, dir_name, parameter_name, values, steps):
+    """
+    Returns True if the actuators recorded in a log (with the first parameter value) are the same as the replayed ones
+    just for that value, also prints the rms differences
+    """
+    log       = speed_sensors(steps)
+    actuators = np.array(run_log(file_name, dir_name, {parameter_name: values[0]}, log))
+    log.update({'accelerator': actuators[:, 0], 'brake': actuators[:, 1]})
+    log_file_name = os.path.join(tempfile.gettempdir(), 'test_audit.ndjson')
+    write_log(log, log_file_name)
+    differences   = audit(file_name, dir_name, [{parameter_name: value} for value in values], log_file_name,
+                          chunk_size=300)
+    for value, difference in zip(values, differences):
+        print('   %s: %s' % (value, {name: round(rms, 3) for name, rms in difference.items()}))
+    return all(rms == 0.0 for rms in differences[0].values()) and \
+        all(max(difference.values()) > 0.0 for difference in differences[1:])
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/replay.test', '')
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import unit_test as ut
+
+# modules whose code defines the results of an episode, if any of them changes the cached results are not used
+simulation_files = ['ControlUnit.py', 'signals.py', 'hierarchical_control.py', 'hierarchy_compiler.py', 'CarModel.py',
+                    'CarControl.py', 'scenario.py', 'GymEnvironment.py', 'CartPole.py', 'FuzzyControl.py']
+_code_versions   = {}  # tuple of file names -> hash of their content
+_default_cache   = None
+
+
+class ResultCache:
+    """
+    Persistent store of episode results (costs, summary metrics and optionally compressed telemetry) addressed by the
+    hash of everything that defines them: definitions content, parameters, scenario, car type and code version. So
+    the same episode run again (in another tuning session, a GUI refresh, etc.) is read from disk instead of simulated
+    The size in disk is bounded: when it is exceeded, the least recently used results are deleted
+    """
+
+    k_result    = 'result'
+    k_extension = '.pickle'
+
+    def __init__(self, directory=None, max_bytes=200*2**20, code_files=simulation_files):
+        """
+        :param directory:  where results are saved, None means __pycache__/results in this script directory
+        :param max_bytes:  max size of all the results saved
+        :param code_files: modules whose content is part of the key (see code_version)
+        """
+        self.directory    = directory if directory is not None else \
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'results')
+        self.max_bytes    = max_bytes
+        self.code_version = code_version(code_files)
+        self.total_bytes  = None  # size in disk, calculated the first time a result is saved
+        self.hits         = 0
+        self.misses       = 0
+
+    def get_key(self, *parts):
+        """
+        Returns the key of a result given everything that defines it (any value that can be converted to json, or
+        its repr is used), plus the code version
+        """
+        text = json.dumps([self.code_version, parts], sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def get(self, key, default=None):
+        file_name = self.get_file_name(key)
+        try:
+            with open(file_name, 'rb') as result_file:
+                result = pickle.load(result_file)[self.k_result]
+        except (IOError, EOFError, ValueError, KeyError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        os.utime(file_name)  # to know it was used (see evict)
+        self.hits += 1
+        return result
+
+    def get_telemetry(self, key):
+        """
+        Returns the telemetry saved with a result (dict name -> array) or None if there is not
+        """
+        try:
+            with np.load(self.get_file_name(key, extension='.npz')) as arrays:
+                return {name: arrays[name] for name in arrays.files}
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, result, telemetry=None):
+        """
+        :param key:       see get_key
+        :param result:    anything that can be pickled, i.e. a cost or a dict with summary metrics
+        :param telemetry: optional dict name -> array (i.e. TelemetryRecorder.as_dict()), saved compressed
+        """
+        file_name = self.get_file_name(key)
+        size      = save_atomic(file_name, lambda f: pickle.dump({self.k_result: result}, f, pickle.HIGHEST_PROTOCOL))
+        if telemetry is not None:
+            size += save_atomic(self.get_file_name(key, extension='.npz'),
+                                lambda f: np.savez_compressed(f, **telemetry))
+        if self.total_bytes is None:
+            self.total_bytes = self.get_disk_size()
+        else:
+            self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def get_or_run(self, key_parts, function, *args, **kwargs):
+        """
+        Returns the result saved for the key parts (see get_key) or, if there is not, runs the function and saves it
+        """
+        key    = self.get_key(*key_parts)
+        result = self.get(key, default=_missing)
+        if result is _missing:
+            result = function(*args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def get_file_name(self, key, extension=k_extension):
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def get_files(self):
+        # returns [[last use time, size, file name], ...] of all the results saved
+        files = []
+        if not os.path.isdir(self.directory):
+            return files
+        for sub_directory in os.scandir(self.directory):
+            if sub_directory.is_dir():
+                for entry in os.scandir(sub_directory.path):
+                    stat = entry.stat()
+                    files.append([stat.st_mtime, stat.st_size, entry.path])
+        return files
+
+    def get_disk_size(self):
+        return sum(size for [_, size, _] in self.get_files())
+
+    def evict(self, target_ratio=0.8):
+        """
+        Deletes the least recently used results until the size is target_ratio of max_bytes
+        """
+        files            = sorted(self.get_files())
+        self.total_bytes = sum(size for [_, size, _] in files)
+        for [_, size, file_name] in files:
+            if self.total_bytes <= self.max_bytes*target_ratio:
+                break
+            try:
+                os.remove(file_name)
+                self.total_bytes -= size
+            except OSError:
+                pass  # already deleted by other process
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.total_bytes = 0
+
+
+_missing = object()
+
+
+def save_atomic(file_name, write_function):
+    # saves in a temporal file first, so other process never reads an incomplete file, returns its size
+    temporal_file_name = '%s.%s.tmp' % (file_name, os.getpid())
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(temporal_file_name, 'wb') as output_file:
+        write_function(output_file)
+    os.replace(temporal_file_name, file_name)
+    return os.path.getsize(file_name)
+
+
+def code_version(file_names=simulation_files):
+    """
+    Returns the hash of the content of the given modules (relative to this script directory), calculated once
+    """
+    file_names = tuple(file_names)
+    if file_names not in _code_versions:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        digest    = hashlib.sha1()
+        for file_name in file_names:
+            digest.update(file_digest(os.path.join(directory, file_name)).encode())
+        _code_versions[file_names] = digest.hexdigest()
+    return _code_versions[file_names]
+
+
+def file_digest(file_name, directory=None):
+    """
+    Returns the hash of a file content ('' if it does not exist), i.e. to use a definition file as part of a key
+    """
+    full_file_name = os.path.join(directory, file_name) if directory else file_name
+    try:
+        with open(full_file_name, 'rb') as input_file:
+            return hashlib.sha1(input_file.read()).hexdigest()
+    except IOError:
+        return ''
+
+
+def object_digest(value):
+    """
+    Returns the hash of an object (i.e. a control unit after reset, so its definition and state) or None if it can not
+    be pickled
+    """
+    try:
+        return hashlib.sha1(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).hexdigest()
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def default_cache():
+    """
+    Returns the cache shared by all the module (created the first time)
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
+
+
+# tests
+def test_auto_tune_cache(control_params, parameters_list, repeats):
+    """
+    Returns [results read from disk, episodes simulated] of an AutoTuneControl run repeats times with each parameters
+    """
+    import ControlUnit as cu
+
+    cache = ResultCache(directory=os.path.join(tempfile.gettempdir(), 'test_auto_tune_cache'))
+    cache.clear()
+    costs = {}
+    for _ in range(repeats):
+        auto_tune = cu.AutoTuneControl(cu.create_control(control_params), reference=5.0, max_iter=200, cache=cache)
+        for parameters in parameters_list:
+            cost = auto_tune.run_function_with_parameters(parameters)
+            if costs.setdefault(json.dumps(parameters, sort_keys=True), cost) != cost:
+                raise Exception('cost from cache %s is not the one simulated %s' % (cost, costs))
+    return [cache.hits, cache.misses]
+
+
+def test_auto_tune_car_cache(speed_control_def, parameters, bank_scenarios):
+    """
+    Returns True if an AutoTuneCar episode read from the cache has the same cost (and costs per scenario) than the one
+    simulated
+    """
+    import CarControl as cc
+    import scenario as sc
+
+    cache   = ResultCache(directory=os.path.join(tempfile.gettempdir(), 'test_auto_tune_car_cache'))
+    cache.clear()
+    bank    = sc.ScenarioBank.generate(bank_scenarios, 301, slopes=(-5.0, 5.0), slope_changes=2) \
+        if bank_scenarios > 0 else None
+    results = []
+    for _ in range(2):
+        control   = cc.CarSpeedControl(5.0, speed_control_def)
+        auto_tune = cc.AutoTuneCar('simple', control, 2, [[0, 5.0], [150, 2.0]], max_iter=300, bank=bank, cache=cache)
+        results.append([auto_tune.run_function_with_parameters(parameters), auto_tune.last_costs])
+    return results[0] == results[1] and [cache.hits, cache.misses] == [1, 1]
+
+
+def test_keys(parameters1, parameters2, other_code):
+    """
+    Returns True if the keys are the same
+    """
+    cache1 = ResultCache()
+    cache2 = ResultCache(code_files=['CarModel.py'] if other_code else simulation_files)
+    return cache1.get_key('episode', parameters1) == cache2.get_key('episode', parameters2)
+
+
+def test_eviction(results, result_size, max_bytes):
+    """
+    Returns True if the size in disk is kept below max_bytes and the last results are kept
+    """
+    cache = ResultCache(directory=os.path.join(tempfile.gettempdir(), 'test_eviction'), max_bytes=max_bytes)
+    cache.clear()
+    for i in range(results):
+        cache.put(cache.get_key(i), bytes(result_size))
+        time.sleep(0.001)  # so each one has a different use time
+    return cache.get_disk_size() <= max_bytes and cache.get(cache.get_key(results - 1)) is not None
+
+
+def test_telemetry(steps, min_ratio):
+    """
+    Returns [True if the telemetry saved is the same, True if it is compressed at least min_ratio times]
+    """
+    import telemetry
+
+    recorder = telemetry.TelemetryRecorder()
+    for i in range(steps):
+        recorder.record(0.1*i, {'speed': round(0.01*i, 2), 'brake': 0.0, 'accelerator': 10.0*(i % 5)})
+    cache    = ResultCache(directory=os.path.join(tempfile.gettempdir(), 'test_telemetry_cache'))
+    cache.clear()
+    key      = cache.get_key('telemetry', steps)
+    cache.put(key, {'cost': 1.0}, telemetry=recorder.as_dict())
+    saved    = cache.get_telemetry(key)
+    same     = all(np.array_equal(saved[name], values) for name, values in recorder.as_dict().items())
+    ratio    = recorder.data[:, :len(recorder)].nbytes/cache.get_disk_size()
+    print('   compression ratio: %.1f' % ratio)
+    return [same, ratio >= min_ratio]
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/result_cache.test', '')
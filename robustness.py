@@ -0,0 +1,229 @@
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+
+import scenario as sc
+import unit_test as ut
+
+
+class Envelope:
+    """
+    Operating envelope the robustness episodes are sampled from, every range is [min, max] and sampled uniformly
+    """
+
+    k_car_name     = 'car_name'
+    k_output_lag   = 'output_lag'
+    k_sensor_noise = 'sensor_noise'
+    k_events       = 'events'
+    k_seed         = 'seed'
+
+    def __init__(self, slopes=(0.0, 0.0), slope_changes=0, output_lags=(0, 0), car_names=('simple',),
+                 sensor_noise=(0.0, 0.0), disturbances=(0.0, 0.0), disturbance_changes=0):
+        """
+        :param slopes:              slope range (in degrees)
+        :param slope_changes:       number of slope changes in each episode (at random steps)
+        :param output_lags:         output lag range (in steps)
+        :param car_names:           car types (see cars/cars_definition.yaml), one chosen at random
+        :param sensor_noise:        range of the standard deviation of the sensors noise
+        :param disturbances:        range of the external acceleration (i.e. wind)
+        :param disturbance_changes: number of disturbance changes in each episode (at random steps)
+        """
+        self.slopes              = slopes
+        self.slope_changes       = slope_changes
+        self.output_lags         = output_lags
+        self.car_names           = list(car_names)
+        self.sensor_noise        = sensor_noise
+        self.disturbances        = disturbances
+        self.disturbance_changes = disturbance_changes
+
+    def sample(self, rng, steps):
+        """
+        Returns the definition of a random episode (a dict, so it can be sent to other processes)
+        :param rng:   numpy random Generator
+        :param steps: episode length
+        """
+        events  = [[int(step), sc.Scenario.k_slope, None, float(rng.uniform(*self.slopes))]
+                   for step in rng.integers(0, steps, self.slope_changes)]
+        events += [[int(step), sc.Scenario.k_disturbance, None, float(rng.uniform(*self.disturbances))]
+                   for step in rng.integers(0, steps, self.disturbance_changes)]
+        return {self.k_car_name:     self.car_names[rng.integers(len(self.car_names))],
+                self.k_output_lag:   int(rng.integers(self.output_lags[0], self.output_lags[1] + 1)),
+                self.k_sensor_noise: float(rng.uniform(*self.sensor_noise)),
+                self.k_events:       events,
+                self.k_seed:         int(rng.integers(2**31))}
+
+
+class RobustnessStats:
+    """
+    Costs of the episodes run so far, with their distribution and failure rate
+    """
+
+    def __init__(self, episodes, max_final_error):
+        self.costs           = np.full(episodes, np.nan)
+        self.final_errors    = np.full(episodes, np.nan)
+        self.done            = np.zeros(episodes, dtype=bool)
+        self.max_final_error = max_final_error
+
+    def add(self, results):
+        """
+        :param results: list of [episode index, cost, final error]
+        """
+        for [i, cost, final_error] in results:
+            self.costs[i]        = cost
+            self.final_errors[i] = final_error
+            self.done[i]         = True
+
+    def episodes_done(self):
+        return int(np.count_nonzero(self.done))
+
+    def get_failed(self):
+        """
+        Returns a boolean array with the episodes done that failed: the error at the end is greater than max_final_error
+        (or it is not a number)
+        """
+        final_errors = self.final_errors[self.done]
+        return ~(np.abs(final_errors) <= self.max_final_error)
+
+    def failure_rate(self):
+        return float(np.mean(self.get_failed())) if self.episodes_done() > 0 else 0.0
+
+    def percentiles(self, percentiles=(5, 50, 95)):
+        """
+        Returns the cost percentiles of the episodes done that did not fail
+        """
+        costs = self.costs[self.done][~self.get_failed()]
+        return np.percentile(costs, percentiles).tolist() if len(costs) > 0 else [np.nan for _ in percentiles]
+
+    def summary_string(self, percentiles=(5, 50, 95)):
+        values = ' '.join('p%s:%.3f' % (p, v) for p, v in zip(percentiles, self.percentiles(percentiles)))
+        return 'episodes:%s %s failed:%.1f%%' % (self.episodes_done(), values, 100*self.failure_rate())
+
+
+def iter_robustness(file_name, dir_name, envelope, episodes, base_scenario=None, parameters=None, steps=500, dt=0.1,
+                    reference_name='ref_speed', sensor_name='speed', max_final_error=0.5, seed=0, processes=None,
+                    batch_size=20):
+    """
+    Runs a hierarchy in many car episodes sampled from an envelope, using a pool of processes
+    The episodes are sampled before running them, so results do not depend on the number of processes
+    :param file_name:       hierarchy definition
+    :param dir_name:
+    :param envelope:        Envelope
+    :param episodes:        number of episodes
+    :param base_scenario:   scenario.Scenario (or its file name) with the reference changes, the sampled events are
+                            added
+    :param parameters:      dict with values that replace the ones in the hierarchy definition
+    :param steps:
+    :param dt:
+    :param reference_name:  reference and sensor used to calculate the cost (sum of abs(reference - sensor)*dt)
+    :param sensor_name:
+    :param max_final_error: an episode fails if the mean error in its last 10% steps is greater
+    :param seed:            seed of the sampling
+    :param processes:       number of processes, None means one per cpu, 0 or 1 means run in this process
+    :param batch_size:      episodes sent to a process at once
+    :return: yields a RobustnessStats (the same one, updated) each time a batch of episodes is done
+    """
+    base_scenario = sc.get_scenario(base_scenario)
+    rng           = np.random.default_rng(seed)
+    specs         = [envelope.sample(rng, steps) for _ in range(episodes)]
+    batches       = [list(range(start, min(start + batch_size, episodes))) for start in range(0, episodes, batch_size)]
+    stats         = RobustnessStats(episodes, max_final_error)
+    arguments     = [file_name, dir_name, parameters, base_scenario, steps, dt, reference_name, sensor_name]
+
+    processes = os.cpu_count() if processes is None else processes
+    if processes <= 1:
+        for batch in batches:
+            stats.add(run_episodes(*arguments, [[i, specs[i]] for i in batch]))
+            yield stats
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(run_episodes, *arguments, [[i, specs[i]] for i in batch]) for batch in batches]
+        for future in concurrent.futures.as_completed(futures):
+            stats.add(future.result())
+            yield stats
+
+
+def run_robustness(file_name, dir_name, envelope, episodes, **kwargs):
+    """
+    Same as iter_robustness but just returns the final RobustnessStats
+    """
+    stats = None
+    for stats in iter_robustness(file_name, dir_name, envelope, episodes, **kwargs):
+        pass
+    return stats
+
+
+def run_episodes(file_name, dir_name, parameters, base_scenario, steps, dt, reference_name, sensor_name, specs):
+    """
+    Runs a batch of episodes (in a worker process), the hierarchy is created once and reset for each episode
+    :param specs: list of [episode index, episode definition (see Envelope.sample)]
+    :return: list of [episode index, cost, final error]
+    """
+    import CarModel as cm
+    import hierarchical_control as hc
+
+    control = hc.HierarchicalControl(file_name, dir_name, initial_parameters=parameters, compiled=True)
+    results = []
+    for [i, spec] in specs:
+        control.reset(initial_parameters=parameters)
+        env = cm.CarEnvironment1(control, car_name=spec[Envelope.k_car_name], output_lag=spec[Envelope.k_output_lag],
+                                 dt=dt, max_steps=steps, channels=[reference_name, sensor_name],
+                                 sensor_noise=spec[Envelope.k_sensor_noise], seed=spec[Envelope.k_seed])
+        env.run_episode(scenario=base_scenario.with_events(spec[Envelope.k_events]))
+        errors      = env.recorder.get_channel(reference_name) - env.recorder.get_channel(sensor_name)
+        cost        = float(np.sum(np.abs(errors))*dt)
+        final_error = float(np.mean(np.abs(errors[-max(len(errors)//10, 1):])))
+        results.append([i, cost, final_error])
+    return results
+
+
+# tests
+def test_robustness(episodes, slope_changes, output_lags, sensor_noise, processes, debug):
+    """
+    Returns the failure rate of the simple speed control in the city scenario, with the given envelope
+    """
+    envelope = Envelope(slopes=(-5.0, 5.0), slope_changes=slope_changes, output_lags=output_lags,
+                        car_names=('simple', 'truck', 'sport'), sensor_noise=(0.0, sensor_noise))
+    stats    = run_robustness('simple_speed_control.yaml', 'cars', envelope, episodes,
+                              base_scenario='city_speed.yaml', processes=processes, batch_size=10)
+    if debug:
+        print('   %s' % stats.summary_string())
+    return round(stats.failure_rate(), 2)
+
+
+def test_same_results(episodes, processes):
+    """
+    Returns True if running the episodes in a pool of processes gives the same costs than in this one
+    """
+    envelope = Envelope(slopes=(-5.0, 5.0), slope_changes=2, output_lags=(0, 4), sensor_noise=(0.0, 0.1),
+                        disturbances=(-1.0, 1.0), disturbance_changes=1)
+    costs    = [run_robustness('simple_speed_control.yaml', 'cars', envelope, episodes, base_scenario='city_speed.yaml',
+                               processes=p, batch_size=3).costs for p in [1, processes]]
+    return np.array_equal(costs[0], costs[1])
+
+
+def test_streaming(episodes, batch_size):
+    """
+    Returns the number of episodes done each time results are given
+    """
+    envelope = Envelope(output_lags=(0, 2))
+    return [stats.episodes_done() for stats in
+            iter_robustness('simple_speed_control.yaml', 'cars', envelope, episodes, base_scenario='city_speed.yaml',
+                            processes=1, batch_size=batch_size)]
+
+
+def test_episodes_per_second(episodes, processes):
+    envelope = Envelope(slopes=(-5.0, 5.0), slope_changes=3, output_lags=(0, 4), car_names=('simple', 'truck'),
+                        sensor_noise=(0.0, 0.05))
+    start    = time.perf_counter()
+    stats    = run_robustness('simple_speed_control.yaml', 'cars', envelope, episodes, base_scenario='city_speed.yaml',
+                              processes=processes)
+    elapsed  = time.perf_counter() - start
+    print('   %s' % stats.summary_string())
+    return round(episodes/elapsed)
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/robustness.test', '')
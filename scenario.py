@@ -0,0 +1,388 @@
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import yaml_functions as yf
+import unit_test as ut
+
+
+class Scenario:
+    """
+    Changes made to an episode at given steps (references, slope, disturbances and output lag), compiled once so the
+    environments get the events of each step with just one lookup instead of scanning all the changes in every step
+    It can be defined in a YAML file (see load_scenario), as:
+        general:
+          steps: 500     # episode length (optional)
+        events:
+          - event:
+              step:  0
+              type:  reference   # one of: reference, slope, disturbance, lag
+              name:  ref_speed   # optional, which reference (or observation for a disturbance) is changed
+              value: 5.0
+    """
+
+    k_general     = 'general'
+    k_name        = 'name'
+    k_steps       = 'steps'
+    k_events      = 'events'
+    k_event       = 'event'
+    k_step        = 'step'
+    k_type        = 'type'
+    k_value       = 'value'
+
+    # event types
+    k_reference   = 'reference'
+    k_slope       = 'slope'
+    k_disturbance = 'disturbance'
+    k_lag         = 'lag'
+    valid_types   = [k_reference, k_slope, k_disturbance, k_lag]
+
+    def __init__(self, events=(), steps=None, name=''):
+        """
+        :param events: list of [step, type, name, value] (name can be None)
+        :param steps:  episode length, None if not defined
+        :param name:
+        """
+        for [_, event_type, _, _] in events:
+            if event_type not in self.valid_types:
+                raise Exception('Event type "%s" not known, must be one of %s' % (event_type, self.valid_types))
+        events     = sorted(events, key=lambda event: event[0])  # stable, so events in the same step keep their order
+        self.name  = name
+        self.steps = steps
+
+        # sorted event arrays
+        self.event_steps  = np.array([event[0] for event in events], dtype=int)
+        self.event_types  = [event[1] for event in events]
+        self.event_names  = [event[2] for event in events]
+        self.event_values = np.array([event[3] for event in events], dtype=float)
+
+        # per step lookup: step -> [[type, name, value], ...]
+        self.events_by_step = {}
+        for [step, event_type, name, value] in events:
+            self.events_by_step.setdefault(step, []).append([event_type, name, value])
+
+    def __len__(self):
+        return len(self.event_types)
+
+    def get_events(self, step):
+        """
+        Returns the events of a step as a list of [type, name, value] (empty if none)
+        """
+        return self.events_by_step.get(step, ())
+
+    def get_profile(self, event_type, steps=None, initial=0.0, name=None):
+        """
+        Returns the value in effect at each step (as set by the last event of the given type before or at that step)
+        :param event_type:
+        :param steps:      number of steps, None means the scenario ones
+        :param initial:    value before the first event
+        :param name:       just the events with this name, None means all of the given type
+        :return: numpy array of length steps
+        """
+        steps    = self.get_steps(steps)
+        selected = [i for i, (t, n) in enumerate(zip(self.event_types, self.event_names))
+                    if t == event_type and (name is None or n == name)]
+        if not selected:
+            return np.full(steps, float(initial))
+        event_values = self.event_values[selected]
+        last_event   = np.searchsorted(self.event_steps[selected], np.arange(steps), side='right') - 1
+        return np.where(last_event >= 0, event_values[np.maximum(last_event, 0)], initial)
+
+    def get_event_list(self):
+        """
+        Returns the events as a list of [step, type, name, value], sorted by step
+        """
+        return [[int(step), event_type, name, float(value)] for step, event_type, name, value in
+                zip(self.event_steps, self.event_types, self.event_names, self.event_values)]
+
+    def with_events(self, events):
+        """
+        Returns a new scenario with these events plus the given ones (list of [step, type, name, value])
+        """
+        return Scenario(self.get_event_list() + list(events), steps=self.steps, name=self.name)
+
+    def get_steps(self, steps=None):
+        if steps is not None:
+            return steps
+        if self.steps is None:
+            raise Exception('Scenario "%s" does not define its steps, they must be given' % self.name)
+        return self.steps
+
+    @classmethod
+    def from_definition(cls, definition, name=''):
+        general = definition.get(cls.k_general, {}) or {}
+        events  = [[event[cls.k_step], event[cls.k_type], event.get(cls.k_name, None), event[cls.k_value]]
+                   for event in [item[cls.k_event] for item in definition.get(cls.k_events, []) or []]]
+        return cls(events, steps=general.get(cls.k_steps, None), name=general.get(cls.k_name, name))
+
+    @classmethod
+    def from_changes(cls, reference_changes=(), slope_changes=(), steps=None):
+        """
+        Returns the scenario equivalent to the lists of changes used before scenarios existed
+        :param reference_changes: list of [step, reference] or [step, reference name, reference]
+        :param slope_changes:     list of [step, slope]
+        :param steps:
+        """
+        events  = [[change[0], cls.k_reference, change[1] if len(change) > 2 else None, change[-1]]
+                   for change in reference_changes]
+        events += [[step, cls.k_slope, None, slope] for [step, slope] in slope_changes]
+        return cls(events, steps=steps)
+
+
+def load_scenario(file_name, directory='scenarios'):
+    return Scenario.from_definition(yf.get_yaml_file(file_name, directory=directory), name=file_name)
+
+
+def get_scenario(scenario=None, reference_changes=(), slope_changes=()):
+    """
+    Returns the scenario given (a Scenario or a file name in scenarios) or, if None, the one made with the changes
+    """
+    if scenario is None:
+        return Scenario.from_changes(reference_changes=reference_changes, slope_changes=slope_changes)
+    if isinstance(scenario, str):
+        return load_scenario(scenario)
+    return scenario
+
+
+def batch_profiles(scenarios, event_type, steps, initial=0.0, name=None):
+    """
+    Returns the profiles (see Scenario.get_profile) of many scenarios as one array, one row per scenario, i.e. to run
+    them all at once in a vectorized environment
+    """
+    return np.stack([scenario.get_profile(event_type, steps=steps, initial=initial, name=name)
+                     for scenario in scenarios])
+
+
+class ScenarioBank:
+    """
+    A set of random scenarios generated once (with a seed) and kept as arrays, so every candidate of a tuning is
+    evaluated with exactly the same ones (common random numbers): the differences between candidates costs are then
+    due to the candidates, not to the scenarios drawn, and far fewer episodes are needed to compare them (see
+    paired_comparison)
+    Arrays (first dimension is the scenario):
+        * seeds:          to reset environments that have their own randomness (i.e. gymnasium ones)
+        * initial_states: initial values of the observation (scenarios x state values)
+        * slopes:         slope in each step (scenarios x steps)
+        * noise:          noise added to the sensors (scenarios x steps x sensors)
+    """
+
+    k_arrays = ['seeds', 'initial_states', 'slopes', 'noise']
+
+    def __init__(self, seeds, initial_states, slopes, noise):
+        self.seeds          = np.asarray(seeds, dtype=np.int64)
+        self.initial_states = np.asarray(initial_states, dtype=float)
+        self.slopes         = np.asarray(slopes, dtype=float)
+        self.noise          = np.asarray(noise, dtype=float)
+
+    @classmethod
+    def generate(cls, scenarios, steps, seed=0, initial_ranges=(), slopes=(0.0, 0.0), slope_changes=0,
+                 sensor_noise=0.0, sensors=3):
+        """
+        :param scenarios:      number of scenarios
+        :param steps:          steps of each scenario
+        :param seed:
+        :param initial_ranges: list of [min, max], one per observation value
+        :param slopes:         slope range (in degrees)
+        :param slope_changes:  number of slope changes (at random steps) in each scenario
+        :param sensor_noise:   standard deviation of the sensors noise
+        :param sensors:        number of sensors with noise
+        """
+        rng            = np.random.default_rng(seed)
+        seeds          = rng.integers(2**31, size=scenarios)
+        initial_states = np.stack([rng.uniform(low, high, scenarios) for [low, high] in initial_ranges], axis=1) \
+            if initial_ranges else np.zeros((scenarios, 0))
+        profiles       = np.zeros((scenarios, steps))
+        for profile in profiles:
+            for step in np.sort(rng.integers(0, steps, slope_changes)):
+                profile[step:] = rng.uniform(*slopes)
+        noise          = rng.normal(0.0, sensor_noise, (scenarios, steps, sensors)) if sensor_noise > 0.0 \
+            else np.zeros((scenarios, steps, sensors))
+        return cls(seeds, initial_states, profiles, noise)
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def save(self, file_name):
+        np.savez(file_name, **{name: getattr(self, name) for name in self.k_arrays})
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as arrays:
+            return cls(*[arrays[name] for name in cls.k_arrays])
+
+    def get_scenario(self, i, base=None):
+        """
+        Returns scenario i as a Scenario: the base one (its file name or a Scenario, i.e. with the reference changes)
+        plus the slope changes
+        """
+        profile = self.slopes[i]
+        changes = np.flatnonzero(np.diff(profile, prepend=0.0))
+        return get_scenario(base).with_events([[int(step), Scenario.k_slope, None, float(profile[step])]
+                                              for step in changes])
+
+    def get_initial_values(self, i):
+        """
+        Returns the initial state of scenario i as a list of [observation index, value]
+        """
+        return [[j, float(value)] for j, value in enumerate(self.initial_states[i])]
+
+    def get_noise(self, i):
+        return self.noise[i] if np.any(self.noise[i]) else None
+
+    def get_seed(self, i):
+        return int(self.seeds[i])
+
+
+def paired_comparison(costs_a, costs_b):
+    """
+    Compares the costs of two candidates evaluated in the same scenarios
+    :return: dict with the mean difference (a - b), its standard error using the pairs and the one it would have with
+             independent scenarios (the ratio between both is the variance reduction obtained)
+    """
+    costs_a     = np.asarray(costs_a, dtype=float)
+    costs_b     = np.asarray(costs_b, dtype=float)
+    n           = len(costs_a)
+    differences = costs_a - costs_b
+    return {'mean_difference':       float(np.mean(differences)),
+            'std_error':             float(np.std(differences, ddof=1)/math.sqrt(n)) if n > 1 else np.nan,
+            'independent_std_error': float(math.sqrt((np.var(costs_a, ddof=1) + np.var(costs_b, ddof=1))/n))
+            if n > 1 else np.nan}
+
+
+# tests
+def test_profile(file_name, event_type, name, initial, at_steps):
+    """
+    Returns the value in effect at the given steps
+    """
+    scenario = load_scenario(file_name)
+    profile  = scenario.get_profile(event_type, initial=initial, name=name)
+    return [float(profile[step]) for step in at_steps]
+
+
+def test_batch(file_names, event_type, steps):
+    scenarios = [load_scenario(file_name) for file_name in file_names]
+    return list(batch_profiles(scenarios, event_type, steps).shape)
+
+
+def test_same_as_changes(file_name, reference_changes, slope_changes, steps):
+    """
+    Returns True if running a car with a scenario file gives the same values as with the equivalent lists of changes
+    """
+    import CarModel as cm
+    import hierarchical_control as hc
+
+    records = []
+    for scenario in [None, file_name]:
+        env = cm.CarEnvironment1(hc.HierarchicalControl('simple_speed_control.yaml', 'cars', compiled=True),
+                                 output_lag=2, max_steps=steps)
+        env.run_episode(reference_changes=reference_changes, slope_changes=slope_changes, scenario=scenario)
+        records.append(env.recorder.get_records())
+    return records[0] == records[1]
+
+
+def test_step_response(r, d, times, dt, control_params, changes):
+    """
+    Returns the last perception of a step response where the reference changes
+    """
+    import ControlUnit as cu
+
+    scenario = Scenario([[step, Scenario.k_reference, None, value] for [step, value] in changes])
+    control  = cu.create_control(control_params)
+    p_last   = 0.0
+    for [p, _] in cu.step_response_values(r, d, times, dt, False, control, scenario=scenario):
+        p_last = p
+    return p_last
+
+
+def test_step_response_events(event_type):
+    """
+    Returns True if a scenario with an event of this type can be used in a step response (if not it raises)
+    """
+    import ControlUnit as cu
+
+    scenario = Scenario([[10, event_type, None, 1.0]])
+    control  = cu.create_control({'type': 'P', 'gain': 1.0})
+    try:
+        list(cu.step_response_values(0.0, 0.0, 20, 0.1, False, control, scenario=scenario))
+    except Exception:
+        return False
+    return True
+
+
+def test_lookup_speedup(events, steps):
+    """
+    Returns how many times getting the events of each step is faster than scanning the lists of changes
+    """
+    reference_changes = [[i*steps//events, 'ref_speed', float(i)] for i in range(events)]
+    scenario          = Scenario.from_changes(reference_changes=reference_changes)
+    start   = time.perf_counter()
+    scanned = 0
+    for step in range(steps):
+        for [i, _, value] in reference_changes:
+            if i == step:
+                scanned += 1
+    scan_time = time.perf_counter() - start
+    start     = time.perf_counter()
+    found     = 0
+    for step in range(steps):
+        for _ in scenario.get_events(step):
+            found += 1
+    lookup_time = time.perf_counter() - start
+    if found != scanned:
+        raise Exception('Lookup found %s events, scan %s' % (found, scanned))
+    return round(scan_time/lookup_time)
+
+
+def test_bank_round_trip(scenarios, steps, slope_changes, sensor_noise):
+    """
+    Returns True if a saved bank is loaded with the same values, and generating it again with the same seed too
+    """
+    bank      = ScenarioBank.generate(scenarios, steps, seed=3, initial_ranges=[[-0.05, 0.05], [-0.1, 0.1]],
+                                      slopes=(-5.0, 5.0), slope_changes=slope_changes, sensor_noise=sensor_noise)
+    file_name = os.path.join(tempfile.gettempdir(), 'test_bank.npz')
+    bank.save(file_name)
+    loaded    = ScenarioBank.load(file_name)
+    again     = ScenarioBank.generate(scenarios, steps, seed=3, initial_ranges=[[-0.05, 0.05], [-0.1, 0.1]],
+                                      slopes=(-5.0, 5.0), slope_changes=slope_changes, sensor_noise=sensor_noise)
+    return all(np.array_equal(getattr(bank, name), getattr(other, name)) for name in ScenarioBank.k_arrays
+               for other in [loaded, again])
+
+
+def bank_costs(bank, parameters, steps):
+    """
+    Returns the cost of the simple speed control (with the given parameters) in each scenario of the bank
+    """
+    import CarModel as cm
+    import hierarchical_control as hc
+
+    control = hc.HierarchicalControl('simple_speed_control.yaml', 'cars', initial_parameters=parameters, compiled=True)
+    costs   = []
+    for i in range(len(bank)):
+        control.reset(initial_parameters=parameters)
+        env = cm.CarEnvironment1(control, output_lag=2, max_steps=steps, channels=['ref_speed', 'speed'])
+        env.run_episode(scenario=bank.get_scenario(i, base='city_speed.yaml'), noise=bank.get_noise(i))
+        costs.append(float(np.sum(np.abs(env.recorder.get_channel('ref_speed') - env.recorder.get_channel('speed')))))
+    return costs
+
+
+def test_common_random_numbers(scenarios, steps, parameters_a, parameters_b, debug):
+    """
+    Returns True if comparing two candidates with the same scenarios has less error than with different ones, and the
+    same candidate evaluated twice gets the same costs
+    """
+    bank    = ScenarioBank.generate(scenarios, steps, seed=1, slopes=(-8.0, 8.0), slope_changes=3, sensor_noise=0.05)
+    other   = ScenarioBank.generate(scenarios, steps, seed=2, slopes=(-8.0, 8.0), slope_changes=3, sensor_noise=0.05)
+    costs_a = bank_costs(bank, parameters_a, steps)
+    paired  = paired_comparison(costs_a, bank_costs(bank, parameters_b, steps))
+    apart   = paired_comparison(costs_a, bank_costs(other, parameters_b, steps))
+    if debug:
+        print('   paired: %s' % paired)
+        print('   independent scenarios: %s' % apart)
+    return paired['std_error'] < apart['std_error'] and costs_a == bank_costs(bank, parameters_a, steps)
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/scenario.test', '')
@@ -1,19 +1,42 @@
+import math
+import random
+import time
 from collections import deque
+import numpy as np
 import unit_test as ut
 
+array_min_length = 64  # from this length create_signal_history returns an ArraySignalHistory
+
 
 class SignalHistory(object):
     """
     Store the last N values of a Signal
+    Note: sum/average, min and max are kept updated on each append (so they are O(1)) but only after the first time
+          each one is asked for, so histories never aggregated (i.e. DelayedSignal) do not pay for it
     """
 
+    __slots__ = ('length', 'values', 'count', 'running_sum', 'appends_since_resum', 'min_values', 'max_values')
+
     def __init__(self, length=10):
-        self.length = length + 1
-        self.values = None  # just to avoid warnings
+        self.length              = length + 1
+        self.values              = None  # just to avoid warnings
+        self.count               = 0     # values appended since reset, used as index in min_values and max_values
+        self.running_sum         = None  # None while sum is not tracked
+        self.appends_since_resum = 0     # the running sum is recalculated every length appends to avoid float drift
+        self.min_values          = None  # [index, value] increasing, first one is the min (None while not tracked)
+        self.max_values          = None  # [index, value] decreasing, first one is the max (None while not tracked)
         self.reset()
 
     def reset(self):
-        self.values = deque(maxlen=self.length)
+        self.values              = self.new_values()
+        self.count               = 0
+        self.running_sum         = None
+        self.appends_since_resum = 0
+        self.min_values          = None
+        self.max_values          = None
+
+    def new_values(self):
+        return deque(maxlen=self.length)
 
     def get_len(self):
         return self.length
@@ -29,19 +52,44 @@ class SignalHistory(object):
         self.reset()
 
     def append(self, value):
+        if self.running_sum is not None:
+            if len(self.values) == self.length:
+                self.running_sum -= self.values[0]
+            self.running_sum         += value
+            self.appends_since_resum += 1
+        self.append_value(value)
+        if self.appends_since_resum >= self.length:
+            self.resum()
+        if self.min_values is not None:
+            self.append_min(self.count, value)
+        if self.max_values is not None:
+            self.append_max(self.count, value)
+        self.count += 1
+
+    def append_value(self, value):
         self.values.append(value)
 
     def update(self, value):
         """
         Change the last value
+        Note: min and max have to be recalculated after it (the next time they are asked for)
         :param value:
         :return:
         """
         # print 'before:%s v:%s' %(self.values, value)
-        self.values.pop()
-        self.values.append(value)
+        old_value = self.replace_last(value)
+        if self.running_sum is not None:
+            self.running_sum += value - old_value
+        self.min_values = None
+        self.max_values = None
         # print 'after:%s' %(self.values)
 
+    def replace_last(self, value):
+        # changes the last value and returns the old one
+        old_value = self.values.pop()
+        self.values.append(value)
+        return old_value
+
     def load(self, values):
         """
         Bulk store values. Used to load from telemetry
@@ -50,7 +98,7 @@ class SignalHistory(object):
         """
         self.reset()
         for value in values:
-            self.values.append(value)
+            self.append(value)
 
     def is_full(self):
         return len(self.values) >= self.length
@@ -104,14 +152,51 @@ class SignalHistory(object):
             return 0
 
     def min(self):
-        return min(self.values)
+        if len(self.values) == 0:
+            return min(self.values)  # same error as before
+        if self.min_values is None:
+            self.min_values = deque()
+            for i, value in enumerate(self.values, self.count - len(self.values)):
+                self.append_min(i, value)
+        return self.min_values[0][1]
 
     def max(self):
-        return max(self.values)
+        if len(self.values) == 0:
+            return max(self.values)
+        if self.max_values is None:
+            self.max_values = deque()
+            for i, value in enumerate(self.values, self.count - len(self.values)):
+                self.append_max(i, value)
+        return self.max_values[0][1]
 
     def sum(self):
-        # To Do: optimize to have the sum pre-calculated in every update
-        return sum(self.values)
+        if self.running_sum is None:
+            self.resum()
+        elif not math.isfinite(self.running_sum):
+            return sum(self.values)  # inf or nan values, they can not be subtracted when they leave the history
+        return self.running_sum
+
+    def resum(self):
+        # starts (or restarts) the running sum from the current values
+        self.running_sum         = math.fsum(self.values)
+        self.appends_since_resum = 0
+
+    def append_min(self, index, value):
+        # keeps min_values increasing with just the values that can be the min when older ones leave the history
+        min_values = self.min_values
+        while min_values and min_values[-1][1] >= value:
+            min_values.pop()
+        min_values.append((index, value))
+        if min_values[0][0] <= index - self.length:
+            min_values.popleft()
+
+    def append_max(self, index, value):
+        max_values = self.max_values
+        while max_values and max_values[-1][1] <= value:
+            max_values.pop()
+        max_values.append((index, value))
+        if max_values[0][0] <= index - self.length:
+            max_values.popleft()
 
     def weighted_sum(self, weights, lifo_order=True):
         function = self.get_items_in_lifo_order if lifo_order else self.get_items_in_fifo_order
@@ -154,12 +239,111 @@ class SignalHistory(object):
 ###
 
 
+class ArraySignalHistory(SignalHistory):
+    """
+    SignalHistory stored in a numpy ring buffer, for long histories (i.e. past errors in adaptive control units)
+    values is always a view (not a copy) of the stored values in FIFO order, so weighted_sum is a dot product and
+    the derivative based methods use np.diff
+    Note: each value is stored twice (at i and i + length) so the stored values are always contiguous
+    """
+
+    __slots__ = ('buffer', 'start')
+
+    def __init__(self, length=10):
+        self.buffer = None  # just to avoid warnings
+        self.start  = 0     # buffer index of the oldest value
+        super(ArraySignalHistory, self).__init__(length)
+
+    def new_values(self):
+        self.buffer = np.zeros(2*self.length)
+        self.start  = 0
+        return self.buffer[0:0]
+
+    def append_value(self, value):
+        size = len(self.values)
+        i    = (self.start + size) % self.length
+        self.buffer[i]               = value
+        self.buffer[i + self.length] = value
+        if size < self.length:
+            size += 1
+        else:
+            self.start = (self.start + 1) % self.length
+        self.values = self.buffer[self.start:self.start + size]
+
+    def replace_last(self, value):
+        i         = (self.start + len(self.values) - 1) % self.length
+        old_value = self.buffer[i]
+        self.buffer[i]               = value
+        self.buffer[i + self.length] = value
+        return old_value
+
+    def load(self, values):
+        """
+        Bulk store values (just the last length ones). Used to load from telemetry
+        :param values: any sequence of numbers (i.e. a numpy array)
+        :return:
+        """
+        self.reset()
+        values = np.asarray(values, dtype=float)
+        stored = values[len(values) - self.length:] if len(values) > self.length else values
+        self.buffer[:len(stored)]                          = stored
+        self.buffer[self.length:self.length + len(stored)] = stored
+        self.values = self.buffer[:len(stored)]
+        self.count  = len(values)
+
+    def get_fifo_view(self):
+        return self.values
+
+    def get_lifo_view(self):
+        return self.values[::-1]
+
+    def get_items_in_lifo_order(self):
+        return iter(self.values[::-1].tolist())
+
+    def get_items_in_fifo_order(self):
+        return iter(self.values.tolist())
+
+    def last(self):
+        return float(self.values[-1])
+
+    def weighted_sum(self, weights, lifo_order=True):
+        values = self.values[::-1] if lifo_order else self.values
+        return float(np.dot(weights[:len(values)], values))
+
+    def local_optimum_points(self):
+        dif     = 0.1
+        d       = np.diff(self.values)
+        d1      = d[:-1]
+        d2      = d[1:]
+        is_max  = (d2 < -dif) & (d1 > dif)
+        is_min  = ~(d2 < -dif) & (d1 < -dif)
+        values  = self.values.tolist()
+        return [(i + 2, values[i + 1], 1 if is_max[i] else -1) for i in np.flatnonzero(is_max | is_min).tolist()]
+
+    def changed_derivative(self):
+        return bool(np.any(np.abs(np.diff(self.values, 2)) > 0.1))
+
+
+def create_signal_history(length=10, array=None):
+    """
+    Returns a SignalHistory
+    :param length:
+    :param array:  True for an ArraySignalHistory, None to use one only if length is at least array_min_length
+    :return:
+    """
+    if array is None:
+        array = length >= array_min_length
+    return ArraySignalHistory(length) if array else SignalHistory(length)
+
+
 class DelayedSignal(SignalHistory):
     """
     Returns a delayed value of a signal
         Parameter: number of cycles of delay
     """
 
+    __slots__ = ()
+
     def __init__(self, delay=1):
         super(DelayedSignal, self).__init__(delay)
 
@@ -239,5 +423,126 @@ def test_get_in_lifo_order(values):
     return [v1 for v1 in signal.get_items_in_lifo_order()]
 
 
+def test_aggregates(length, steps, update_every, seed=1):
+    """
+    Returns True if sum, average, min and max (kept updated on each append) are the same as calculating them from all
+    the values
+    """
+    random.seed(seed)
+    signal = SignalHistory(length)
+    for step in range(steps):
+        value = random.uniform(-10.0, 10.0)
+        if update_every > 0 and step % update_every == 0 and signal.values:
+            signal.update(value)
+        else:
+            signal.append(value)
+        if not (math.isclose(signal.sum(), sum(signal.values), abs_tol=1e-9) and
+                math.isclose(signal.average(), sum(signal.values)/len(signal.values), abs_tol=1e-9) and
+                signal.min() == min(signal.values) and signal.max() == max(signal.values)):
+            print('   step %s: sum %s min %s max %s' % (step, signal.sum(), signal.min(), signal.max()))
+            return False
+    return True
+
+
+def test_load(length, loaded, appended):
+    """
+    Returns True if a history loaded with values (then appended) has the same values, count and aggregates as one
+    where they were all appended
+    """
+    loaded_signal   = SignalHistory(length)
+    appended_signal = SignalHistory(length)
+    loaded_signal.load(loaded)
+    for value in loaded:
+        appended_signal.append(value)
+    for value in appended:
+        loaded_signal.append(value)
+        appended_signal.append(value)
+    return list(loaded_signal.values) == list(appended_signal.values) and \
+        loaded_signal.count == appended_signal.count and \
+        [loaded_signal.sum(), loaded_signal.min(), loaded_signal.max()] == \
+        [appended_signal.sum(), appended_signal.min(), appended_signal.max()]
+
+
+def test_sum_drift(length, steps, seed=1):
+    """
+    Returns the difference between the running sum and the exact one after many appends of values with very
+    different magnitudes
+    """
+    random.seed(seed)
+    signal = SignalHistory(length)
+    signal.sum()
+    for _ in range(steps):
+        signal.append(random.choice([1e8, 1.0, 1e-8])*random.uniform(-1.0, 1.0))
+    return abs(signal.sum() - math.fsum(signal.values))
+
+
+def test_aggregates_speedup(length, steps):
+    """
+    Prints how many times faster is asking for sum, min and max on each append than calculating them from all values
+    """
+    values = [math.sin(i/10.0) for i in range(steps)]
+    times  = []
+    for running in [False, True]:
+        signal = SignalHistory(length)
+        start  = time.perf_counter()
+        for value in values:
+            signal.append(value)
+            if running:
+                signal.sum(), signal.min(), signal.max()
+            else:
+                sum(signal.values), min(signal.values), max(signal.values)
+        times.append(time.perf_counter() - start)
+    print('   length %s: %.1f times faster' % (length, times[0]/times[1]))
+
+
+def test_array_history(length, steps, update_every, seed=1):
+    """
+    Returns True if an ArraySignalHistory gives the same results as a SignalHistory with the same values
+    """
+    random.seed(seed)
+    signal  = SignalHistory(length)
+    array   = ArraySignalHistory(length)
+    weights = [random.uniform(-1.0, 1.0) for _ in range(length + 1)]
+    for step in range(steps):
+        value = round(random.uniform(-1.0, 1.0), 1)
+        if update_every > 0 and step % update_every == 0 and len(signal.values) > 0:
+            signal.update(value)
+            array.update(value)
+        else:
+            signal.append(value)
+            array.append(value)
+        results = [(list(s.get_items_in_fifo_order()), list(s.get_items_in_lifo_order()), s.is_full(), s.last(),
+                    s.min(), s.max(), s.local_optimum_points(), s.changed_derivative()) for s in [signal, array]]
+        if results[0] != results[1] or \
+                not math.isclose(signal.average(), array.average(), abs_tol=1e-9) or \
+                not math.isclose(signal.weighted_sum(weights), array.weighted_sum(weights), abs_tol=1e-9) or \
+                not math.isclose(signal.weighted_sum(weights, False), array.weighted_sum(weights, False),
+                                 abs_tol=1e-9):
+            print('   step %s:\n      %s\n      %s' % (step, results[0], results[1]))
+            return False
+
+    all_values = [random.uniform(-1.0, 1.0) for _ in range(3*length)]
+    signal.load(all_values)
+    array.load(np.array(all_values))
+    return list(signal.get_items_in_fifo_order()) == list(array.get_items_in_fifo_order()) and \
+        signal.max() == array.max()
+
+
+def test_array_history_speedup(length, steps):
+    """
+    Prints how many times faster is an ArraySignalHistory (appending and getting weighted_sum and changed_derivative)
+    """
+    weights = [1.0/(i + 1) for i in range(length + 1)]
+    times   = []
+    for signal in [SignalHistory(length), ArraySignalHistory(length)]:
+        start = time.perf_counter()
+        for i in range(steps):
+            signal.append(math.sin(i/10.0))
+            signal.weighted_sum(weights)
+            signal.changed_derivative()
+        times.append(time.perf_counter() - start)
+    print('   length %s: %.1f times faster' % (length, times[0]/times[1]))
+
+
 if __name__ == "__main__":
     ut.UnitTest(__name__, 'tests/signals.test', '')
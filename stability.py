@@ -0,0 +1,241 @@
+import numpy as np
+
+import unit_test as ut
+
+# transfer functions are [numerator, denominator], both arrays of coefficients of z^0, z^-1, z^-2, ...
+
+
+class StabilityScreen:
+    """
+    Checks, without simulating, if a linear control unit makes a loop with a known linear plant unstable (a pole of the
+    closed loop outside the unit circle), so auto tune can reject it
+    Only linear units are checked (P, PID, IncrementalPID, PCU and Lineal without bounds, max change nor min error),
+    the integrator windup is assumed not reached
+    """
+
+    k_stable   = 'stable'
+    k_marginal = 'marginal'
+    k_unstable = 'unstable'
+    k_unknown  = 'unknown'
+
+    def __init__(self, plant, tolerance=1e-9):
+        """
+        :param plant:     transfer function of the plant, from the control output to the perception (see
+                          integrator_plant)
+        :param tolerance: poles closer than this to the unit circle are marginal
+        """
+        self.plant     = plant
+        self.tolerance = tolerance
+        self.checked   = 0
+        self.pruned    = 0
+
+    def classify(self, control):
+        """
+        Returns k_stable, k_marginal, k_unstable or k_unknown (the control is not linear)
+        """
+        polynomial = closed_loop_polynomial(control, self.plant)
+        if polynomial is None:
+            return self.k_unknown
+        if jury_stable(polynomial):
+            return self.k_stable
+        return self.k_unstable if max_pole_magnitude(polynomial) > 1.0 + self.tolerance else self.k_marginal
+
+    def is_unstable(self, control):
+        """
+        Returns True if the control (with its current parameters) makes the loop unstable, counting the ones pruned
+        """
+        self.checked += 1
+        unstable      = self.classify(control) == self.k_unstable
+        self.pruned  += 1 if unstable else 0
+        return unstable
+
+    def pruning_rate(self):
+        return self.pruned/self.checked if self.checked > 0 else 0.0
+
+    def summary_string(self):
+        return 'checked:%s pruned:%s (%.1f%%)' % (self.checked, self.pruned, 100*self.pruning_rate())
+
+
+def integrator_plant(dt):
+    """
+    Returns the transfer function of ControlUnit.simple_change_model: p(t+1) = p(t) + o(t)*dt (the disturbance does not
+    change stability)
+    """
+    return [np.array([0.0, dt]), np.array([1.0, -1.0])]
+
+
+def first_order_plant(a, b):
+    """
+    Returns the transfer function of p(t+1) = a*p(t) + b*o(t)
+    """
+    return [np.array([0.0, b]), np.array([1.0, -a])]
+
+
+def is_linear(control):
+    return len(control.bounds) == 0 and control.max_change <= 0.00001 and control.min_error <= 0.0
+
+
+def control_transfer_function(control):
+    """
+    Returns the transfer function of a control unit, from the error to the output, or None if it is not linear
+    """
+    if not is_linear(control):
+        return None
+    transfer_function = linear_transfer_function(control)
+    if transfer_function is None:
+        return None
+    return cancel_integrator([polynomials[0] for polynomials in transfer_function])
+
+
+def linear_transfer_function(control, parameters=None):
+    """
+    Returns the transfer function of a control unit, from the error to the output, ignoring bounds, max change and min
+    error (as for small signals), for many parameter sets at once: numerator and denominator have a row per set (or
+    None if the control type is not linear)
+    :param parameters: dict name (as in control.get_parameters) -> array of values, the ones not given are the ones
+                       of the control
+    """
+    parameters = parameters if parameters is not None else {}
+    sets       = max([np.size(value) for value in parameters.values()] + [1])
+
+    def value(name, default):
+        return np.broadcast_to(np.asarray(parameters.get(name, default), dtype=float), (sets,)).reshape(-1, 1)
+
+    delta = np.array([1.0, -1.0])  # 1 - z^-1
+    if control.type in ['PID', 'P']:
+        k_p        = value(control.kp_key, control.k_p)
+        k_i        = value(control.ki_key, control.k_i)
+        k_i        = np.where(np.abs(k_i) < 0.0001, 0.0, k_i)
+        k_d        = value(control.kd_key, control.k_d)/control.dt if control.dt > control.min_dt else 0.0*k_p
+        integrator = np.ones(1) if control.integrator_length <= 0 else \
+            add(np.ones(1), -np.eye(1, control.integrator_length + 1, control.integrator_length)[0])
+        numerator  = add(add(k_p*delta, k_i*control.dt*integrator), k_d*np.convolve(delta, delta))
+        return [numerator, np.tile(delta, (sets, 1))]
+    if control.type == 'IncrementalPID':
+        numerator = add(add(value(control.kp_key, control.k_p)*delta, value(control.ki_key, control.k_i)),
+                        value(control.kd_key, control.k_d)*np.convolve(delta, delta))
+        return [numerator, np.tile(delta, (sets, 1))]
+    if control.type == 'PCU':
+        kg = value(control.k_g, control.kg)
+        ks = value(control.k_s, control.ks)
+        ks = np.where((0.0 <= ks) & (ks < 0.01), 0.01, np.where((-0.01 < ks) & (ks <= 0.0), -0.01, ks))
+        return [kg/ks, np.hstack([np.ones((sets, 1)), -(1.0 - 1.0/ks)])]
+    if control.type == 'Lineal':
+        return [np.zeros((sets, 1)), np.ones((sets, 1))]  # the output does not depend on the perception
+    return None
+
+
+def cancel_integrator(transfer_function):
+    """
+    Without integral gain the numerator has also the integrator (1 - z^-1) of the denominator, it is removed so it does
+    not become a (marginal) pole of the loop
+    """
+    [numerator, denominator] = transfer_function
+    if abs(np.sum(numerator)) > 1e-12 or abs(np.sum(denominator)) > 1e-12:
+        return transfer_function
+    return [np.cumsum(numerator)[:-1], np.cumsum(denominator)[:-1]]  # divided by 1 - z^-1
+
+
+def perception_filter(control):
+    """
+    Returns the transfer function from the perception to the one used by the control (the predicted one after its lag,
+    see ControlUnit.GenericControlUnit.update)
+    """
+    if control.type in ['PCU', 'Lineal'] or control.lag == 0.0:
+        return [np.ones(1), np.ones(1)]
+    k = control.lag/control.dt
+    return [np.array([1.0 + k, -k]), np.ones(1)]
+
+
+def closed_loop_polynomial(control, plant):
+    """
+    Returns the characteristic polynomial of the loop (coefficients of z^n ... z^0, its roots are the poles) or None if
+    the control is not linear
+    """
+    transfer_function = control_transfer_function(control)
+    if transfer_function is None:
+        return None
+    [c_numerator, c_denominator] = transfer_function
+    [f_numerator, f_denominator] = perception_filter(control)
+    [p_numerator, p_denominator] = plant
+    polynomial = add(np.convolve(np.convolve(c_denominator, f_denominator), p_denominator),
+                     np.convolve(np.convolve(c_numerator, f_numerator), p_numerator))
+    return np.trim_zeros(polynomial)
+
+
+def add(polynomial1, polynomial2):
+    # sum of polynomials in z^-1 (of different length), or of arrays of them (a polynomial per row)
+    length = max(np.shape(polynomial1)[-1], np.shape(polynomial2)[-1])
+    return pad(polynomial1, length) + pad(polynomial2, length)
+
+
+def pad(polynomial, length):
+    polynomial = np.asarray(polynomial, dtype=float)
+    return np.pad(polynomial, [(0, 0)]*(polynomial.ndim - 1) + [(0, length - polynomial.shape[-1])])
+
+
+def jury_stable(polynomial):
+    """
+    Jury (Schur-Cohn) test: returns True if all the roots of the polynomial (coefficients of z^n ... z^0) are inside
+    the unit circle, without calculating them
+    """
+    a = np.trim_zeros(np.asarray(polynomial, dtype=float), 'f')
+    a = np.trim_zeros(a, 'b')  # roots in 0
+    while len(a) > 1:
+        if abs(a[-1]) >= abs(a[0]):
+            return False
+        a = a[0]*a[:-1] - a[-1]*a[::-1][:-1]
+        a = a/np.max(np.abs(a))
+    return len(a) > 0
+
+
+def max_pole_magnitude(polynomial):
+    polynomial = np.trim_zeros(np.asarray(polynomial, dtype=float), 'f')
+    return float(np.max(np.abs(np.roots(polynomial)))) if len(polynomial) > 1 else 0.0
+
+
+# tests
+def test_jury(polynomial):
+    """
+    Returns [Jury test result, True if all the roots are inside the unit circle]
+    """
+    return [jury_stable(polynomial), max_pole_magnitude(polynomial) < 1.0]
+
+
+def test_classify(control_params, dt):
+    import ControlUnit as cu
+
+    return StabilityScreen(integrator_plant(dt)).classify(cu.create_control(control_params))
+
+
+def test_simulated(control_params, dt, steps):
+    """
+    Returns True if the classification agrees with the simulated step response (unstable ones grow without limit)
+    """
+    import ControlUnit as cu
+
+    control = cu.create_control(control_params)
+    status  = StabilityScreen(integrator_plant(dt)).classify(control)
+    values  = [p for [p, _] in cu.step_response_values(1.0, 0.0, steps, dt, False, control)]
+    grows   = not np.isfinite(values[-1]) or abs(values[-1] - 1.0) > 1e3
+    return grows == (status == StabilityScreen.k_unstable)
+
+
+def test_prescreen(control_params, reference, max_iter, debug):
+    """
+    Returns [True if tuning with the screen gives the same parameters, True if some candidates were pruned]
+    """
+    import ControlUnit as cu
+
+    expected  = cu.AutoTuneControl(cu.create_control(control_params), reference=reference,
+                                   max_iter=max_iter).auto_tune()
+    auto_tune = cu.AutoTuneControl(cu.create_control(control_params), reference=reference, max_iter=max_iter,
+                                   prescreen=True)
+    tuned     = auto_tune.auto_tune()
+    if debug:
+        print('   %s' % auto_tune.screen.summary_string())
+    return [all(abs(tuned[name] - expected[name]) < 1e-6 for name in expected), auto_tune.screen.pruned > 0]
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/stability.test', '')
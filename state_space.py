@@ -0,0 +1,635 @@
+import math
+import time
+
+import numpy as np
+
+import CarModel as cm
+import ControlUnit as cu
+import unit_test as ut
+
+k_disturbance = 'disturbance'  # input of the plants (external acceleration or change)
+
+
+class StateSpace:
+    """
+    Discrete linear system:
+        x(k+1) = A*x(k) + B*u(k)
+        y(k)   = C*x(k) + D*u(k)
+    The response to inputs that just change at some steps (i.e. a reference schedule) is calculated with matrix powers,
+    the states of 1, 2, 4, 8... steps at once, instead of step by step
+    """
+
+    def __init__(self, a, b, c, d, state_names=(), input_names=(), output_names=()):
+        self.a            = np.asarray(a, dtype=float)
+        self.b            = np.asarray(b, dtype=float)
+        self.c            = np.asarray(c, dtype=float)
+        self.d            = np.asarray(d, dtype=float)
+        self.state_names  = list(state_names)
+        self.input_names  = list(input_names)
+        self.output_names = list(output_names)
+
+    def step(self, x, u):
+        """
+        Returns [next state, output] of one step
+        """
+        return [self.a @ x + self.b @ u, self.c @ x + self.d @ u]
+
+    def constant_input_states(self, x0, u, steps):
+        """
+        Returns the states from x(0) to x(steps) (steps + 1 rows) while the input is u
+        With z = [x, 1] the system is z(k+1) = M*z(k), so z(k..2k-1) = M^k*z(0..k-1)
+        """
+        n         = len(x0)
+        m         = np.zeros((n + 1, n + 1))
+        m[:n, :n] = self.a
+        m[:n, n]  = self.b @ u
+        m[n, n]   = 1.0
+        states    = np.append(x0, 1.0).reshape(-1, 1)
+        power     = m
+        with np.errstate(over='ignore', invalid='ignore'):  # an unstable system just gives inf or nan
+            while True:
+                states = np.hstack([states, power @ states])
+                if states.shape[1] >= steps + 1:
+                    break
+                power = power @ power
+        return states[:n, :steps + 1].T
+
+    def simulate(self, x0, input_changes, steps):
+        """
+        :param x0:            initial state
+        :param input_changes: [[step, u], ...] sorted, u is the whole input vector used from that step (the first one
+                              must be at step 0)
+        :param steps:
+        :return: [states (steps + 1 x states), inputs (steps x inputs), outputs (steps x outputs)]
+        """
+        if not input_changes or input_changes[0][0] != 0:
+            raise Exception('The inputs at step 0 must be given')
+        states  = [np.asarray(x0, dtype=float).reshape(1, -1)]
+        inputs  = []
+        x       = states[0][0]
+        changes = [[step, np.asarray(u, dtype=float)] for [step, u] in input_changes if step < steps]
+        for i, [step, u] in enumerate(changes):
+            end      = changes[i + 1][0] if i + 1 < len(changes) else steps
+            segment  = self.constant_input_states(x, u, end - step)
+            x        = segment[-1]
+            states.append(segment[1:])
+            inputs.append(np.tile(u, (end - step, 1)))
+        states = np.vstack(states)
+        inputs = np.vstack(inputs)
+        with np.errstate(over='ignore', invalid='ignore'):
+            return [states, inputs, states[:-1] @ self.c.T + inputs @ self.d.T]
+
+
+class LinearBuilder:
+    """
+    Builds a linear step map, symbolically, as StateSpace does with its matrices:
+        an expression is a dict term -> coefficient (the terms are state names, input names and k_one for constants)
+        states have an initial value and an expression of their value in the next step
+        limits are expressions that must remain in [low, high] for the map to be valid (i.e. bounds of an output), the
+        ones that can be clamped are replaced by a constant (its low or high value) when they are in clamped
+    """
+
+    k_one  = '1'
+    k_low  = 'low'
+    k_high = 'high'
+
+    def __init__(self, clamped=None, first_step=False):
+        """
+        :param clamped:    dict limit name -> k_low or k_high, limits that are saturated all the time
+        :param first_step: build the map of the first step (i.e. the first output of a PID is just proportional)
+        """
+        self.clamped    = clamped if clamped is not None else {}
+        self.first_step = first_step
+        self.states     = []
+        self.initial    = {}
+        self.next       = {}
+        self.inputs     = []
+        self.limits     = []  # [[name, expression, low, high, clampable], ...]
+
+    def state(self, name, initial=0.0):
+        if name in self.initial or name in self.inputs:
+            raise Exception('State "%s" already defined' % name)
+        self.states.append(name)
+        self.initial[name] = initial
+        self.next[name]    = {name: 1.0}
+        return {name: 1.0}
+
+    def input(self, name):
+        if name in self.initial:
+            raise Exception('Input "%s" already defined as a state' % name)
+        if name not in self.inputs:
+            self.inputs.append(name)
+        return {name: 1.0}
+
+    def set_next(self, name, expression):
+        self.next[name] = expression
+
+    def limit(self, name, expression, bounds, clampable=True):
+        """
+        Returns the expression bounded (a constant if it is clamped)
+        """
+        if not bounds:
+            return expression
+        self.limits.append([name, expression, bounds[0], bounds[1], clampable])
+        side = self.clamped.get(name) if clampable else None
+        if side is None:
+            return expression
+        return constant(bounds[0] if side == self.k_low else bounds[1])
+
+    def matrices(self, expressions):
+        """
+        Returns [state matrix, input matrix] of the expressions (inputs in self.inputs order plus k_one)
+        """
+        states = {name: i for i, name in enumerate(self.states)}
+        inputs = {name: i for i, name in enumerate(self.inputs + [self.k_one])}
+        x      = np.zeros((len(expressions), len(states)))
+        u      = np.zeros((len(expressions), len(inputs)))
+        for i, expression in enumerate(expressions):
+            for term, value in expression.items():
+                if term in states:
+                    x[i, states[term]] = value
+                else:
+                    u[i, inputs[term]] = value
+        return [x, u]
+
+    def get_state_space(self, outputs):
+        """
+        :param outputs: dict name -> expression
+        """
+        [a, b] = self.matrices([self.next[name] for name in self.states])
+        [c, d] = self.matrices(list(outputs.values()))
+        return StateSpace(a, b, c, d, self.states, self.inputs + [self.k_one], list(outputs))
+
+    def get_initial_state(self):
+        return np.array([self.initial[name] for name in self.states], dtype=float)
+
+
+def constant(value):
+    return {LinearBuilder.k_one: value} if value != 0.0 else {}
+
+
+def combine(*terms):
+    """
+    Returns the expression sum(coefficient*expression) given [coefficient, expression] pairs
+    """
+    result = {}
+    for [coefficient, expression] in terms:
+        for term, value in expression.items():
+            result[term] = result.get(term, 0.0) + coefficient*value
+    return result
+
+
+# linear models of the control units, as hierarchy_compiler writes them, None means the unit is not linear
+def model_error(builder, control, r, new_p):
+    if control.min_error > 0.0:
+        return None
+    if control.lag == 0.0:
+        return combine([1.0, r], [-1.0, new_p])
+    p = builder.state(control.key + '.p', control.p)
+    builder.set_next(control.key + '.p', new_p)
+    k = control.lag/control.dt
+    return combine([1.0, r], [-(1.0 + k), new_p], [k, p])
+
+
+def model_output_limits(builder, control, new_o):
+    if control.max_change > 0.00001:
+        return None
+    return builder.limit(control.key + '.output', new_o, control.bounds)
+
+
+def model_pid(builder, control, r, new_p):
+    integrate = abs(control.k_i) >= 0.0001
+    if control.integrator_length > 0 or (integrate and control.integrator_reset):
+        return None
+    new_error = model_error(builder, control, r, new_p)
+    if new_error is None:
+        return None
+    e          = builder.state(control.key + '.e', control.e)
+    integrator = builder.state(control.key + '.integrator', control.integrator)
+    builder.set_next(control.key + '.e', new_error)
+    if builder.first_step and control.first_time:
+        return model_output_limits(builder, control, combine([control.k_p, new_error]))
+    if integrate:
+        integrator = builder.limit(control.key + '.integrator', combine([1.0, integrator], [control.dt, new_error]),
+                                   [-control.i_windup, control.i_windup], clampable=False)
+        builder.set_next(control.key + '.integrator', integrator)
+    k_d   = control.k_d/control.dt if control.dt > control.min_dt else 0.0
+    new_o = combine([control.k_p, new_error], [control.k_i, integrator], [k_d, new_error], [-k_d, e])
+    return model_output_limits(builder, control, new_o)
+
+
+def model_incremental_pid(builder, control, r, new_p):
+    new_error = model_error(builder, control, r, new_p)
+    if new_error is None:
+        return None
+    last_e      = builder.state(control.key + '.last_e', control.last_e)
+    last_last_e = builder.state(control.key + '.last_last_e', control.last_last_e)
+    o           = builder.state(control.key + '.o', control.o)
+    new_o       = combine([1.0, o], [control.k_p + control.k_i + control.k_d, new_error],
+                          [-control.k_p - 2*control.k_d, last_e], [control.k_d, last_last_e])
+    new_o       = model_output_limits(builder, control, new_o)
+    if new_o is not None:
+        builder.set_next(control.key + '.last_last_e', last_e)
+        builder.set_next(control.key + '.last_e', new_error)
+        builder.set_next(control.key + '.o', new_o)
+    return new_o
+
+
+def model_pcu(builder, control, r, new_p, min_ks=0.01):
+    if 0.0 <= control.ks < min_ks:
+        ks = min_ks
+    elif -min_ks < control.ks <= 0.0:
+        ks = -min_ks
+    else:
+        ks = control.ks
+    o     = builder.state(control.key + '.o', control.o)
+    new_o = builder.limit(control.key + '.output', combine([1.0 - 1.0/ks, o], [control.kg/ks, r],
+                                                           [-control.kg/ks, new_p]), control.bounds)
+    builder.set_next(control.key + '.o', new_o)
+    return new_o
+
+
+def model_lineal(builder, control, r, _):
+    new_o = builder.limit(control.key + '.input', r, control.input_bounds)
+    return builder.limit(control.key + '.output', combine([control.gain, new_o]), control.bounds)
+
+
+control_models = {cu.PID: model_pid, cu.P: model_pid, cu.IncrementalPID: model_incremental_pid, cu.PCU: model_pcu,
+                  cu.LinealControlUnit: model_lineal}
+
+
+class IntegratorModel:
+    """
+    Plant of ControlUnit.simple_change_model (the output is multiplied by a gain), with the interface of
+    CarModel.CarModel used in a hierarchy loop
+    """
+
+    def __init__(self, sensor_name, actuator_name, gain=1.0, rate_name=None, initial=0.0):
+        self.sensor_name   = sensor_name
+        self.actuator_name = actuator_name
+        self.gain          = gain
+        self.rate_name     = rate_name
+        self.p             = initial
+        self.rate          = 0.0
+        self.disturbance   = 0.0
+
+    def set_disturbance(self, new_disturbance):
+        self.disturbance = new_disturbance
+
+    def apply_actions(self, actions, dt=0.1):
+        new_p     = cu.simple_change_model(self.p, self.gain*actions.get(self.actuator_name, 0.0), self.disturbance, dt)
+        self.rate = (new_p - self.p)/dt
+        self.p    = new_p
+
+    def get_sensors(self):
+        sensors = {self.sensor_name: self.p}
+        if self.rate_name is not None:
+            sensors[self.rate_name] = self.rate
+        return sensors
+
+
+class IntegratorPlant:
+    """
+    Linear model of IntegratorModel: p(t+1) = p(t) + (gain*o(t) + disturbance)*dt
+    """
+
+    def __init__(self, sensor_name, actuator_name, gain=1.0, rate_name=None, initial=0.0, dt=0.1):
+        """
+        :param rate_name: if given, the rate of change of p in the last step is also a sensor (as the acceleration of
+                          CarModel)
+        """
+        self.sensor_name   = sensor_name
+        self.actuator_name = actuator_name
+        self.gain          = gain
+        self.rate_name     = rate_name
+        self.initial       = initial
+        self.dt            = dt
+
+    def add_sensors(self, builder):
+        sensors = {self.sensor_name: builder.state('plant.p', self.initial)}
+        if self.rate_name is not None:
+            sensors[self.rate_name] = builder.state('plant.rate')
+        return sensors
+
+    def add_update(self, builder, actuators):
+        rate = combine([self.gain, actuators.get(self.actuator_name, {})], [1.0, builder.input(k_disturbance)])
+        builder.set_next('plant.p', combine([1.0, {'plant.p': 1.0}], [self.dt, rate]))
+        if self.rate_name is not None:
+            builder.set_next('plant.rate', rate)
+
+    def new_model(self):
+        return IntegratorModel(self.sensor_name, self.actuator_name, gain=self.gain, rate_name=self.rate_name,
+                               initial=self.initial)
+
+
+class CarPlant:
+    """
+    Linear model of CarModel.CarModel while it moves forward (or stays stopped) with the pedals inside their range
+    """
+
+    def __init__(self, car_name='simple', output_lag=0, slope=0.0, dt=0.1, friction=0.1, max_pedal_value=100,
+                 acc_pedal_key='accelerator', brake_pedal_key='brake'):
+        self.car_name        = car_name
+        self.car_type        = cm.get_car_type(car_name)
+        self.output_lag      = output_lag
+        self.slope           = slope
+        self.dt              = dt
+        self.friction        = friction
+        self.max_pedal_value = max_pedal_value
+        self.acc_pedal_key   = acc_pedal_key
+        self.brake_pedal_key = brake_pedal_key
+
+    def add_sensors(self, builder):
+        # names as CarModel.get_sensors
+        return {'position': builder.state('car.position'), 'speed': builder.state('car.speed'),
+                'acceleration': builder.state('car.acceleration')}
+
+    def add_delay(self, builder, name, value):
+        # CarModel.acc_values: the value applied is the one of output_lag steps ago (0.0 before)
+        for i in range(self.output_lag):
+            delayed = builder.state('car.%s.%s' % (name, i + 1))
+            builder.set_next('car.%s.%s' % (name, i + 1), value)
+            value = delayed
+        return value
+
+    def add_update(self, builder, actuators):
+        dt        = self.dt
+        v         = {'car.speed': 1.0}
+        pedals    = [builder.limit('car.' + key, actuators.get(key, {}), [0, self.max_pedal_value])
+                     for key in [self.acc_pedal_key, self.brake_pedal_key]]
+        acc       = self.add_delay(builder, 'acc', combine([self.car_type.max_acc/self.max_pedal_value, pedals[0]]))
+        brake_acc = self.add_delay(builder, 'brake', combine([self.car_type.max_brake/self.max_pedal_value,
+                                                              pedals[1]]))
+        slope_acc = np.sin(np.radians(self.slope))*cm.CarModel.gravity
+        forward   = combine([1.0, acc], [1.0, constant(-slope_acc)], [1.0, builder.input(k_disturbance)])
+        new_v     = builder.limit('car.forward', combine([1.0, v], [dt, forward]), [0.0, math.inf], clampable=False)
+        new_v     = builder.limit('car.braking', combine([1.0, new_v], [-dt*self.friction, v], [-dt, brake_acc]),
+                                  [0.0, math.inf], clampable=False)
+        builder.set_next('car.acceleration', combine([1.0/dt, new_v], [-1.0/dt, v]))
+        builder.set_next('car.speed', new_v)
+        builder.set_next('car.position', combine([1.0, {'car.position': 1.0}], [dt, new_v]))
+
+    def new_model(self):
+        return cm.CarModel(self.car_type, slope=self.slope, friction=self.friction, output_lag=self.output_lag,
+                           max_pedal_value=self.max_pedal_value, acc_pedal_key=self.acc_pedal_key,
+                           brake_pedal_key=self.brake_pedal_key)
+
+
+class LinearHierarchy:
+    """
+    Runs a hierarchical_control.HierarchicalControl with a plant (IntegratorPlant or CarPlant) as a StateSpace (see
+    get_models), many steps at once, when all its control units are linear and no bound saturates over the episode
+    A bound saturated all the episode (i.e. the input of the brake while accelerating) is just a constant, if it
+    saturates some steps (or a unit is not linear) the episode is simulated step by step, as CarModel.CarEnvironment1
+    """
+
+    def __init__(self, control, plant, tolerance=1e-9):
+        """
+        :param control:   hierarchical_control.HierarchicalControl, its current state is the initial one
+        :param plant:
+        :param tolerance: a limit is saturated if it is exceeded more than this
+        """
+        self.control     = control
+        self.plant       = plant
+        self.tolerance   = tolerance
+        self.last_linear = None  # True if the last episode was calculated as a StateSpace
+
+    def build(self, clamped, first_step):
+        """
+        Returns [builder, signals, sensors] of one step of the loop, or None if some control unit is not linear
+        signals are the references and control outputs calculated in the step and sensors the ones seen at its start
+        (both as name -> expression)
+        """
+        builder = LinearBuilder(clamped=clamped, first_step=first_step)
+        state   = self.control.get_state()
+        sensors = self.plant.add_sensors(builder)
+        values  = {name: builder.input(name) for name in self.control.reference_names}
+        values.update(sensors)
+        held    = []  # values read before they are written (or never written), kept from the last step
+        for unit in self.control._controls:
+            inputs = []
+            for name in [unit.reference_name, unit.sensor_name]:
+                if name is not None and name not in values:
+                    values[name] = builder.state('signal.' + name, state.get(name, 0.0))
+                    held.append(name)
+                inputs.append(values[name] if name is not None else {})
+            model = control_models.get(type(unit.control))
+            new_o = model(builder, unit.control, *inputs) if model is not None else None
+            if new_o is None:
+                return None
+            values[unit.output_name] = new_o
+        for name in held:
+            builder.set_next('signal.' + name, values[name])
+        self.plant.add_update(builder, {name: values.get(name, {}) for name in self.control.actuator_names})
+        names   = self.control.reference_names + [unit.output_name for unit in self.control._controls]
+        signals = {name: values[name] for name in names}
+        return [builder, signals, sensors]
+
+    def get_models(self, clamped=None):
+        """
+        Returns the models of the first step and the next ones, as [builder, StateSpace of the signals, StateSpace of
+        the limits, StateSpace of the sensors], or None if the hierarchy is not linear
+        """
+        models = []
+        for first_step in [True, False]:
+            built = self.build(clamped, first_step)
+            if built is None:
+                return None
+            [builder, signals, sensors] = built
+            limits = {name: expression for [name, expression, _, _, _] in builder.limits}
+            models.append([builder, builder.get_state_space(signals), builder.get_state_space(limits),
+                           builder.get_state_space(sensors)])
+        return models
+
+    def get_input_changes(self, builder, reference_changes, disturbance_changes):
+        """
+        Returns [[step, u], ...] given the changes of the references ([[step, name, value], ...]) and the disturbance
+        ([[step, value], ...])
+        """
+        state  = self.control.get_state()
+        values = {name: state.get(name, 0.0) for name in builder.inputs}
+        values[k_disturbance] = 0.0
+        events = sorted([[step, name, value] for [step, name, value] in reference_changes] +
+                        [[step, k_disturbance, value] for [step, value] in disturbance_changes],
+                        key=lambda event: event[0])
+        changes = {}
+        for [step, name, value] in [[0, None, None]] + events:
+            if name is not None:
+                if name not in values:
+                    raise Exception('Reference "%s" not known, must be one of %s' % (name, builder.inputs))
+                values[name] = value
+            changes[step] = [values[name] for name in builder.inputs] + [1.0]
+        return [[step, u] for step, u in sorted(changes.items())]
+
+    def run_linear(self, reference_changes, disturbance_changes, steps, max_builds=10):
+        """
+        Returns the evolution of the signals (see run_episode) calculated as a StateSpace or None if it is not valid
+        The first step is calculated with its own model and the next ones with matrix powers, then the limits are
+        checked: the ones saturated all the steps are clamped and it is calculated again
+        """
+        clamped = {}
+        for _ in range(max_builds if steps > 1 else 0):
+            models = self.get_models(clamped)
+            if models is None:
+                return None
+            [[first, first_signals, first_limits, _], [builder, signals, limits, sensors]] = models
+            changes  = self.get_input_changes(builder, reference_changes, disturbance_changes)
+            x0       = first.get_initial_state()
+            u0       = np.array(changes[0][1])
+            [x1, y0] = first_signals.step(x0, u0)
+            next_u   = [u for [step, u] in changes if step <= 1][-1]
+            later    = [[0, next_u]] + [[step - 1, u] for [step, u] in changes if step > 1]
+            [states, inputs, values] = signals.simulate(x1, later, steps - 1)
+            states   = np.vstack([x0, states])
+            values   = np.vstack([y0, values])
+            limited  = {name: [value] for name, value in zip(first_limits.output_names,
+                                                              first_limits.step(x0, u0)[1])}
+            with np.errstate(over='ignore', invalid='ignore'):
+                columns = (states[1:-1] @ limits.c.T + inputs @ limits.d.T).T
+            for name, column in zip(limits.output_names, columns):
+                limited.setdefault(name, []).extend(column.tolist())
+            saturated = self.get_saturated(first.limits + builder.limits, limited, clamped)
+            if saturated is None:
+                return None
+            if not saturated:
+                evolution = dict(zip(signals.output_names, values.T))
+                evolution.update(zip(sensors.output_names, (states[1:] @ sensors.c.T).T))
+                return evolution
+            clamped.update(saturated)
+        return None
+
+    def get_saturated(self, limits, values, clamped):
+        """
+        Returns the limits (name -> side) that must be clamped (the ones saturated in the first step), {} if all of
+        them are right, None if some limit is saturated just some steps (so the episode is not linear)
+        :param limits: [[name, expression, low, high, clampable], ...]
+        :param values: limit name -> its values in all the steps
+        """
+        saturated = {}
+        exceeded  = False  # maybe just because of other limits not clamped yet
+        for [name, _, low, high, clampable] in limits:
+            column = np.array(values[name])
+            side   = clamped.get(name)
+            if side == LinearBuilder.k_low:
+                if not np.all(column <= low + self.tolerance):
+                    return None
+                continue
+            if side == LinearBuilder.k_high:
+                if not np.all(column >= high - self.tolerance):
+                    return None
+                continue
+            below = column < low - self.tolerance
+            above = column > high + self.tolerance
+            if np.all(np.isfinite(column)) and not np.any(below) and not np.any(above):
+                continue
+            if clampable and below[0]:
+                saturated[name] = LinearBuilder.k_low
+            elif clampable and above[0]:
+                saturated[name] = LinearBuilder.k_high
+            else:
+                exceeded = True
+        return None if exceeded and not saturated else saturated
+
+    def run_simulation(self, reference_changes, disturbance_changes, steps):
+        """
+        Returns the evolution of the signals (see run_episode) simulating step by step
+        """
+        model   = self.plant.new_model()
+        sensors = model.get_sensors()
+        events  = {}
+        for [step, name, value] in reference_changes:
+            events.setdefault(step, []).append([name, value])
+        for [step, value] in disturbance_changes:
+            events.setdefault(step, []).append([k_disturbance, value])
+        records = []
+        for step in range(steps):
+            for [name, value] in events.get(step, []):
+                if name == k_disturbance:
+                    model.set_disturbance(value)
+                else:
+                    self.control.set_value(name, value)
+            actuators = self.control.get_actuators(sensors)
+            model.apply_actions(actuators, self.plant.dt)
+            sensors   = model.get_sensors()
+            values    = dict(self.control.get_state())
+            values.update(actuators)
+            values.update(sensors)
+            records.append(values)
+        names = self.control.reference_names + [unit.output_name for unit in self.control._controls] + list(sensors)
+        return {name: np.array([values.get(name, 0.0) for values in records]) for name in dict.fromkeys(names)}
+
+    def run_episode(self, reference_changes=(), disturbance_changes=(), steps=500, linear=True):
+        """
+        Returns the evolution of the references, the control outputs and the sensors (after each step) as a dict
+        name -> array, calculated as a StateSpace when it is valid (see self.last_linear) or simulating step by step
+        The control is reset at the end
+        :param reference_changes:   [[step, reference name, value], ...]
+        :param disturbance_changes: [[step, value], ...], as CarModel.set_disturbance (i.e. wind)
+        :param steps:
+        :param linear:              if False it is always simulated
+        """
+        evolution        = self.run_linear(reference_changes, disturbance_changes, steps) if linear else None
+        self.last_linear = evolution is not None
+        if evolution is None:
+            evolution = self.run_simulation(reference_changes, disturbance_changes, steps)
+        self.control.reset()
+        return evolution
+
+
+# tests
+def test_powers(states, steps, seed):
+    """
+    Returns True if the states calculated with matrix powers are the ones of step by step
+    """
+    rng    = np.random.default_rng(seed)
+    a      = rng.normal(size=(states, states))
+    a      = 0.95*a/np.max(np.abs(np.linalg.eigvals(a)))
+    system = StateSpace(a, rng.normal(size=(states, 2)), rng.normal(size=(1, states)), np.zeros((1, 2)))
+    x0     = rng.normal(size=states)
+    u      = [[0, [1.0, 0.0]], [steps//3, [0.5, -1.0]]]
+    [x, _, y] = system.simulate(x0, u, steps)
+    expected  = [x0]
+    for k in range(steps):
+        expected.append(system.step(expected[-1], np.array(u[0][1] if k < steps//3 else u[1][1]))[0])
+    return bool(np.allclose(x, expected) and np.allclose(y[:, 0], (np.array(expected[:-1]) @ system.c.T)[:, 0]))
+
+
+def get_plant(plant_name):
+    if plant_name == 'integrator':
+        return IntegratorPlant('speed', 'accelerator', gain=0.05, rate_name='acceleration')
+    return CarPlant(car_name=plant_name)
+
+
+def test_same_as_simulation(file_name, dir_name, plant_name, reference_changes, disturbance_changes, steps):
+    """
+    Returns [True if the episode is the same as simulated step by step, True if it was calculated as a StateSpace]
+    """
+    import hierarchical_control as hc
+
+    control   = hc.HierarchicalControl(file_name, dir_name)
+    episode   = LinearHierarchy(control, get_plant(plant_name))
+    linear    = episode.run_episode(reference_changes, disturbance_changes, steps)
+    simulated = episode.run_episode(reference_changes, disturbance_changes, steps, linear=False)
+    same      = all(np.allclose(linear[name], simulated[name], atol=1e-6) for name in simulated)
+    return [same and set(linear) == set(simulated), episode.run_episode(reference_changes, disturbance_changes,
+                                                                           steps) is not None and episode.last_linear]
+
+
+def test_speedup(file_name, dir_name, plant_name, reference_changes, steps):
+    """
+    Returns how many times calculating an episode as a StateSpace is faster than simulating it
+    """
+    import hierarchical_control as hc
+
+    episode = LinearHierarchy(hc.HierarchicalControl(file_name, dir_name), get_plant(plant_name))
+    times   = []
+    for linear in [True, False]:
+        start = time.perf_counter()
+        episode.run_episode(reference_changes, (), steps, linear=linear)
+        times.append(time.perf_counter() - start)
+    print('      linear: %.0f steps/s simulated: %.0f steps/s' % (steps/times[0], steps/times[1]))
+    return times[0] < times[1]
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/state_space.test', '')
@@ -0,0 +1,345 @@
+import numpy as np
+
+import unit_test as ut
+
+
+class ArxModel:
+    """
+    Linear ARX model of a plant, fitted from recorded telemetry (least squares):
+        y(t+1) = a1*y(t) + ... + an*y(t-n+1) + b0*u(t-delay) + ... + bm*u(t-delay-m) + c
+    where u(t) are the inputs applied at step t (i.e. pedals) and y(t+1) the output seen after them (i.e. speed)
+    It is cheap to simulate, many candidates at once (see rollout_pid), so it is used as a low fidelity plant to tune
+    """
+
+    def __init__(self, output_order=1, input_order=1, delay=0):
+        """
+        :param output_order: number of past outputs used (n)
+        :param input_order:  number of past values of each input used (m + 1)
+        :param delay:        steps it takes an input to affect the output
+        """
+        self.output_order = output_order
+        self.input_order  = input_order
+        self.delay        = delay
+        self.a            = np.zeros(output_order)
+        self.b            = None  # input_order x inputs
+        self.c            = 0.0
+        self.rms          = None  # one step prediction error in the data fitted
+
+    def get_history(self):
+        # steps of past values needed to predict the next output
+        return max(self.output_order, self.delay + self.input_order)
+
+    def fit(self, outputs, inputs):
+        """
+        :param outputs: array (steps + 1), outputs[t + 1] is the output after applying inputs[t]
+        :param inputs:  array (steps) or (steps x inputs)
+        :return: self
+        """
+        outputs = np.asarray(outputs, dtype=float)
+        inputs  = np.asarray(inputs, dtype=float).reshape(len(inputs), -1)
+        start   = self.get_history() - 1
+        if len(inputs) - start < 2*(self.output_order + self.input_order*inputs.shape[1] + 1):
+            raise Exception('Not enough values (%s) to fit an ARX model of this order' % len(inputs))
+        rows      = self.get_regressors(outputs, inputs, start)
+        targets   = outputs[start + 1:len(inputs) + 1]
+        solution  = np.linalg.lstsq(rows, targets, rcond=None)[0]
+        self.a    = solution[:self.output_order]
+        self.b    = solution[self.output_order:-1].reshape(self.input_order, inputs.shape[1])
+        self.c    = solution[-1]
+        self.rms  = float(np.sqrt(np.mean((rows @ solution - targets)**2)))
+        return self
+
+    def get_regressors(self, outputs, inputs, start):
+        steps   = np.arange(start, len(inputs))
+        columns = [outputs[steps - i] for i in range(self.output_order)]
+        columns += [inputs[steps - self.delay - j, k] for j in range(self.input_order) for k in range(inputs.shape[1])]
+        return np.column_stack(columns + [np.ones(len(steps))])
+
+    def fit_log(self, log, output_name, input_names):
+        """
+        Fits the model from a log: a dict name -> array (i.e. TelemetryRecorder.as_dict) or a log file name (see
+        replay.read_log), where each record has the inputs applied and the output seen after them (the output before
+        the first record is taken as the first one)
+        """
+        if isinstance(log, str):
+            import replay
+
+            chunks = list(replay.read_log(log, names=[output_name] + list(input_names)))
+            log    = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+        outputs = np.concatenate([[log[output_name][0]], log[output_name]])
+        return self.fit(outputs, np.column_stack([log[name] for name in input_names]))
+
+    def simulate(self, inputs, initial_output=0.0):
+        """
+        Returns the outputs (steps + 1) given the inputs (steps x inputs), starting at rest in initial_output
+        """
+        inputs = np.asarray(inputs, dtype=float).reshape(len(inputs), -1)
+        state  = ArxState(self, 1, inputs.shape[1], initial_output)
+        return np.concatenate([[initial_output], [state.step(u[np.newaxis, :])[0] for u in inputs]])
+
+    def summary_string(self):
+        return 'a:%s b:%s c:%.4f delay:%s rms:%.4f' % (np.round(self.a, 4).tolist(), np.round(self.b, 4).tolist(),
+                                                       self.c, self.delay, self.rms if self.rms is not None else -1)
+
+
+class ArxState:
+    """
+    Past outputs and inputs of many ARX simulations run at the same time (one per candidate)
+    """
+
+    def __init__(self, model, candidates, inputs, initial_output=0.0):
+        self.model   = model
+        self.outputs = np.full((candidates, model.output_order), float(initial_output))  # y(t), y(t-1), ...
+        self.inputs  = np.zeros((candidates, model.delay + model.input_order, inputs))   # u(t), u(t-1), ...
+
+    def step(self, inputs):
+        """
+        Applies the inputs (candidates x inputs) and returns the new outputs (candidates)
+        """
+        self.inputs       = np.roll(self.inputs, 1, axis=1)
+        self.inputs[:, 0] = inputs
+        delayed           = self.inputs[:, self.model.delay:]
+        new_outputs       = self.outputs @ self.model.a + np.einsum('cjk,jk->c', delayed, self.model.b) + self.model.c
+        self.outputs      = np.roll(self.outputs, 1, axis=1)
+        self.outputs[:, 0] = new_outputs
+        return new_outputs
+
+
+def identify(outputs, inputs, max_delay=5, output_order=1, input_order=1):
+    """
+    Returns the ArxModel (with the given orders) whose delay simulates better the data
+    """
+    outputs = np.asarray(outputs, dtype=float)
+    best    = None
+    for delay in range(max_delay + 1):
+        model = ArxModel(output_order=output_order, input_order=input_order, delay=delay).fit(outputs, inputs)
+        error = np.mean((model.simulate(inputs, initial_output=outputs[0]) - outputs[:len(inputs) + 1])**2)
+        if best is None or error < best[0]:
+            best = [error, model]
+    return best[1]
+
+
+def car_inputs(outputs, max_pedal_value=100):
+    """
+    Returns the pedals (candidates x [accelerator, brake]) given the outputs of a speed control (see
+    CarControl.get_actions_from_acceleration)
+    """
+    return np.column_stack([np.clip(outputs, 0, max_pedal_value), np.clip(-outputs, 0, max_pedal_value)])
+
+
+def rollout_pid(model, gains, reference_changes, steps, dt=0.1, input_function=car_inputs, overshoot_gain=1.0,
+                i_windup=300.0, initial_output=0.0):
+    """
+    Runs a PID control of the model plant for many gains at once (vectorized), returns the cost of each one, the same
+    cost of a hierarchical_control.BaseHierarchicalControl: sum of abs(error), multiplied by overshoot_gain when the
+    error sign is not the one of the reference
+    :param model:             ArxModel
+    :param gains:             array (candidates x 3) with p, i and d
+    :param reference_changes: [[step, reference], ...]
+    :param steps:             the episode has steps + 1 steps (as in CarModel.CarEnvironment)
+    :param dt:
+    :param input_function:    given the control outputs (candidates) returns the model inputs (candidates x inputs)
+    :param overshoot_gain:
+    :param i_windup:          max abs value of the integrator
+    :param initial_output:
+    :return: array (candidates) with the costs
+    """
+    gains      = np.asarray(gains, dtype=float).reshape(-1, 3)
+    candidates = len(gains)
+    inputs     = input_function(np.zeros(candidates)).shape[1]
+    state      = ArxState(model, candidates, inputs, initial_output)
+    changes    = {int(step): value for [step, value] in reference_changes}
+    perception = np.full(candidates, float(initial_output))
+    last_error = np.zeros(candidates)
+    integrator = np.zeros(candidates)
+    costs      = np.zeros(candidates)
+    reference  = 0.0
+    for step in range(steps + 1):
+        reference  = changes.get(step, reference)
+        error      = reference - perception
+        output     = gains[:, 0]*error
+        if step > 0:
+            integrator = np.clip(integrator + error*dt, -i_windup, i_windup)
+            output    += gains[:, 1]*integrator + gains[:, 2]*(error - last_error)/dt
+        last_error = error
+        gain       = np.where(np.sign(error) != np.sign(reference), overshoot_gain, 1.0)
+        costs     += gain*np.abs(error)
+        perception = state.step(input_function(output))
+    return np.where(np.isfinite(costs), costs, np.inf)
+
+
+def coarse_search(cost_function, center, scale, candidates=500, rounds=6, keep=20, shrink=0.5, seed=0,
+                  min_value=0.0):
+    """
+    Cross entropy like search of parameters: each round evaluates many candidates sampled around the best ones so far
+    (with a smaller spread each round), cost_function evaluates all of them at once
+    :param cost_function: given an array (candidates x parameters) returns the costs (candidates)
+    :param center:        initial parameters (array)
+    :param scale:         initial spread of each parameter
+    :param min_value:     parameters are never less than this
+    :return: [parameters (keep x parameters), costs] of the best candidates found, sorted by cost
+    """
+    rng    = np.random.default_rng(seed)
+    center = np.asarray(center, dtype=float)
+    scale  = np.asarray(scale, dtype=float)
+    best   = center[np.newaxis, :]
+    costs  = cost_function(best)
+    for _ in range(rounds):
+        parents    = best[rng.integers(len(best), size=candidates)]
+        sampled    = np.maximum(parents + rng.normal(size=parents.shape)*scale, min_value)
+        population = np.concatenate([best, sampled])
+        all_costs  = np.concatenate([costs, cost_function(sampled)])
+        order      = np.argsort(all_costs, kind='stable')[:keep]
+        best       = population[order]
+        costs      = all_costs[order]
+        scale      = scale*shrink
+    return best, costs
+
+
+def multi_fidelity_tune(auto_tune, model, finalists=5, parameter_names=('p', 'i', 'd'), scale=(2.0, 0.5, 1.0),
+                        candidates=500, rounds=6, seed=0, debug=False):
+    """
+    Tunes a PID speed control (of a CarControl.AutoTuneCar) in two steps:
+        coarse: many candidates are evaluated in the surrogate model (vectorized, see rollout_pid)
+        fine:   just the best finalists (distinct ones) are evaluated in the real simulator
+    :param auto_tune:       CarControl.AutoTuneCar (or any AutoTuneFunction with reference_changes, max_iter and dt,
+                            whose control has overshoot_gain)
+    :param model:           ArxModel of the plant
+    :param finalists:       candidates run in the real simulator
+    :param parameter_names: PID gains names
+    :param scale:           initial spread of each gain in the coarse search
+    :param candidates:      candidates per round in the coarse search
+    :param rounds:
+    :param seed:
+    :param debug:
+    :return: [best parameters (by real cost), fidelity report (see fidelity_report)]
+    """
+    initial = auto_tune.get_parameters()
+    center  = [initial[name] for name in parameter_names]
+
+    def surrogate_costs(gains):
+        return rollout_pid(model, gains, auto_tune.reference_changes, auto_tune.max_iter, dt=auto_tune.dt,
+                           overshoot_gain=auto_tune.control.overshoot_gain)
+
+    best, costs = coarse_search(surrogate_costs, center, scale, candidates=candidates, rounds=rounds, seed=seed)
+    chosen      = []
+    for gains, cost in zip(best, costs):
+        if all(np.max(np.abs(gains - other)) > 1e-3 for [other, _] in chosen):
+            chosen.append([gains, cost])
+        if len(chosen) >= finalists:
+            break
+    rows = []
+    for gains, cost in chosen:
+        parameters = dict(initial, **dict(zip(parameter_names, gains.tolist())))
+        rows.append([parameters, float(cost), auto_tune.run_function_with_parameters(dict(parameters))])
+    report = fidelity_report(rows)
+    if debug:
+        print(fidelity_string(report))
+    return min(rows, key=lambda row: row[2])[0], report
+
+
+def fidelity_report(rows):
+    """
+    Compares the surrogate cost with the real one of the finalists
+    :param rows: [[parameters, surrogate cost, real cost], ...]
+    :return: dict with the rows, the relative error of each surrogate cost and the rank correlation (1.0 means the
+             surrogate orders the finalists as the real simulator)
+    """
+    surrogate = np.array([row[1] for row in rows])
+    real      = np.array([row[2] for row in rows])
+    errors    = (surrogate - real)/np.maximum(np.abs(real), 1e-9)
+    return {'rows':             rows,
+            'relative_errors':  errors.tolist(),
+            'mean_abs_error':   float(np.mean(np.abs(errors))),
+            'rank_correlation': rank_correlation(surrogate, real)}
+
+
+def rank_correlation(values1, values2):
+    # Spearman correlation (without ties correction)
+    if len(values1) < 2:
+        return 1.0
+    ranks1 = np.argsort(np.argsort(values1))
+    ranks2 = np.argsort(np.argsort(values2))
+    if np.std(ranks1) == 0 or np.std(ranks2) == 0:
+        return 1.0
+    return float(np.corrcoef(ranks1, ranks2)[0, 1])
+
+
+def fidelity_string(report):
+    lines = ['   %s surrogate:%.3f real:%.3f (%+.1f%%)' %
+             ({name: round(value, 3) for name, value in parameters.items()}, surrogate, real, 100*error)
+             for [parameters, surrogate, real], error in zip(report['rows'], report['relative_errors'])]
+    lines.append('   mean abs error:%.1f%% rank correlation:%.2f' % (100*report['mean_abs_error'],
+                                                                     report['rank_correlation']))
+    return '\n'.join(lines)
+
+
+# tests
+def car_excitation(car_name, output_lag, steps, dt=0.1, seed=0, hold=20):
+    """
+    Returns a log (dict name -> array) of a car driven with random pedals (each value held some steps), with the
+    pedals applied in each step and the speed after them
+    """
+    import CarModel as cm
+
+    rng       = np.random.default_rng(seed)
+    car_model = cm.CarModel(cm.get_car_type(car_name), output_lag=output_lag)
+    values    = {'acc': [], 'brake': [], 'speed': []}
+    acc, brake = 0.0, 0.0
+    for step in range(steps):
+        if step % hold == 0:
+            acc   = float(rng.uniform(0, 60)) if rng.random() < 0.7 else 0.0
+            brake = 0.0 if acc > 0 or car_model.current_v < 0.5 else float(rng.uniform(0, 20))
+        car_model.apply_actions({'acc': acc, 'brake': brake}, dt)
+        values['acc'].append(acc)
+        values['brake'].append(brake)
+        values['speed'].append(car_model.current_v)
+    return {name: np.array(value) for name, value in values.items()}
+
+
+def test_fit(car_name, output_lag, steps, max_delay):
+    """
+    Returns [delay identified, True if the simulated speed of a new log is close to the real one]
+    """
+    log   = car_excitation(car_name, output_lag, steps)
+    model = identify(np.concatenate([[0.0], log['speed']]), np.column_stack([log['acc'], log['brake']]),
+                     max_delay=max_delay)
+    new   = car_excitation(car_name, output_lag, steps, seed=1)
+    speed = model.simulate(np.column_stack([new['acc'], new['brake']]))[1:]
+    print('   %s sim rms:%.3f' % (model.summary_string(), np.sqrt(np.mean((speed - new['speed'])**2))))
+    return [model.delay, bool(np.sqrt(np.mean((speed - new['speed'])**2)) < 0.1*np.max(new['speed']))]
+
+
+def test_rollout(car_name, output_lag, gains_list, reference_changes, steps):
+    """
+    Returns True if the vectorized rollout of many gains gives the same costs as rolling out each one alone, also the
+    costs
+    """
+    log    = car_excitation(car_name, output_lag, 3000)
+    model  = ArxModel(delay=output_lag).fit_log(log, 'speed', ['acc', 'brake'])
+    costs  = rollout_pid(model, gains_list, reference_changes, steps, overshoot_gain=10.0)
+    single = [rollout_pid(model, [gains], reference_changes, steps, overshoot_gain=10.0)[0] for gains in gains_list]
+    return [bool(np.allclose(costs, single)), np.round(costs).tolist()]
+
+
+def test_multi_fidelity(car_name, output_lag, reference_changes, max_iter, finalists, debug):
+    """
+    Returns [True if the tuned parameters are better than the initial ones in the real simulator, real episodes run,
+    True if the surrogate orders the finalists as the simulator (rank correlation > 0)]
+    """
+    import CarControl as cc
+
+    log       = car_excitation(car_name, output_lag, 3000)
+    model     = ArxModel(delay=output_lag).fit_log(log, 'speed', ['acc', 'brake'])
+    control   = cc.CarSpeedControl(0.0, {'type': 'PID', 'name': 'speed', 'gains': [1.0, 0.0, 0.0]})
+    auto_tune = cc.AutoTuneCar(car_name, control, output_lag, reference_changes, max_iter=max_iter)
+    initial   = auto_tune.run_function_with_parameters(auto_tune.get_parameters())
+    best, report = multi_fidelity_tune(auto_tune, model, finalists=finalists, debug=debug)
+    best_cost = min(row[2] for row in report['rows'])
+    if debug:
+        print('   initial cost:%.3f best:%.3f %s' % (initial, best_cost, best))
+    return [best_cost < initial, len(report['rows']), report['rank_correlation'] > 0.0]
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/surrogate.test', '')
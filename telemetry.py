@@ -0,0 +1,409 @@
+import glob
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import unit_test as ut
+
+
+class TelemetryRecorder:
+    """
+    Records the values of an episode (time and every sensor, actuator and internal value) in preallocated numpy
+    columns, one per channel, instead of a list of dicts per step: each step just stores a few floats and each channel
+    can be read (i.e. to plot it) as an array without copying it
+    """
+
+    k_time = 't'
+
+    def __init__(self, channels=None, capacity=1000, decimation=1):
+        """
+        :param channels:   names of the values to record, None means all the ones present in the first record
+        :param capacity:   initial number of records (it grows if needed, but it's better to give the expected one)
+        :param decimation: just one of every decimation records is stored (i.e. 10 means 1 in 10)
+        """
+        self.channels   = None  # to avoid warnings
+        self.index      = {}    # channel name -> row in data
+        self.data       = None  # one row per channel (so each channel is contiguous), the first one is time
+        self.size       = 0     # number of records stored
+        self.calls      = 0     # number of calls to record (including the ones not stored because of decimation)
+        self.capacity   = max(capacity, 1)
+        self.decimation = max(int(decimation), 1)
+        self.set_channels(channels)
+
+    def set_channels(self, channels):
+        self.channels = list(channels) if channels is not None else None
+        self.index    = {name: i + 1 for i, name in enumerate(self.channels)} if channels is not None else {}
+        self.data     = np.empty((len(self.channels) + 1, self.capacity)) if channels is not None else None
+        self.size     = 0
+        self.calls    = 0
+
+    def reset(self, channels=None, keep_decimation=False):
+        """
+        Deletes all records (keeping the memory already allocated)
+        :param channels:        new channel names, if None the current ones are kept
+        :param keep_decimation: if True the next record is stored or not as if there were no reset (used when
+                                recording in chunks)
+        """
+        if channels is not None:
+            self.set_channels(channels)
+        self.size = 0
+        if not keep_decimation:
+            self.calls = 0
+
+    def record(self, t, values):
+        """
+        Stores the values of one step
+        :param t:      time
+        :param values: dict channel name -> value, channels not present are stored as nan and values not in
+                       channels are ignored
+        """
+        self.calls += 1
+        if (self.calls - 1) % self.decimation != 0:
+            return
+        if self.channels is None:
+            self.set_channels(values.keys())
+            self.calls = 1
+        if self.size >= self.data.shape[1]:
+            self.data = np.concatenate([self.data, np.empty_like(self.data)], axis=1)
+        self.data[:, self.size] = [t] + [values.get(name, np.nan) for name in self.channels]
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def get_channel(self, name):
+        """
+        Returns all the recorded values of a channel (a view, not a copy, so it must not be changed)
+        :param name: channel name or k_time for the time
+        :return: numpy array
+        """
+        if name == self.k_time:
+            return self.get_times()
+        if name not in self.index:
+            raise Exception('Channel "%s" not recorded, must be one of %s' % (name, self.channels))
+        return self.data[self.index[name], :self.size]
+
+    def get_times(self):
+        return self.data[0, :self.size] if self.data is not None else np.empty(0)
+
+    def get_evolution(self, name):
+        """
+        Returns [[t, value], ...] of a channel, as the format used to plot points
+        """
+        return np.stack([self.get_times(), self.get_channel(name)], axis=1).tolist()
+
+    def get_record(self, i):
+        """
+        Returns the values of record i as a dict (channel name -> value)
+        """
+        return {name: float(self.data[row, i]) for name, row in self.index.items()}
+
+    def get_records(self):
+        return [self.get_record(i) for i in range(self.size)]
+
+    def as_dict(self):
+        """
+        Returns all channels (views, not copies) by name, including time
+        """
+        channels = {self.k_time: self.get_times()}
+        channels.update({name: self.get_channel(name) for name in self.index})
+        return channels
+
+
+def chunks(steps, chunk_size, channels=None):
+    """
+    Groups the steps of an episode in chunks of chunk_size records
+    Note: the same recorder is used for all the chunks, so each one is valid just until the next one is asked for
+    :param steps:      iterable of (t, values dict), i.e. iter_episode of an environment
+    :param chunk_size:
+    :param channels:   names of the values to record, None means all
+    :return: yields a TelemetryRecorder
+    """
+    recorder = TelemetryRecorder(channels=channels, capacity=chunk_size)
+    for t, values in steps:
+        recorder.record(t, values)
+        if len(recorder) >= chunk_size:
+            yield recorder
+            recorder.reset()
+    if len(recorder) > 0:
+        yield recorder
+
+
+class ChunkWriter:
+    """
+    Writes the telemetry of (long) episodes to disk in chunks of chunk_size records, so memory used is constant:
+        * each chunk has a .npy file per channel (including time), they can be memory mapped
+        * index.json has the channels and the time range of each chunk, it is updated after each chunk is written, so
+          the files can be read while the episode is still running (see ChunkReader)
+    """
+
+    k_index_file = 'index.json'
+    k_channels   = 'channels'
+    k_chunks     = 'chunks'
+    k_rows       = 'rows'
+    k_first_t    = 'first_t'
+    k_last_t     = 'last_t'
+
+    def __init__(self, directory, channels=None, chunk_size=10000, decimation=1):
+        """
+        :param directory:  where the files are saved (created if needed, the chunks and index of a previous episode
+                           in it are deleted, any other file is kept)
+        :param channels:   names of the values to record, None means all the ones in the first record
+        :param chunk_size: records per chunk
+        :param decimation: just one of every decimation records is stored
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory  = directory
+        self.chunk_size = chunk_size
+        self.recorder   = TelemetryRecorder(channels=channels, capacity=chunk_size, decimation=decimation)
+        self.index      = {self.k_channels: channels, self.k_chunks: []}
+        self.remove_chunks()
+
+    def remove_chunks(self):
+        # removes the files of a previous episode: its index and the chunks listed in it
+        index_file_name = os.path.join(self.directory, self.k_index_file)
+        if not os.path.exists(index_file_name):
+            return
+        with open(index_file_name) as index_file:
+            chunks = len(json.load(index_file)[self.k_chunks])
+        for chunk in range(chunks):
+            for file_name in glob.glob(chunk_file_name(glob.escape(self.directory), chunk, '*')):
+                os.remove(file_name)
+        os.remove(index_file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def record(self, t, values):
+        self.recorder.record(t, values)
+        if len(self.recorder) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the records not written yet as a new chunk
+        """
+        if len(self.recorder) == 0:
+            return
+        chunk = len(self.index[self.k_chunks])
+        for name, values in self.recorder.as_dict().items():
+            np.save(chunk_file_name(self.directory, chunk, name), values)
+        times = self.recorder.get_times()
+        self.index[self.k_channels] = self.recorder.channels
+        self.index[self.k_chunks].append({self.k_rows: len(self.recorder), self.k_first_t: float(times[0]),
+                                          self.k_last_t: float(times[-1])})
+        # written to another file first, so readers never see an incomplete index
+        temporal_file_name = os.path.join(self.directory, self.k_index_file + '.tmp')
+        with open(temporal_file_name, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temporal_file_name, os.path.join(self.directory, self.k_index_file))
+        self.recorder.reset(keep_decimation=True)
+
+    def close(self):
+        self.flush()
+
+
+class ChunkReader:
+    """
+    Reads the telemetry written by a ChunkWriter (even while it is still writing, see refresh)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index     = None  # to avoid warnings
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reads the index again, to see the chunks written since the last time
+        """
+        index_file_name = os.path.join(self.directory, ChunkWriter.k_index_file)
+        if os.path.exists(index_file_name):
+            with open(index_file_name) as index_file:
+                self.index = json.load(index_file)
+        else:
+            self.index = {ChunkWriter.k_channels: [], ChunkWriter.k_chunks: []}
+
+    def get_channels(self):
+        return self.index[ChunkWriter.k_channels] or []
+
+    def get_chunks_count(self):
+        return len(self.index[ChunkWriter.k_chunks])
+
+    def __len__(self):
+        return sum(chunk[ChunkWriter.k_rows] for chunk in self.index[ChunkWriter.k_chunks])
+
+    def get_chunk(self, chunk, names=None, mmap=True):
+        """
+        Returns the values of a chunk
+        :param chunk: chunk number
+        :param names: channels to read (time is always included), None means all
+        :param mmap:  if True the files are memory mapped (read from disk just when used), if not loaded in memory
+        :return: dict channel name -> array
+        """
+        names = [TelemetryRecorder.k_time] + [name for name in (self.get_channels() if names is None else names)
+                                              if name != TelemetryRecorder.k_time]
+        return {name: np.load(chunk_file_name(self.directory, chunk, name), mmap_mode='r' if mmap else None)
+                for name in names}
+
+    def iter_chunks(self, names=None, t_from=None, t_to=None, mmap=True):
+        """
+        Yields the chunks (see get_chunk) with values between t_from and t_to (None means no limit), using the time
+        range in the index so other chunks are not read
+        """
+        for chunk, chunk_info in enumerate(self.index[ChunkWriter.k_chunks]):
+            if t_from is not None and chunk_info[ChunkWriter.k_last_t] < t_from:
+                continue
+            if t_to is not None and chunk_info[ChunkWriter.k_first_t] > t_to:
+                break
+            yield self.get_chunk(chunk, names=names, mmap=mmap)
+
+    def get_channel(self, name, t_from=None, t_to=None):
+        """
+        Returns the values of a channel (as one array) between t_from and t_to (None means no limit)
+        """
+        values = []
+        for chunk in self.iter_chunks(names=[name], t_from=t_from, t_to=t_to):
+            times = chunk[TelemetryRecorder.k_time]
+            valid = np.ones(len(times), dtype=bool)
+            if t_from is not None:
+                valid &= times >= t_from
+            if t_to is not None:
+                valid &= times <= t_to
+            values.append(chunk[name][valid])
+        return np.concatenate(values) if values else np.empty(0)
+
+
+def chunk_file_name(directory, chunk, name):
+    return os.path.join(directory, '%06d_%s.npy' % (chunk, name))
+
+
+# tests
+def sample_values(i):
+    return {'speed': 0.1*i, 'acceleration': 1.0, 'accelerator': 10.0*(i % 3), 'brake': 0.0, 'ref_speed': 5.0}
+
+
+def test_record(steps, channels, decimation, channel):
+    """
+    Returns the values of a channel recorded (with a small initial capacity, so it has to grow)
+    """
+    recorder = TelemetryRecorder(channels=channels, capacity=2, decimation=decimation)
+    for i in range(steps):
+        recorder.record(0.1*i, sample_values(i))
+    values = recorder.get_channel(channel)
+    if not np.shares_memory(values, recorder.data):
+        return 'copied'
+    return [round(v, 3) for v in values.tolist()]
+
+
+def test_memory(steps):
+    """
+    Returns how many times less memory uses the recorder than a list of [t, values dict] per step
+    """
+    sizes = []
+    for use_recorder in [False, True]:
+        tracemalloc.start()
+        start_size = tracemalloc.get_traced_memory()[0]
+        records    = TelemetryRecorder(capacity=steps) if use_recorder else []
+        for i in range(steps):
+            values = {k: float(v) for k, v in sample_values(i).items()}
+            if use_recorder:
+                records.record(0.1*i, values)
+            else:
+                records.append([0.1*i, values])
+        sizes.append(tracemalloc.get_traced_memory()[0] - start_size)
+        tracemalloc.stop()
+        del records
+    print('   bytes per step: %.0f with a list, %.0f with the recorder' % (sizes[0]/steps, sizes[1]/steps))
+    return sizes[0]/sizes[1] > 5.0
+
+
+def test_channel_speedup(steps):
+    """
+    Prints how many times faster is getting the values of a channel from the recorder than from a list of dicts
+    """
+    records  = []
+    recorder = TelemetryRecorder(capacity=steps)
+    for i in range(steps):
+        records.append([0.1*i, sample_values(i)])
+        recorder.record(0.1*i, sample_values(i))
+
+    start = time.perf_counter()
+    for _ in range(100):
+        [[t, values['speed']] for t, values in records]
+    list_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(100):
+        recorder.get_channel('speed')
+    recorder_time = time.perf_counter() - start
+    print('   %.0f times faster' % (list_time/recorder_time))
+
+
+def test_chunks(steps, chunk_size, decimation, t_from, t_to):
+    """
+    Returns True if the values written by a ChunkWriter (read while writing and at the end, between t_from and t_to)
+    are the same as recording them in memory
+    """
+    directory  = os.path.join(tempfile.gettempdir(), 'test_chunks')
+    in_memory  = TelemetryRecorder(decimation=decimation)
+    reader     = ChunkReader(directory)
+    read_while = 0
+    with ChunkWriter(directory, chunk_size=chunk_size, decimation=decimation) as writer:
+        for i in range(steps):
+            writer.record(0.1*i, sample_values(i))
+            in_memory.record(0.1*i, sample_values(i))
+            if i == steps//2:
+                reader.refresh()
+                read_while = len(reader)
+    reader.refresh()
+    print('   %s chunks, %s records read while writing' % (reader.get_chunks_count(), read_while))
+
+    times    = in_memory.get_times()
+    expected = in_memory.get_channel('speed')[(times >= t_from) & (times <= t_to)]
+    same     = np.array_equal(reader.get_channel('speed', t_from=t_from, t_to=t_to), expected)
+    return same and len(reader) == len(in_memory) and read_while == (len(in_memory)//2//chunk_size)*chunk_size
+
+
+def test_rewrite_chunks(steps, chunk_size):
+    """
+    Returns [chunk files, True if other files are kept] after writing two episodes (the second one with half the
+    steps) in the same directory
+    """
+    directory = os.path.join(tempfile.gettempdir(), 'test_rewrite_chunks')
+    for episode_steps in [steps, steps//2]:
+        with ChunkWriter(directory, chunk_size=chunk_size) as writer:
+            for i in range(episode_steps):
+                writer.record(0.1*i, sample_values(i))
+        with open(os.path.join(directory, 'notes.txt'), 'w') as notes:
+            notes.write('not written by ChunkWriter')
+    chunk_files = len(glob.glob(os.path.join(glob.escape(directory), '*.npy')))
+    return [chunk_files, os.path.exists(os.path.join(directory, 'notes.txt'))]
+
+
+def test_chunks_memory(steps, chunk_size):
+    """
+    Prints the peak memory used writing an episode to disk, it must be a small part of what is needed to keep it in
+    memory (it grows just with the index, a few bytes per chunk)
+    """
+    directory = os.path.join(tempfile.gettempdir(), 'test_chunks_memory')
+    tracemalloc.start()
+    with ChunkWriter(directory, chunk_size=chunk_size) as writer:
+        for i in range(steps):
+            writer.record(0.1*i, sample_values(i))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    in_memory = steps*8*(len(sample_values(0)) + 1)
+    print('   %s steps: peak memory %.0f KB (%.0f KB in memory)' % (steps, peak/1024, in_memory/1024))
+    return peak < in_memory/10
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/telemetry.test', '')
@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import unit_test as ut
+
+
+class TuningDatabase:
+    """
+    Local store (SQLite) of the results of past tunings, indexed by what was tuned (the hierarchy), where (plant, output
+    lag and slope) and in which scenario (its features). So a new tuning can start from the best parameters of the most
+    similar tunings done before, with smaller changes, instead of from the initial parameters of the definition
+    A context is a dict with:
+        k_hierarchy:  name of what is tuned (see hierarchy_name), only tunings of the same hierarchy are used
+        k_plant:      plant name (i.e. car type)
+        k_output_lag: in steps
+        k_slope:      in degrees
+        k_features:   dict name -> number that describe the scenario (see scenario_features)
+    """
+
+    k_hierarchy  = 'hierarchy'
+    k_plant      = 'plant'
+    k_output_lag = 'output_lag'
+    k_slope      = 'slope'
+    k_features   = 'features'
+
+    default_weights = {k_plant: 1.0, k_output_lag: 0.5, k_slope: 0.1, k_features: 1.0}
+
+    def __init__(self, file_name=None, weights=None, neighbors=3, full_change_distance=2.0, min_change_ratio=0.1):
+        """
+        :param file_name:            SQLite file, None means __pycache__/tuning.sqlite in this script directory
+        :param weights:              weight in the distance of: a different plant, each step of output lag, each
+                                     degree of slope and each feature relative difference (see get_distance)
+        :param neighbors:            number of past tunings used to calculate the initial parameters
+        :param full_change_distance: if the nearest past tuning is at this distance (or more) the given change is used,
+                                     if it is closer the change is reduced in proportion
+        :param min_change_ratio:     the initial change is never less than the given change times this
+        """
+        self.file_name            = file_name if file_name is not None else \
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'tuning.sqlite')
+        self.weights              = dict(self.default_weights, **(weights if weights is not None else {}))
+        self.neighbors            = neighbors
+        self.full_change_distance = full_change_distance
+        self.min_change_ratio     = min_change_ratio
+        os.makedirs(os.path.dirname(os.path.abspath(self.file_name)), exist_ok=True)
+        self.connection           = sqlite3.connect(self.file_name)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tunings (id INTEGER PRIMARY KEY, hierarchy TEXT, '
+                                'plant TEXT, output_lag REAL, slope REAL, features TEXT, parameters TEXT, cost REAL, '
+                                'tries INTEGER, created REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tunings_hierarchy ON tunings (hierarchy, plant)')
+        self.connection.commit()
+
+    def add(self, context, parameters, cost, tries=0):
+        """
+        Saves the result of a tuning
+        :param context:    see class doc
+        :param parameters: best parameters found
+        :param cost:       cost of the best parameters
+        :param tries:      iterations needed to find them
+        """
+        self.connection.execute('INSERT INTO tunings (hierarchy, plant, output_lag, slope, features, parameters, cost,'
+                                ' tries, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (context[self.k_hierarchy], context.get(self.k_plant, ''),
+                                 context.get(self.k_output_lag, 0), context.get(self.k_slope, 0.0),
+                                 json.dumps(context.get(self.k_features, {}), sort_keys=True),
+                                 json.dumps(parameters, sort_keys=True), cost, tries, time.time()))
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM tunings').fetchone()[0]
+
+    def nearest(self, context, neighbors=None):
+        """
+        Returns [[distance, parameters, cost], ...] of the past tunings of the same hierarchy closest to the context
+        (sorted by distance, just the best one of each equal context)
+        """
+        neighbors = self.neighbors if neighbors is None else neighbors
+        rows      = self.connection.execute('SELECT plant, output_lag, slope, features, parameters, cost FROM tunings '
+                                            'WHERE hierarchy = ?', (context[self.k_hierarchy],)).fetchall()
+        best      = {}
+        for [plant, output_lag, slope, features, parameters, cost] in rows:
+            past     = {self.k_plant: plant, self.k_output_lag: output_lag, self.k_slope: slope,
+                        self.k_features: json.loads(features)}
+            distance = self.get_distance(context, past)
+            key      = (distance, plant, output_lag, slope, features)
+            if key not in best or cost < best[key][2]:
+                best[key] = [distance, json.loads(parameters), cost]
+        return sorted(best.values(), key=lambda result: (result[0], result[2]))[:neighbors]
+
+    def get_distance(self, context1, context2):
+        distance  = self.weights[self.k_plant] if context1.get(self.k_plant, '') != context2.get(self.k_plant, '') \
+            else 0.0
+        distance += self.weights[self.k_output_lag]*abs(context1.get(self.k_output_lag, 0) -
+                                                         context2.get(self.k_output_lag, 0))
+        distance += self.weights[self.k_slope]*abs(context1.get(self.k_slope, 0.0) - context2.get(self.k_slope, 0.0))
+        features1 = context1.get(self.k_features, {})
+        features2 = context2.get(self.k_features, {})
+        for name in set(features1) | set(features2):
+            if name not in features1 or name not in features2:
+                distance += self.weights[self.k_features]
+                continue
+            value1, value2 = features1[name], features2[name]
+            distance += self.weights[self.k_features]*abs(value1 - value2)/max(abs(value1), abs(value2), 1.0)
+        return distance
+
+    def get_start(self, context, parameters, change):
+        """
+        Returns [initial parameters, initial change] for a new tuning in the context:
+            the parameters are the mean of the best ones of the nearest past tunings (weighted by the inverse of their
+            distance, so an equal context gives its parameters) and the change is reduced in proportion to the
+            distance to the nearest one
+            if there are no past tunings, the given parameters and change are returned
+        :param context:    see class doc
+        :param parameters: initial parameters (i.e. the ones in the definition)
+        :param change:     initial change
+        """
+        nearest = self.nearest(context)
+        if len(nearest) == 0:
+            return parameters, change
+        if nearest[0][0] == 0.0:
+            nearest = [nearest[0]]
+        weights = [1.0/max(distance, 1e-9) for [distance, _, _] in nearest]
+        start   = {}
+        for name, value in parameters.items():
+            values = [[w, past_parameters[name]] for w, [_, past_parameters, _] in zip(weights, nearest)
+                      if name in past_parameters]
+            start[name] = sum(w*v for [w, v] in values)/sum(w for [w, _] in values) if values else value
+        return start, change*min(1.0, max(self.min_change_ratio, nearest[0][0]/self.full_change_distance))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM tunings')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def hierarchy_name(name, parameters):
+    """
+    Returns the name used as hierarchy in a context: the control name and its parameter names, so just tunings of the
+    same parameters are used to start a new one
+    """
+    return '%s:%s' % (name, ','.join(sorted(parameters)))
+
+
+def scenario_features(reference_changes=(), slope_changes=(), steps=None):
+    """
+    Returns the features (see TuningDatabase) of a scenario given by its changes ([[step, value], ...])
+    """
+    references = [value for [_, value] in reference_changes]
+    slopes     = [value for [_, value] in slope_changes]
+    steps      = steps if steps is not None else \
+        max([step for [step, _] in list(reference_changes) + list(slope_changes)] + [1])
+    return {'reference_mean':    sum(references)/len(references) if references else 0.0,
+            'reference_changes': len(references)*100.0/steps,
+            'reference_range':   max(references) - min(references) if references else 0.0,
+            'slope_mean':        sum(abs(value) for value in slopes)/len(slopes) if slopes else 0.0}
+
+
+def round_parameters(parameters, decimals=2):
+    return {name: round(value, decimals) for name, value in parameters.items()}
+
+
+# tests
+def car_auto_tune(car_name, output_lag, reference_changes, max_iter, database):
+    import CarControl as cc
+
+    control   = cc.CarSpeedControl(0.0, {'type': 'PID', 'name': 'speed', 'gains': [1.0, 0.0, 0.0]})
+    auto_tune = cc.AutoTuneCar(car_name, control, output_lag, reference_changes, max_iter=max_iter)
+    auto_tune.auto_tune(database=database)
+    return auto_tune
+
+
+def test_warm_start(car_name, first_lag, new_lag, reference_changes, max_iter, debug):
+    """
+    Returns True if tuning a car with a new lag takes less tries (and gets a cost as good) starting from a tuning with
+    another lag than from scratch
+    """
+    database  = TuningDatabase(os.path.join(tempfile.gettempdir(), 'test_warm_start.sqlite'))
+    database.clear()
+    car_auto_tune(car_name, first_lag, reference_changes, max_iter, database)
+    warm      = car_auto_tune(car_name, new_lag, reference_changes, max_iter, database)
+    cold      = car_auto_tune(car_name, new_lag, reference_changes, max_iter, None)
+    [[warm_cost, warm_tries], [cold_cost, cold_tries]] = [[t.last_cost, t.last_tries] for t in [warm, cold]]
+    if debug:
+        print('   warm: cost %.3f tries %s, cold: cost %.3f tries %s' % (warm_cost, warm_tries, cold_cost, cold_tries))
+    return warm_tries < cold_tries and warm_cost <= cold_cost*1.05
+
+
+def test_get_start(past, context, parameters, change):
+    """
+    Returns [initial parameters, initial change] given the past tunings ([[context, parameters, cost], ...])
+    """
+    database = TuningDatabase(os.path.join(tempfile.gettempdir(), 'test_get_start.sqlite'))
+    database.clear()
+    for [past_context, past_parameters, cost] in past:
+        database.add(past_context, past_parameters, cost)
+    start, start_change = database.get_start(context, parameters, change)
+    return [round_parameters(start), round(start_change, 2)]
+
+
+def test_distance(context1, context2):
+    return round(TuningDatabase(':memory:').get_distance(context1, context2), 3)
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/tuning_db.test', '')
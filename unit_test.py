@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import yaml_functions as yf
+import os
+import subprocess
 import sys
 from enum import IntEnum
 
@@ -137,3 +139,24 @@ def get_test_name_from_cmd_line():
         return None
     else:
         return sys.argv[1]
+
+
+def get_import_time(module_name, watched_modules=()):
+    """
+    Imports a module in a new python process (so nothing is loaded yet) and returns how long it took (in seconds) and
+    which of the watched modules got loaded by it, used to check that slow libraries are only loaded when needed
+    :param module_name:     name of the module to import (i.e. 'ControlUnit')
+    :param watched_modules: names of the modules to check (i.e. ['matplotlib', 'skfuzzy'])
+    :return: elapsed time, list of the watched modules loaded
+    """
+    code   = ('import sys, time\n'
+              'start = time.perf_counter()\n'
+              'import %s\n'
+              'print(time.perf_counter() - start)\n'
+              'print(" ".join(name for name in %r if name in sys.modules))' % (module_name, list(watched_modules)))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise Exception('could not import %s: %s' % (module_name, result.stderr))
+    lines = result.stdout.splitlines()
+    return float(lines[0]), lines[1].split() if len(lines) > 1 else []
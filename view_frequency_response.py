@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import sys
+
+import numpy as np
+
+import WinDeklar.QTAux as QTAux
+import WinDeklar.WindowForm as WinForm
+
+import ControlUnit as cu
+import frequency_response as fr
+
+
+class FrequencyResponseHost(WinForm.TestHost):
+    """
+    Shows the Bode diagram (open loop magnitude and phase) of a controller with a plant, and its gain and phase margins
+    """
+
+    def __init__(self):
+        # keys (names used in the yaml definition file)
+        self.k_plant       = 'plant'
+        self.k_dt          = 'dt'
+        self.k_output_lag  = 'output_lag'
+        self.k_points      = 'points'
+        self.k_type        = 'type'
+        self.k_controller_params = ['p1', 'p2', 'p3']
+
+        # particular data
+        self.plant_name  = 'integrator'
+        self.control_def = None
+        self.parm_map    = []
+
+        super(FrequencyResponseHost, self).__init__(initial_values={}, base_dir=None)
+
+    def update_view(self, figure, ax):
+        if self.control_def is None:
+            return
+        [w, magnitude, phase, margins] = self.get_response()
+        position = [0.125, 0.11, 0.775, 0.8]
+        figure.figure.clear()
+        ax1 = figure.figure.add_axes(position)
+        ax1.set_xscale('log')
+        ax1.grid(True, which='both', linewidth=0.3)
+
+        if figure.name == 'magnitude':
+            figure.figure.suptitle('Magnitude (dB)   gain margin: %.2f dB at %.3g rad/s' %
+                                   (margins[fr.k_gain_margin], margins[fr.k_phase_crossover]), fontsize='medium')
+            ax1.plot(w, magnitude, 'red', linewidth=1)
+            ax1.axhline(0.0, color='black', linewidth=0.5)
+        if figure.name == 'phase':
+            figure.figure.suptitle('Phase (degrees)   phase margin: %.2f at %.3g rad/s' %
+                                   (margins[fr.k_phase_margin], margins[fr.k_gain_crossover]), fontsize='medium')
+            ax1.plot(w, phase, 'red', linewidth=1)
+            ax1.axhline(-180.0, color='black', linewidth=0.5)
+
+    def get_response(self):
+        """
+        Returns [frequencies, magnitude, phase, margins] of the open loop with the current parameters
+        """
+        dt      = self.get_value(self.k_dt)
+        control = cu.create_control(self.control_def)
+        control.set_parameters({k1: self.get_value(k) for [k, k1] in self.parm_map})
+        plant   = fr.get_plant(self.plant_name, dt, int(self.get_value(self.k_output_lag)))
+        loop    = fr.loop_transfer_function(control, plant)
+        w       = fr.frequencies(dt, int(self.get_value(self.k_points)))
+        [magnitude, phase] = fr.bode(loop, w, dt)
+        margins = {k: float(v[0]) for k, v in fr.margins(loop, w, dt).items()}
+        return [w, magnitude[0], phase[0], margins]
+
+    def set_case(self, test_input, output, test_description):
+        self.control_def, self.plant_name, dt, output_lag = test_input
+        self.set_value(self.k_plant, self.plant_name)
+        self.set_value(self.k_dt, dt)
+        self.set_value(self.k_output_lag, output_lag)
+        self.set_value(self.k_type, self.control_def.get(self.k_type, 'Unknown'))
+        controller_parms = cu.create_control(self.control_def).get_parameters()
+        # change default values with controller specific values
+        self.parm_map = []
+        i = 0
+        for k, v in controller_parms.items():
+            if i >= len(self.k_controller_params):
+                break
+            widget_name = self.k_controller_params[i]
+            ui_control  = self.get_widget_by_name(widget_name)
+            ui_control.label.setText(k)
+            ui_control.set_visible(True)
+            self.set_value(widget_name, v)
+            self.parm_map.append([widget_name, k])
+            i += 1
+        # hide not used default widgets
+        for i in range(len(controller_parms), len(self.k_controller_params)):
+            widget_name = self.k_controller_params[i]
+            ui_control  = self.get_widget_by_name(widget_name)
+            ui_control.set_visible(False)
+
+        return self.get_current_description(test_description)
+
+    def set_no_case(self):
+        self.control_def = None
+
+    def print_margins(self):
+        [_, _, _, margins] = self.get_response()
+        print(' '.join('%s: %s' % (k, np.round(v, 3)) for k, v in margins.items()))
+
+
+if __name__ == '__main__':
+    app = QTAux.def_app()
+    provider = FrequencyResponseHost()        # class to handle events
+    WinForm.run_winform(__file__, provider)
+    sys.exit(app.exec_())
@@ -7,6 +7,7 @@ import WinDeklar.QTAux as QTAux
 import WinDeklar.WindowForm as WinForm
 
 import ControlUnit as cu
+import result_cache as rc
 
 
 class CarEnvelopHost(WinForm.TestHost):
@@ -66,8 +67,17 @@ class CarEnvelopHost(WinForm.TestHost):
         d      = self.get_value(self.k_disturbance)
         dt     = self.get_value(self.k_dt)
         debug  = self.get_value(self.k_debug)
+        control_params = {k1: self.get_value(k) for [k, k1] in self.parm_map}
+        if debug:
+            # debug info is printed only when simulated
+            return self.simulate(r, d, cycles, dt, control_params, debug)
+        # the same values are shown again and again (i.e. each time the window is refreshed), so they are cached
+        return rc.default_cache().get_or_run(['step_response', self.control_def, control_params, r, d, cycles, dt],
+                                             self.simulate, r, d, cycles, dt, control_params, debug)
+
+    def simulate(self, r, d, cycles, dt, control_params, debug):
         control_unit = cu.create_control(self.control_def)
-        self.set_control_unit_parameters(control_unit)
+        control_unit.set_parameters(control_params)
         values = [{self.k_t: 0.0, self.k_reference: r, self.k_disturbance: d, self.k_perception: 0.0,
                    self.k_output: 0.0}]
         cycle  = 1
@@ -87,10 +97,6 @@ class CarEnvelopHost(WinForm.TestHost):
                 self.box_size.add_points([p0, p1])
         self.box_size.set_bounds(ax, inc=1.1)
 
-    def set_control_unit_parameters(self, control_unit):
-        control_params = {k1: self.get_value(k) for [k, k1] in self.parm_map}
-        control_unit.set_parameters(control_params)
-
     def set_ui_parameters(self, parameters):
         for [k, k1] in self.parm_map:
             if k1 not in parameters:
@@ -0,0 +1,383 @@
+import os
+import pickle
+import socket
+import sqlite3
+import tempfile
+import time
+import traceback
+import uuid
+
+import unit_test as ut
+
+
+class FileQueue:
+    """
+    Queue of jobs in a directory (i.e. a shared one, mounted in many nodes), so tunings are evaluated by workers in any
+    node without a message broker:
+        pending/<job>.pickle  jobs not claimed yet
+        claimed/<job>.pickle  jobs being evaluated, a worker claims a job renaming it (atomic, so just one can do it)
+        done/<job>.pickle     results
+        stop                  if it exists, workers finish
+    """
+
+    k_pending   = 'pending'
+    k_claimed   = 'claimed'
+    k_done      = 'done'
+    k_stop      = 'stop'
+    k_extension = '.pickle'
+
+    def __init__(self, directory):
+        self.directory = directory
+        for state in [self.k_pending, self.k_claimed, self.k_done]:
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def put(self, job_id, payload):
+        save_atomic(self.get_file_name(self.k_pending, job_id), payload)
+
+    def claim(self):
+        """
+        Returns [job id, payload] of the oldest pending job (now claimed by this process) or None if there are not
+        """
+        for job_file in sorted(os.listdir(os.path.join(self.directory, self.k_pending))):
+            if not job_file.endswith(self.k_extension):
+                continue
+            job_id       = job_file[:-len(self.k_extension)]
+            claimed_name = self.get_file_name(self.k_claimed, job_id)
+            try:
+                os.rename(self.get_file_name(self.k_pending, job_id), claimed_name)
+            except OSError:
+                continue  # claimed by other worker
+            os.utime(claimed_name)  # claim time (see requeue_stale)
+            with open(claimed_name, 'rb') as job_file_object:
+                return [job_id, pickle.load(job_file_object)]
+        return None
+
+    def complete(self, job_id, result):
+        save_atomic(self.get_file_name(self.k_done, job_id), result)
+        remove_file(self.get_file_name(self.k_claimed, job_id))
+
+    def pop_result(self, job_id, default=None):
+        """
+        Returns the result of a job (and deletes it) or default if it is not done yet
+        """
+        file_name = self.get_file_name(self.k_done, job_id)
+        try:
+            with open(file_name, 'rb') as result_file:
+                result = pickle.load(result_file)
+        except IOError:
+            return default
+        remove_file(file_name)
+        return result
+
+    def requeue_stale(self, timeout):
+        """
+        Jobs claimed more than timeout seconds ago (i.e. its worker died) are pending again, returns how many
+        """
+        requeued = 0
+        now      = time.time()
+        for job_file in os.listdir(os.path.join(self.directory, self.k_claimed)):
+            claimed_name = os.path.join(self.directory, self.k_claimed, job_file)
+            try:
+                if now - os.path.getmtime(claimed_name) > timeout:
+                    os.rename(claimed_name, os.path.join(self.directory, self.k_pending, job_file))
+                    requeued += 1
+            except OSError:
+                pass  # completed or requeued by other process
+        return requeued
+
+    def stop(self):
+        open(os.path.join(self.directory, self.k_stop), 'w').close()
+
+    def is_stopped(self):
+        return os.path.exists(os.path.join(self.directory, self.k_stop))
+
+    def clear(self):
+        for state in [self.k_pending, self.k_claimed, self.k_done]:
+            for job_file in os.listdir(os.path.join(self.directory, state)):
+                remove_file(os.path.join(self.directory, state, job_file))
+        remove_file(os.path.join(self.directory, self.k_stop))
+
+    def get_file_name(self, state, job_id):
+        return os.path.join(self.directory, state, job_id + self.k_extension)
+
+
+class SQLiteQueue:
+    """
+    Same as FileQueue but in a SQLite file, a job is claimed in a transaction so just one worker can do it
+    Note: SQLite locking is not reliable in some network file systems, for workers in many nodes use FileQueue
+    """
+
+    k_pending = 'pending'
+    k_claimed = 'claimed'
+    k_done    = 'done'
+
+    def __init__(self, file_name):
+        self.file_name  = file_name
+        self.connection = sqlite3.connect(file_name, timeout=30.0, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, state TEXT, payload BLOB, '
+                                'result BLOB, worker TEXT, claimed REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY)')
+
+    def put(self, job_id, payload):
+        self.connection.execute('INSERT OR REPLACE INTO jobs (id, state, payload) VALUES (?, ?, ?)',
+                                (job_id, self.k_pending, pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)))
+
+    def claim(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.connection.execute('SELECT id, payload FROM jobs WHERE state = ? ORDER BY id LIMIT 1',
+                                          (self.k_pending,)).fetchone()
+            if row is not None:
+                self.connection.execute('UPDATE jobs SET state = ?, worker = ?, claimed = ? WHERE id = ?',
+                                        (self.k_claimed, worker_name(), time.time(), row[0]))
+        finally:
+            self.connection.execute('COMMIT')
+        return None if row is None else [row[0], pickle.loads(row[1])]
+
+    def complete(self, job_id, result):
+        self.connection.execute('UPDATE jobs SET state = ?, result = ?, payload = NULL WHERE id = ?',
+                                (self.k_done, pickle.dumps(result, pickle.HIGHEST_PROTOCOL), job_id))
+
+    def pop_result(self, job_id, default=None):
+        row = self.connection.execute('SELECT result FROM jobs WHERE id = ? AND state = ?',
+                                      (job_id, self.k_done)).fetchone()
+        if row is None:
+            return default
+        self.connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        return pickle.loads(row[0])
+
+    def requeue_stale(self, timeout):
+        cursor = self.connection.execute('UPDATE jobs SET state = ? WHERE state = ? AND claimed < ?',
+                                         (self.k_pending, self.k_claimed, time.time() - timeout))
+        return cursor.rowcount
+
+    def stop(self):
+        self.connection.execute("INSERT OR IGNORE INTO flags (name) VALUES ('stop')")
+
+    def is_stopped(self):
+        return self.connection.execute("SELECT COUNT(*) FROM flags WHERE name = 'stop'").fetchone()[0] > 0
+
+    def clear(self):
+        self.connection.execute('DELETE FROM jobs')
+        self.connection.execute('DELETE FROM flags')
+
+
+class QueueExecutor:
+    """
+    Evaluates parameters of an AutoTuneFunction with the workers of a queue (see run_worker), used by
+    auto_tune.AutoTuneFunction.auto_tune_with_executor
+    """
+
+    k_ok    = 'ok'
+    k_error = 'error'
+
+    def __init__(self, queue, poll=0.05, claim_timeout=600.0, timeout=None):
+        """
+        :param queue:         FileQueue or SQLiteQueue
+        :param poll:          seconds between checks of the results
+        :param claim_timeout: jobs claimed more than this seconds ago are given to other worker
+        :param timeout:       raise an exception if the results are not done in this seconds, None means wait forever
+        """
+        self.queue         = queue
+        self.poll          = poll
+        self.claim_timeout = claim_timeout
+        self.timeout       = timeout
+        self.jobs          = 0  # jobs evaluated so far
+
+    def map(self, function_object, parameters_list):
+        """
+        Returns the cost of each parameters (function_object.run_function_with_parameters), evaluated in parallel
+        """
+        return self.gather(self.submit(function_object, parameters_list))
+
+    def submit(self, function_object, parameters_list):
+        """
+        Adds a job for each parameters to the queue, returns their ids (see gather)
+        """
+        batch   = uuid.uuid4().hex
+        job_ids = ['%s_%04d' % (batch, i) for i in range(len(parameters_list))]
+        for job_id, parameters in zip(job_ids, parameters_list):
+            self.queue.put(job_id, [function_object, parameters])
+        return job_ids
+
+    def gather(self, job_ids):
+        """
+        Waits until the jobs are done and returns their costs, raises an exception if one of them failed
+        """
+        costs      = {}
+        start      = time.time()
+        last_check = start
+        while len(costs) < len(job_ids):
+            for job_id in job_ids:
+                result = self.queue.pop_result(job_id) if job_id not in costs else None
+                if result is None:
+                    continue
+                [state, value] = result
+                if state == self.k_error:
+                    raise Exception('Job %s failed in worker:\n%s' % (job_id, value))
+                costs[job_id] = value
+            if len(costs) < len(job_ids):
+                now = time.time()
+                if self.timeout is not None and now - start > self.timeout:
+                    raise Exception('Jobs not done in %s seconds, are workers running?' % self.timeout)
+                if now - last_check > self.claim_timeout:
+                    self.queue.requeue_stale(self.claim_timeout)
+                    last_check = now
+                time.sleep(self.poll)
+        self.jobs += len(job_ids)
+        return [costs[job_id] for job_id in job_ids]
+
+
+def run_worker(queue, poll=0.05, max_jobs=None, idle_timeout=None):
+    """
+    Evaluates the jobs of a queue until it is stopped (see FileQueue.stop), i.e. in each node that mounts the queue
+    directory:
+        python -c "import work_queue as wq; wq.run_worker(wq.FileQueue('/shared/tuning_queue'))"
+    :param queue:        FileQueue or SQLiteQueue (or its directory / .sqlite file name)
+    :param poll:         seconds to wait when there are no pending jobs
+    :param max_jobs:     finish after evaluating this jobs, None means no limit
+    :param idle_timeout: finish after this seconds without pending jobs, None means wait until stopped
+    :return: number of jobs evaluated
+    """
+    queue     = get_queue(queue)
+    jobs      = 0
+    idle_from = time.time()
+    while not queue.is_stopped() and (max_jobs is None or jobs < max_jobs):
+        job = queue.claim()
+        if job is None:
+            if idle_timeout is not None and time.time() - idle_from > idle_timeout:
+                break
+            time.sleep(poll)
+            continue
+        [job_id, [function_object, parameters]] = job
+        try:
+            result = [QueueExecutor.k_ok, function_object.run_function_with_parameters(parameters)]
+        except Exception:
+            result = [QueueExecutor.k_error, traceback.format_exc()]
+        queue.complete(job_id, result)
+        jobs     += 1
+        idle_from = time.time()
+    return jobs
+
+
+def get_queue(queue):
+    """
+    Returns the queue given its name: a .sqlite file is a SQLiteQueue, else a FileQueue directory
+    """
+    if not isinstance(queue, str):
+        return queue
+    return SQLiteQueue(queue) if queue.endswith('.sqlite') else FileQueue(queue)
+
+
+def save_atomic(file_name, value):
+    # other processes never read an incomplete file
+    temporal_file_name = '%s.%s.tmp' % (file_name, worker_name())
+    with open(temporal_file_name, 'wb') as output_file:
+        pickle.dump(value, output_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporal_file_name, file_name)
+
+
+def remove_file(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def worker_name():
+    return '%s_%s' % (socket.gethostname(), os.getpid())
+
+
+# tests
+def start_workers(queue_name, workers, poll=0.002):
+    import multiprocessing
+
+    processes = [multiprocessing.Process(target=run_worker, args=(queue_name, poll)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def stop_workers(queue_name, processes):
+    get_queue(queue_name).stop()
+    for process in processes:
+        process.join()
+
+
+def new_queue_name(kind):
+    name = os.path.join(tempfile.gettempdir(), 'test_work_queue' + ('.sqlite' if kind == 'sqlite' else ''))
+    get_queue(name).clear()
+    return name
+
+
+def test_ask_tell(control_params, reference, max_iter, speculative, kind, workers):
+    """
+    Returns True if tuning with workers gives the same parameters than the inline twiddle
+    """
+    import ControlUnit as cu
+
+    auto_tune   = cu.AutoTuneControl(cu.create_control(control_params), reference=reference, max_iter=max_iter)
+    expected    = auto_tune.auto_tune()
+    queue_name  = new_queue_name(kind)
+    processes   = start_workers(queue_name, workers)
+    try:
+        auto_tune = cu.AutoTuneControl(cu.create_control(control_params), reference=reference, max_iter=max_iter)
+        executor  = QueueExecutor(get_queue(queue_name), poll=0.002, timeout=120.0)
+        tuned     = auto_tune.auto_tune_with_executor(executor, speculative=speculative)
+    finally:
+        stop_workers(queue_name, processes)
+    print('   %s jobs, tuned: %s' % (executor.jobs, {name: round(value, 3) for name, value in tuned.items()}))
+    return all(abs(tuned[name] - expected[name]) < 1e-6 for name in expected)
+
+
+def test_claim_once(kind, jobs, workers):
+    """
+    Returns [jobs evaluated, True if each one was evaluated just once]
+    """
+    import ControlUnit as cu
+
+    queue_name = new_queue_name(kind)
+    processes  = start_workers(queue_name, workers)
+    try:
+        auto_tune  = cu.AutoTuneControl(cu.create_control({'type': 'PID', 'gains': [1.0, 0.0, 0.0]}), reference=5.0,
+                                        max_iter=50)
+        executor   = QueueExecutor(get_queue(queue_name), poll=0.002, timeout=60.0)
+        costs      = executor.map(auto_tune, [{'p': 1.0 + 0.1*i} for i in range(jobs)])
+        expected   = [auto_tune.run_function_with_parameters({'p': 1.0 + 0.1*i}) for i in range(jobs)]
+    finally:
+        stop_workers(queue_name, processes)
+    return [executor.jobs, costs == expected]
+
+
+def test_stale_claim(kind):
+    """
+    Returns [job claimed again after its worker died, payload]
+    """
+    queue = get_queue(new_queue_name(kind))
+    queue.put('job1', [None, {'p': 1.0}])
+    queue.claim()
+    claimed_again = queue.claim()
+    time.sleep(0.05)
+    queue.requeue_stale(0.01)
+    [_, payload] = queue.claim()
+    return [claimed_again is not None, payload[1]]
+
+
+def test_worker_error(kind):
+    """
+    Returns the first line of the exception raised when a job fails in a worker
+    """
+    queue    = get_queue(new_queue_name(kind))
+    executor = QueueExecutor(queue)
+    job_ids  = executor.submit(None, [{'p': 1.0}])
+    run_worker(queue, max_jobs=1)
+    try:
+        executor.gather(job_ids)
+    except Exception as e:
+        return str(e).splitlines()[0].replace(job_ids[0], 'job')
+    return None
+
+
+if __name__ == "__main__":
+    ut.UnitTest(__name__, 'tests/work_queue.test', '')
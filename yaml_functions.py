@@ -1,37 +1,68 @@
 #!/usr/bin/env python
 
+import copy
+import hashlib
 import os
+import pickle
+import time
 import yaml
 import json
 import sys
 PY3 = sys.version_info[0] == 3
 
+yaml_loader    = getattr(yaml, 'CFullLoader', yaml.FullLoader) if PY3 else None  # C (libyaml) loader when available
+use_disk_cache = True         # keep a pickled copy of the package's parsed yaml files (used when the process starts)
+package_dir    = os.path.dirname(os.path.abspath(__file__))
+disk_cache_dir = os.path.join(package_dir, '__pycache__', 'yaml')  # where the pickled copies are saved
+recent_time_ns = 2*10**9      # files changed more recently than this are also compared by content (see get_signature)
+_file_cache    = {}  # full file name -> CachedFile, see get_cached_file
+_shared        = {}  # id of the (shared) content of a CachedFile -> CachedFile, used to find its indexes
 
-def get_yaml_file(file_name, directory='', type='r', must_exist=True, verbose=False):
+
+class CachedFile(object):
+    """
+    A parsed yaml file, kept both pickled (to return independent copies fast) and parsed (shared, must not be modified)
+    plus the indexes (i.e. records by name) built on demand for the shared content
+    """
+    def __init__(self, signature, pickled):
+        """
+        :param signature: see get_signature, of the file when parsed, used to know if it has to be re-parsed
+        :param pickled:   parsed file content, pickled
+        """
+        self.signature = signature
+        self.pickled   = pickled
+        self.data      = pickle.loads(pickled)
+        self.indexes   = {}
+
+    def get_copy(self):
+        return pickle.loads(self.pickled)
+
+    def get_index(self, index_name, build_function):
+        if index_name not in self.indexes:
+            self.indexes[index_name] = build_function(self.data)
+        return self.indexes[index_name]
+
+
+def get_yaml_file(file_name, directory='', type='r', must_exist=True, verbose=False, copy=True):
+    """
+    Returns the content of a yaml file, parsed only the first time (or when the file is changed) see get_cached_file
+    :param file_name:  if not absolute, relative to directory
+    :param directory:  '' for this script directory, None for the current directory
+    :param type:       mode used to open the file
+    :param must_exist: if True raises an exception if the file does not exist, if not returns {}
+    :param verbose:
+    :param copy:       if False returns the content shared by all callers (faster and allows get_record to use an
+                       index) so it must not be modified
+    :return:
+    """
     if not file_name:
         print('No file name given')
         return
-    if os.path.isabs(file_name):
-        full_file_name = file_name
-    else:
-        if directory is None:
-            script_dir = ''
-        elif directory == '':
-            script_dir = os.path.dirname(__file__) + '/'  # <-- absolute dir the script is in
-        else:
-            script_dir = directory + '/'
-        full_file_name = script_dir + file_name
+    full_file_name = get_full_file_name(file_name, directory)
 
     try:
-        with open(full_file_name, type) as yml_file:
-            if verbose:
-                print('Loading %s ...' % full_file_name)
-            if PY3:
-                cfg = yaml.load(yml_file, Loader=yaml.FullLoader)
-            else:
-                cfg = yaml.load(yml_file)
-            if verbose:
-                print('loaded')
+        cached = get_cached_file(full_file_name, type=type, verbose=verbose)
+        cfg    = cached.get_copy() if copy else cached.data
     except IOError:
         cfg = {}
         if must_exist:
@@ -39,6 +70,125 @@ def get_yaml_file(file_name, directory='', type='r', must_exist=True, verbose=Fa
     return cfg
 
 
+def get_full_file_name(file_name, directory=''):
+    if os.path.isabs(file_name):
+        return file_name
+    if directory is None:
+        script_dir = ''
+    elif directory == '':
+        script_dir = os.path.dirname(__file__) + '/'  # <-- absolute dir the script is in
+    else:
+        script_dir = directory + '/'
+    return script_dir + file_name
+
+
+def get_cached_file(full_file_name, type='r', verbose=False):
+    """
+    Returns the CachedFile of a yaml file, it is re-parsed only if its signature changed, if not in memory its pickled
+    copy on disk is used (if still valid)
+    """
+    signature = get_signature(full_file_name)
+    cached    = _file_cache.get(full_file_name)
+    if cached is not None and cached.signature == signature:
+        return cached
+
+    if cached is not None:
+        del _shared[id(cached.data)]
+    cached = CachedFile(signature, load_pickled(full_file_name, signature, type, verbose))
+    _file_cache[full_file_name] = cached
+    _shared[id(cached.data)]    = cached
+    return cached
+
+
+def get_signature(full_file_name):
+    """
+    Returns what identifies a version of a file: inode, modification and change times and size, plus a hash of its
+    content if changed recently (it could be rewritten within the same time tick with the same size)
+    """
+    stat      = os.stat(full_file_name)
+    signature = [stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size]
+    if time.time_ns() - max(stat.st_mtime_ns, stat.st_ctime_ns) < recent_time_ns:
+        with open(full_file_name, 'rb') as file_object:
+            signature.append(hashlib.sha1(file_object.read()).hexdigest())
+    return signature
+
+
+def load_pickled(full_file_name, signature, type='r', verbose=False):
+    # returns the yaml file content pickled, from disk if parsed before (and not changed since) or parsing it
+    pickle_file_name = get_pickle_file_name(full_file_name) if use_disk_cache else None
+    if pickle_file_name is not None:
+        try:
+            with open(pickle_file_name, 'rb') as pickle_file:
+                saved_signature, pickled = pickle.load(pickle_file)
+            if saved_signature == signature:
+                return pickled
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    with open(full_file_name, type) as yml_file:
+        if verbose:
+            print('Loading %s ...' % full_file_name)
+        if PY3:
+            try:
+                cfg = yaml.load(yml_file, Loader=yaml_loader)
+            except yaml.YAMLError:
+                # libyaml is stricter than the python parser (i.e. with ':' inside flow mappings)
+                yml_file.seek(0)
+                cfg = yaml.load(yml_file, Loader=yaml.FullLoader)
+        else:
+            cfg = yaml.load(yml_file)
+        if verbose:
+            print('loaded')
+    pickled = pickle.dumps(cfg, pickle.HIGHEST_PROTOCOL)
+
+    if pickle_file_name is not None:
+        save_pickled([signature, pickled], pickle_file_name)
+    return pickled
+
+
+def save_pickled(content, pickle_file_name):
+    # saves in a temporal file first, so other process never reads an incomplete file
+    temporal_file_name = '%s.%s.tmp' % (pickle_file_name, os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(pickle_file_name)):
+            os.makedirs(os.path.dirname(pickle_file_name))
+        with open(temporal_file_name, 'wb') as pickle_file:
+            pickle.dump(content, pickle_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporal_file_name, pickle_file_name)
+    except (IOError, OSError):
+        pass  # i.e. a read only directory, the file will be parsed each time the process starts
+
+
+def get_pickle_file_name(full_file_name):
+    # None for files out of the package (i.e. in /tmp or user directories): anyone could place a pickle there
+    full_file_name = os.path.realpath(full_file_name)
+    directory      = os.path.realpath(package_dir)
+    if os.path.commonpath([directory, full_file_name]) != directory:
+        return None
+    return os.path.join(disk_cache_dir, os.path.relpath(full_file_name, directory) + '.pickle')
+
+
+def clear_cache(disk=False):
+    """
+    Removes all the parsed yaml files from memory (and their pickled copies from disk if disk is True)
+    """
+    if disk:
+        for full_file_name in _file_cache:
+            pickle_file_name = get_pickle_file_name(full_file_name)
+            if pickle_file_name is not None and os.path.exists(pickle_file_name):
+                os.remove(pickle_file_name)
+    _file_cache.clear()
+    _shared.clear()
+
+
+def get_index(content, index_name, build_function):
+    # returns the index of a shared content (see get_yaml_file) or None if content is not shared
+    cached = _shared.get(id(content))
+    if cached is None or cached.data is not content:
+        return None
+    return cached.get_index(index_name, build_function)
+
+
 def get_json_file(file_name, directory='', type='r', must_exist=True, verbose=False):
     if not file_name:
         print('No file name given')
@@ -112,6 +262,13 @@ def get_record(all_file, name, collection_name, record_name, key_name='name', al
     #      tests:             # collection name
     #         - test:         # record name
     #             name:  xxx  # key_name: name
+    #  if all_file is shared (see get_yaml_file) records are found by an index, if not scanning the collection
+    index = get_index(all_file, ('record', collection_name, record_name, key_name, alternative_key_name),
+                      lambda content: records_by_name(content, collection_name, record_name, key_name,
+                                                      alternative_key_name))
+    if index is not None and name in index:
+        return index[name]
+
     if collection_name not in all_file:
         raise Exception('Collection %s not found in %s' % (collection_name, all_file))
 
@@ -130,30 +287,64 @@ def get_record(all_file, name, collection_name, record_name, key_name='name', al
     raise Exception('Name %s not found in %s' % (name, record_name))
 
 
+def records_by_name(all_file, collection_name, record_name, key_name, alternative_key_name):
+    # index for get_record, just the records before any one without a key (get_record scans to report the error)
+    index = {}
+    for test_data in all_file.get(collection_name, []) if isinstance(all_file, dict) else []:
+        data = test_data[record_name]
+        if key_name in data:
+            valid_key_name = key_name
+        elif alternative_key_name in data:
+            valid_key_name = alternative_key_name
+        else:
+            break
+        try:
+            index.setdefault(data[valid_key_name], data)
+        except TypeError:
+            break  # not hashable name
+    return index
+
+
 def get_group_data(file_name, group_name, name='', key_name='name'):
     # Given a yaml FileName a group_name and a name, returns its data
     # ex: test.yaml, 'test', 'my test' return a group name 'test' in file test.yaml whose name is 'my test'
     #   if name is '' returns the first one
     #   'name' is configurable with key_name (ex: searching for 'external_name:' instead of 'name:'
 
-    all_file = get_yaml_file(file_name)
-    for definition in all_file:
-        if group_name in definition:
-            kvs = definition[group_name]
-            if name == '':
-                return kvs
-            for key, value in kvs.items():
-                if key == key_name and value == name:
-                    return kvs
+    all_file = get_yaml_file(file_name, copy=False)
+    first, by_name = get_index(all_file, ('group', group_name, key_name),
+                               lambda content: groups_by_name(content, group_name, key_name))
+    kvs = first if name == '' else by_name.get(name)
+    if kvs is not None:
+        return copy.deepcopy(kvs)
 
     not_found = '"- %s" group' % group_name if name == '' else '"- %s" named "%s"' % (group_name, name)
     raise Exception('%s does not exists in %s' % (not_found, file_name))
 
 
+def groups_by_name(all_file, group_name, key_name):
+    # index for get_group_data: the first group and the groups by name
+    first   = None
+    by_name = {}
+    for definition in all_file:
+        if group_name in definition:
+            kvs = definition[group_name]
+            if first is None:
+                first = kvs
+            if key_name in kvs:
+                by_name.setdefault(kvs[key_name], kvs)
+    return first, by_name
+
+
 def get_all_names(file_name, group_name, key_name='name', key_description='description'):
     # given a file_name and group_name returns all the groups' name
+    all_file = get_yaml_file(file_name, copy=False)
+    return list(get_index(all_file, ('names', group_name, key_name, key_description),
+                          lambda content: all_names(content, group_name, key_name, key_description)))
+
+
+def all_names(all_file, group_name, key_name, key_description):
     names = []
-    all_file = get_yaml_file(file_name)
     for definition in all_file:
         if group_name in definition:
             kvs = definition[group_name]
@@ -197,3 +388,105 @@ def directory_path(file_name):
     :return:
     """
     return os.path.dirname(file_name)
+
+
+# tests
+def test_same_as_parsed(file_names):
+    """
+    Returns True if the (cached) content of all the files is the same as just parsing them
+    """
+    for file_name in file_names:
+        with open(get_full_file_name(file_name)) as yml_file:
+            parsed = yaml.load(yml_file, Loader=yaml.FullLoader)
+        for _ in range(2):  # first parsed (or from disk), then from memory
+            if get_yaml_file(file_name) != parsed or get_yaml_file(file_name, copy=False) != parsed:
+                print('   %s is different' % file_name)
+                return False
+    return True
+
+
+def test_changed_file(first_content, second_content):
+    """
+    Returns the content read after saving a yaml file twice (the cache must notice it was changed)
+    """
+    full_file_name = save_yaml_file(first_content, 'test_changed_file.yaml', directory='/tmp')
+    contents       = [get_yaml_file(full_file_name)]
+    save_yaml_file(second_content, 'test_changed_file.yaml', directory='/tmp')
+    os.utime(full_file_name, ns=(time.time_ns(), time.time_ns() + 1000))  # just in case both saves have the same time
+    contents.append(get_yaml_file(full_file_name))
+    clear_cache(disk=True)
+    return contents
+
+
+def test_same_size_rewrite(first_content, second_content):
+    """
+    Returns the content read after rewriting a yaml file with the same size and modification time
+    """
+    full_file_name = save_yaml_file(first_content, 'test_same_size_rewrite.yaml', directory='/tmp')
+    stat           = os.stat(full_file_name)
+    contents       = [get_yaml_file(full_file_name)]
+    save_yaml_file(second_content, 'test_same_size_rewrite.yaml', directory='/tmp')
+    os.utime(full_file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    contents.append(get_yaml_file(full_file_name))
+    clear_cache()
+    return contents
+
+
+def test_no_disk_cache_outside(content):
+    """
+    Returns True if a yaml file out of the package is not pickled to disk (neither next to it nor in the package)
+    """
+    full_file_name = save_yaml_file(content, 'test_no_disk_cache.yaml', directory='/tmp')
+    get_yaml_file(full_file_name)
+    clear_cache()
+    return get_pickle_file_name(full_file_name) is None and \
+        not os.path.exists('/tmp/__pycache__/test_no_disk_cache.yaml.pickle')
+
+
+def test_disk_cache(file_name):
+    """
+    Returns True if after removing the file from memory it is read from its pickled copy on disk
+    """
+    expected = get_yaml_file(file_name)
+    _file_cache.clear()
+    _shared.clear()
+    global yaml_loader
+    saved_loader, yaml_loader = yaml_loader, None  # so it fails if parsed again
+    try:
+        return get_yaml_file(file_name) == expected
+    finally:
+        yaml_loader = saved_loader
+
+
+def test_get_record(file_name, name, collection_name, record_name):
+    """
+    Returns True if the record found using the index is the same as the one found scanning the collection
+    """
+    indexed = get_record(get_yaml_file(file_name, copy=False), name, collection_name, record_name)
+    scanned = get_record(get_yaml_file(file_name), name, collection_name, record_name)
+    return indexed == scanned
+
+
+def test_cache_speedup(file_name, name, collection_name, record_name, times):
+    """
+    Prints how many times faster is getting a record from a cached file than parsing it
+    """
+    full_file_name = get_full_file_name(file_name)
+    start = time.perf_counter()
+    for _ in range(times):
+        with open(full_file_name) as yml_file:
+            all_file = yaml.load(yml_file, Loader=yaml.FullLoader)
+        get_record(all_file, name, collection_name, record_name)
+    parse_time = time.perf_counter() - start
+
+    for copy_content in [True, False]:
+        start = time.perf_counter()
+        for _ in range(times):
+            get_record(get_yaml_file(file_name, copy=copy_content), name, collection_name, record_name)
+        cached_time = time.perf_counter() - start
+        print('   %s copy=%s: %.1f times faster than parsing' % (file_name, copy_content, parse_time/cached_time))
+
+
+if __name__ == "__main__":
+    import unit_test as ut
+    ut.UnitTest(__name__, 'tests/yaml_functions.test', '')